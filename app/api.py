@@ -0,0 +1,434 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from config import Device
+from controller import Controller, DeviceNotFoundError
+from health import DeviceUnavailableError
+from metrics import metrics
+from scheduler import ScheduleError
+
+"""
+Local HTTP/JSON control API.
+
+Other programs control the devices of iot_devices.json through this server
+instead of talking to Tasmota or Yeelight themselves. It runs on its own
+asyncio loop, device I/O goes through the ``Controller`` (keep-alive Tasmota
+sessions, Yeelight connections, MQTT) on a thread pool.
+
+    GET  /devices                   every device with its cached state
+    GET  /devices/<name>            state of a device
+    GET  /health                    latency, error rate and breaker state
+    GET  /metrics                   metrics.py, Prometheus text format
+    GET  /schedules                 schedules with their next run
+    POST /schedules                 {"name": "off", "at": "23:30",
+                                     "actions": [{"device": "Plug", "power": "off"}]}
+    DELETE /schedules/<name>        a schedule added with POST
+    GET  /telemetry/<name>          power and energy of a plug, telemetry.py
+                                    ?start=&end= (timestamps, last 24 hours by
+                                    default) &bucket= (seconds per point)
+    POST /devices/<name>/toggle
+    POST /devices/<name>/set        {"power": "on", "dimmer": 40}
+    POST /scenes/<name>
+    POST /batch                     {"commands": [
+                                        {"device": "Plug", "action": "toggle"},
+                                        {"device": "Bulb", "action": "set",
+                                         "settings": {"ct": 400}}
+                                    ]}
+
+States are served from the state cache, a device is only asked when its entry
+is missing or expired (or with ``?refresh=1``), and concurrent requests for the
+same device share a single round-trip. Batch commands run concurrently, except
+those of the same device which run in order; several "set" of one device are
+merged into one request when its driver can (see drivers.py). Device errors are answered with
+502 and {"error": "..."}, devices known to be down with 503 at once.
+
+    "iot": {
+        "api": {"host": "127.0.0.1", "port": 8321},
+        "devices": [...]
+    }
+
+"""
+
+
+API_HOST = "127.0.0.1"
+API_PORT = 8321
+# device commands running at the same time
+API_MAX_WORKERS = 32
+# seconds an idle keep-alive connection stays open
+API_KEEPALIVE_TIMEOUT = 30.0
+# largest request body accepted, in bytes
+API_MAX_BODY = 1024 * 1024
+# batch actions, same names as the endpoints
+BATCH_ACTIONS = ("state", "toggle", "set")
+# seconds of a telemetry query without a start
+TELEMETRY_DEFAULT_RANGE = 86400
+# text payloads are the metrics
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ApiServer:
+    def __init__(
+        self,
+        controller: Controller,
+        host: str = API_HOST,
+        port: int = API_PORT,
+        max_workers: int = API_MAX_WORKERS,
+        scheduler=None,
+        telemetry=None,
+    ) -> None:
+        self.controller = controller
+        # scheduler.Scheduler of the /schedules endpoints
+        self.scheduler = scheduler
+        # telemetry.TelemetryStore of the /telemetry endpoint
+        self.telemetry = telemetry
+        self.host = host
+        self.port = port
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="iot-api"
+        )
+        self._fetching = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self.ready = threading.Event()
+
+    def start(self) -> None:
+        """Serve in a background thread, e.g. next to the GUI."""
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="iot-api", daemon=True
+        )
+        self._thread.start()
+        self.ready.wait(5)
+
+    def serve_forever(self) -> None:
+        """Serve until ``stop()``, blocking."""
+        asyncio.run(self._serve())
+
+    def stop(self) -> None:
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        if self._thread is not None:
+            self._thread.join(5)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        # port 0 picks a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.ready.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(reader), API_KEEPALIVE_TIMEOUT
+                    )
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except ApiError as e:
+                    await self._write(writer, e.status, {"error": str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    status, payload = 200, await self._route(method, target, body)
+                except ApiError as e:
+                    status, payload = e.status, {"error": str(e)}
+                await self._write(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            # client gone, or server stopped
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[tuple]:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ApiError(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise ApiError(400, "Malformed Content-Length header")
+        if length < 0:
+            raise ApiError(400, "Malformed Content-Length header")
+        if length > API_MAX_BODY:
+            raise ApiError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target, headers, body
+
+    @staticmethod
+    async def _write(
+        writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool
+    ) -> None:
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), PROMETHEUS_CONTENT_TYPE
+        else:
+            body, content_type = json.dumps(payload).encode(), "application/json"
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _route(self, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        refresh = "refresh=1" in url.query
+        if parts == ["devices"]:
+            self._expect(method, "GET")
+            return [
+                {
+                    **device.as_dict(),
+                    "state": self.controller.cache.get(device.ip),
+                    "available": self.controller.is_available(device),
+                }
+                for device in self.controller.config.devices
+            ]
+        if parts == ["health"]:
+            self._expect(method, "GET")
+            return {
+                device.name: self.controller.health.stats(device)
+                for device in self.controller.config.devices
+            }
+        if parts == ["schedules"] or (len(parts) == 2 and parts[0] == "schedules"):
+            return self._schedules(method, parts, body)
+        if len(parts) == 2 and parts[0] == "telemetry":
+            self._expect(method, "GET")
+            return await self._telemetry(parts[1], parse_qs(url.query))
+        if parts == ["metrics"]:
+            self._expect(method, "GET")
+            return metrics.render()
+        if len(parts) == 2 and parts[0] == "devices":
+            self._expect(method, "GET")
+            return await self._command(parts[1], "state", refresh=refresh)
+        if len(parts) == 3 and parts[0] == "devices":
+            self._expect(method, "POST")
+            if parts[2] not in ("toggle", "set"):
+                raise ApiError(404, f"Unknown action: {parts[2]}")
+            settings = self._json(body) if parts[2] == "set" else None
+            return await self._command(parts[1], parts[2], settings)
+        if len(parts) == 2 and parts[0] == "scenes":
+            self._expect(method, "POST")
+            return await self._scene(parts[1])
+        if parts == ["batch"]:
+            self._expect(method, "POST")
+            return await self._batch(self._json(body))
+        raise ApiError(404, f"Unknown path: {url.path}")
+
+    def _schedules(self, method: str, parts: list, body: bytes):
+        if self.scheduler is None:
+            raise ApiError(404, "Schedules are not run by this server")
+        try:
+            if len(parts) == 2:
+                self._expect(method, "DELETE")
+                self.scheduler.remove(parts[1])
+                return {"removed": parts[1]}
+            if method == "POST":
+                return self.scheduler.add(self._json(body)).as_dict()
+            self._expect(method, "GET")
+        except ScheduleError as e:
+            raise ApiError(404 if len(parts) == 2 else 400, str(e))
+        return [schedule.as_dict() for schedule in self.scheduler.schedules()]
+
+    async def _telemetry(self, name: str, query: dict) -> dict:
+        if self.telemetry is None:
+            raise ApiError(404, "No telemetry in iot_devices.json")
+        try:
+            device = self.controller.find(name)
+        except DeviceNotFoundError as e:
+            raise ApiError(404, str(e))
+        try:
+            end = float(query.get("end", [time.time()])[0])
+            start = float(query.get("start", [end - TELEMETRY_DEFAULT_RANGE])[0])
+            bucket = query.get("bucket")
+            bucket = None if bucket is None else int(bucket[0])
+        except ValueError:
+            raise ApiError(400, "start, end and bucket must be numbers")
+        if end <= start or (bucket is not None and bucket <= 0):
+            raise ApiError(400, "Expected start < end and bucket > 0")
+        return await self._run(self.telemetry.query, device.name, start, end, bucket)
+
+    @staticmethod
+    def _expect(method: str, expected: str) -> None:
+        if method != expected:
+            raise ApiError(405, f"Use {expected}")
+
+    @staticmethod
+    def _json(body: bytes):
+        try:
+            return json.loads(body or b"{}")
+        except ValueError:
+            raise ApiError(400, "Invalid json body")
+
+    async def _run(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _command(self, name: str, action: str, settings=None, refresh=False):
+        try:
+            device = self.controller.find(name)
+        except DeviceNotFoundError as e:
+            raise ApiError(404, str(e))
+        if action == "set" and not isinstance(settings, dict):
+            raise ApiError(400, "Settings must be a json object")
+        if action == "batch" and not all(isinstance(s, dict) for s in settings):
+            raise ApiError(400, "Settings must be json objects")
+        try:
+            if action == "state":
+                return await self._state(device, refresh)
+            if action == "toggle":
+                await self._run(self.controller.toggle, device)
+            elif action == "batch":
+                await self._run(self.controller.batch, device, settings)
+            else:
+                await self._run(self.controller.set, device, settings)
+        except (ValueError, KeyError) as e:
+            raise ApiError(400, f"Invalid settings: {e}")
+        except DeviceUnavailableError as e:
+            raise ApiError(503, str(e))
+        except Exception as e:
+            raise ApiError(502, str(e))
+        return {
+            "name": device.name,
+            "state": self.controller.cache.get(device.ip),
+        }
+
+    async def _state(self, device: Device, refresh: bool) -> dict:
+        ip = device.ip
+        state = None if refresh else self.controller.cache.get(ip)
+        if state is None:
+            # one round-trip per device, whatever the number of requests
+            future = self._fetching.get(ip)
+            if future is None:
+                future = self._fetching[ip] = asyncio.ensure_future(
+                    self._run(self.controller.get_state, device)
+                )
+                future.add_done_callback(lambda f: self._fetching.pop(ip, None))
+            state = await asyncio.shield(future)
+            self.controller.cache.set(ip, state)
+        return {"name": device.name, "state": state}
+
+    async def _scene(self, name: str) -> dict:
+        if name not in self.controller.config.scenes:
+            raise ApiError(404, f"Unknown scene: {name}")
+        results = await self._run(self.controller.scene, name)
+        return {
+            device_name: None if error is None else str(error)
+            for device_name, error in results.items()
+        }
+
+    async def _batch(self, payload) -> dict:
+        commands = payload.get("commands") if isinstance(payload, dict) else None
+        if not isinstance(commands, list):
+            raise ApiError(400, 'Expected {"commands": [...]}')
+        for command in commands:
+            if not isinstance(command, dict) or command.get("action") not in (
+                BATCH_ACTIONS
+            ):
+                raise ApiError(400, f"Invalid command: {command}")
+        results = [None] * len(commands)
+
+        async def _device(name: str, indexes: list) -> None:
+            if len(indexes) > 1 and all(
+                commands[index]["action"] == "set" for index in indexes
+            ):
+                # all the settings of the device at once, see Driver.batch
+                groups = [(indexes, "batch")]
+            else:
+                # commands of a device keep their order
+                groups = [([index], commands[index]["action"]) for index in indexes]
+            for group, action in groups:
+                command = commands[group[0]]
+                if action == "batch":
+                    settings = [commands[index].get("settings") for index in group]
+                else:
+                    settings = command.get("settings")
+                try:
+                    reply = await self._command(
+                        name,
+                        action,
+                        settings,
+                        refresh=bool(command.get("refresh")),
+                    )
+                    result = {"ok": True, **reply}
+                except ApiError as e:
+                    result = {"ok": False, "name": name, "error": str(e)}
+                for index in group:
+                    results[index] = result
+
+        by_device = {}
+        for index, command in enumerate(commands):
+            by_device.setdefault(str(command.get("device")), []).append(index)
+        await asyncio.gather(
+            *(_device(name, indexes) for name, indexes in by_device.items())
+        )
+        return {"results": results}
+
+
+def server_from_config(
+    controller: Controller, scheduler=None, telemetry=None
+) -> Optional[ApiServer]:
+    """
+    Build and start the server from the optional "api" section of
+    iot_devices.json, None when the section is missing.
+    """
+    options = controller.config.api
+    if options is None:
+        return None
+    server = ApiServer(
+        controller,
+        host=options.get("host", API_HOST),
+        port=int(options.get("port", API_PORT)),
+        scheduler=scheduler,
+        telemetry=telemetry,
+    )
+    server.start()
+    return server
@@ -0,0 +1,254 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from config import compile_config
+from controller import Controller
+from simulator import Conditions, Simulator
+
+"""
+Throughput and latency benchmark against simulated devices.
+
+For each number of devices, the devices are simulated by simulator.py and
+driven through the ``Controller``, the same path as the GUI, the command line
+and the HTTP API:
+
+    commands    toggles spread over all devices by ``--workers`` threads:
+                commands per second, p50 and p99 latency, errors
+    fan-out     one scene switching every device on, wall time
+
+    python benchmark.py --devices 1 10 100 1000 --latency 20
+    python benchmark.py --kind yeelight --devices 1 10
+    python benchmark.py --save before.json
+    python benchmark.py --baseline before.json
+    python benchmark.py --devices 2000 --shards 4 --simulators 4
+
+``--shards`` drives the devices through the worker processes of sharding.py,
+``--simulators`` serves the simulated devices from that many processes
+instead of this one, so that the simulator does not compete with the
+controller for the GIL.
+
+``--baseline`` compares with the results saved by an earlier run and exits
+with 1 when a measure got worse by more than ``--tolerance`` percent.
+"""
+
+
+DEFAULT_DEVICES = (1, 10, 100)
+DEFAULT_COMMANDS = 1000
+DEFAULT_WORKERS = 32
+# percent a measure may get worse before it is reported as a regression
+DEFAULT_TOLERANCE = 10.0
+KINDS = {
+    "tasmota": "tasmota-plug",
+    "light": "tasmota-light-RGBCCT",
+    "yeelight": "yeelight-bulb",
+}
+# higher is better for these measures, lower for the others
+HIGHER_IS_BETTER = ("commands_per_second",)
+
+
+def percentile(values: list, percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def simulate(kind: str, count: int, conditions, conn=None) -> Simulator:
+    """
+    Start ``count`` simulated devices of one kind. In a simulator process
+    (``conn`` set), send their config and serve them until told to stop.
+    """
+    simulator = Simulator(seed=0)
+    if kind == "yeelight":
+        simulator.add_yeelight(count, conditions)
+    else:
+        simulator.add_tasmota(count, KINDS[kind], conditions)
+    simulator.start()
+    if conn is None:
+        return simulator
+    conn.send(simulator.devices())
+    try:
+        conn.recv()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    simulator.stop()
+
+
+def run(
+    kind: str,
+    count: int,
+    commands: int,
+    workers: int,
+    conditions,
+    shards: int = 0,
+    simulators: int = 0,
+) -> dict:
+    """Measure ``count`` simulated devices of one kind."""
+    if simulators:
+        context = multiprocessing.get_context("spawn")
+        processes, devices = [], []
+        for index in range(simulators):
+            conn, child = context.Pipe()
+            share = count // simulators + (index < count % simulators)
+            process = context.Process(
+                target=simulate, args=(kind, share, conditions, child), daemon=True
+            )
+            process.start()
+            processes.append((process, conn))
+            for device in conn.recv():
+                # names are only unique inside one simulator
+                devices.append({**device, "name": f"{device['name']} @{index}"})
+
+        def _stop_simulators() -> None:
+            for process, conn in processes:
+                conn.send("stop")
+                process.join()
+
+    else:
+        simulator = simulate(kind, count, conditions)
+        devices = simulator.devices()
+        _stop_simulators = simulator.stop
+    config = compile_config(
+        {
+            "devices": devices,
+            "scenes": {"all on": [{"group": "all", "power": "on"}]},
+        }
+    )
+    if shards:
+        from sharding import ShardedController
+
+        controller = ShardedController(config, shards)
+    else:
+        controller = Controller(config)
+    devices = config.devices
+    latencies, errors = [], 0
+
+    def _toggle(index: int) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            controller.toggle(devices[index % len(devices)])
+        except Exception:
+            errors += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    def _connect(device) -> None:
+        try:
+            controller.get_state(device)
+        except Exception:
+            pass
+
+    try:
+        # connections opened outside of the measure
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_connect, devices))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_toggle, range(max(commands, count))))
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = controller.scene("all on")
+        fan_out = time.perf_counter() - start
+    finally:
+        controller.close()
+        _stop_simulators()
+    return {
+        "devices": count,
+        "commands_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "errors": errors,
+        "fan_out_ms": round(fan_out * 1000, 1),
+        "fan_out_errors": sum(1 for e in results.values() if e is not None),
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float) -> tuple:
+    """Lines describing each measure against the baseline, and regressions."""
+    lines, regressions = [], []
+    previous = {entry["devices"]: entry for entry in baseline}
+    for entry in results:
+        old = previous.get(entry["devices"])
+        if old is None:
+            continue
+        for key in ("commands_per_second", "p50_ms", "p99_ms", "fan_out_ms"):
+            if not old.get(key) or entry.get(key) is None:
+                continue
+            change = (entry[key] - old[key]) / old[key] * 100
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            lines.append(
+                f"{entry['devices']:>7}  {key:20} {old[key]:>10} -> "
+                f"{entry[key]:>10}  {change:+6.1f}%{flag}"
+            )
+            if flag:
+                regressions.append(lines[-1])
+    return lines, regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the controller against simulated devices"
+    )
+    parser.add_argument("--kind", choices=sorted(KINDS), default="tasmota")
+    parser.add_argument("--devices", type=int, nargs="+", default=list(DEFAULT_DEVICES))
+    parser.add_argument("--commands", type=int, default=DEFAULT_COMMANDS)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument(
+        "--shards", type=int, default=0, help="controller worker processes"
+    )
+    parser.add_argument("--simulators", type=int, default=0, help="simulator processes")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument("--loss", type=float, default=0, help="0..1")
+    parser.add_argument("--save", type=Path, help="write the results as json")
+    parser.add_argument("--baseline", type=Path, help="results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    conditions = Conditions(
+        latency=args.latency / 1000, jitter=args.jitter / 1000, loss=args.loss
+    )
+    print(
+        f"{'devices':>7} {'cmd/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'errors':>7} {'fan-out ms':>11}"
+    )
+    results = []
+    for count in args.devices:
+        entry = run(
+            args.kind,
+            count,
+            args.commands,
+            args.workers,
+            conditions,
+            shards=args.shards,
+            simulators=args.simulators,
+        )
+        results.append(entry)
+        print(
+            f"{entry['devices']:>7} {entry['commands_per_second']:>10} "
+            f"{entry['p50_ms']!s:>8} {entry['p99_ms']!s:>8} "
+            f"{entry['errors']:>7} {entry['fan_out_ms']:>11}"
+        )
+
+    if args.save is not None:
+        with args.save.open("w") as filehandle:
+            json.dump({"kind": args.kind, "results": results}, filehandle, indent=4)
+    if args.baseline is not None:
+        with args.baseline.open("r") as filehandle:
+            baseline = json.load(filehandle)["results"]
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print()
+        print("\n".join(lines))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
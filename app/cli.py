@@ -0,0 +1,356 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+from config import GROUP_ALL, ConfigError, ConfigWatcher, group_devices, load_config
+from controller import Controller, DeviceNotFoundError
+from tasmota import TasmotaHttpClient
+
+"""
+Command line, without the GUI.
+
+    python cli.py list
+    python cli.py state "Smart Plug - living room"
+    python cli.py toggle "Smart Plug - living room"
+    python cli.py set "Smart Light Bulb - bedroom" power=on dimmer=40 ct=400
+    python cli.py scene evening
+    python cli.py effect loop lights --period 20 --spread 45
+    python cli.py effect fade all --color "#ff8800" --duration 5
+    python cli.py discover 192.168.15.0/24 --write
+    python cli.py schedules
+    python cli.py energy "Smart Plug - computer" --hours 24 --bucket 3600
+    python cli.py serve --port 8321
+    python cli.py serve --shards 4
+
+tkinter and requests are never imported: a command returns in a few tens of
+milliseconds, plus the round-trip to the device. Tasmota commands are sent over
+HTTP, even for devices with an MQTT topic. Exit status is 1 on failure.
+
+``serve`` runs the HTTP/JSON API of api.py until interrupted, with keep-alive
+connections to the devices and MQTT when configured, and the schedules of
+scheduler.py and the energy telemetry of telemetry.py unless the GUI already
+runs them. With ``--shards``, the devices are spread over worker processes
+(sharding.py), for fleets too large for one core.
+"""
+
+
+BASE_PATH = Path(__file__).parent
+IOT_JSON_FILE = "iot_devices.json"
+# keys accepted by "set", same as the actions of a scene
+SETTINGS_KEYS = ("power", "dimmer", "ct", "color")
+
+
+def parse_settings(pairs: list) -> dict:
+    """["power=on", "dimmer=40"] -> {"power": "on", "dimmer": 40}"""
+    settings = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        key = key.strip().lower()
+        if not sep or key not in SETTINGS_KEYS:
+            raise ValueError(f"Expected one of {', '.join(SETTINGS_KEYS)}=value")
+        settings[key] = int(value) if value.strip().isdigit() else value.strip()
+    return settings
+
+
+def cmd_list(controller: Controller, args) -> int:
+    for device in controller.config.devices:
+        print(f"{device.type:22} {device.ip:21} {device.name}")
+    return 0
+
+
+def cmd_state(controller: Controller, args) -> int:
+    state = controller.get_state(controller.find(args.name))
+    print(json.dumps(state))
+    return 0
+
+
+def cmd_toggle(controller: Controller, args) -> int:
+    reply = controller.toggle(controller.find(args.name))
+    if reply.get("POWER") is not None:
+        print(reply["POWER"])
+    return 0
+
+
+def cmd_set(controller: Controller, args) -> int:
+    controller.set(controller.find(args.name), parse_settings(args.settings))
+    return 0
+
+
+def cmd_scene(controller: Controller, args) -> int:
+    if args.name not in controller.config.scenes:
+        raise DeviceNotFoundError(f"Unknown scene: {args.name}")
+    results = controller.scene(args.name)
+    failed = 0
+    for device_name, error in results.items():
+        print(f"{device_name}: {'ok' if error is None else error}")
+        failed += error is not None
+    return 1 if failed else 0
+
+
+def cmd_effect(controller: Controller, args) -> int:
+    from effects import ColorLoop, EffectRunner, Fade
+
+    config = controller.config
+    if args.target == GROUP_ALL or args.target in config.groups:
+        # the lights of the group, plugs and switches have no color
+        devices = [
+            device
+            for device in group_devices(config, args.target)
+            if controller.frame_interval(device) is not None
+        ]
+    else:
+        devices = [controller.find(args.target)]
+    if args.kind == "fade":
+        if args.color is None:
+            raise ValueError("fade needs --color")
+        for device in devices:
+            # fade from the current colors
+            try:
+                controller.cache.set(device.ip, controller.get_state(device))
+            except Exception:
+                pass
+        effect = Fade(devices, args.color, args.duration or 0, easing=args.easing)
+    else:
+        effect = ColorLoop(
+            devices, period=args.period, spread=args.spread, duration=args.duration
+        )
+    runner = EffectRunner(controller, fps=args.fps)
+    try:
+        runner.play(effect)
+        runner.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()
+    return 0
+
+
+def cmd_discover(controller: Controller, args) -> int:
+    from discovery import discover, parse_ports, update_config
+
+    try:
+        ports = parse_ports(args.ports)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    found = discover(args.subnet, tasmota_ports=ports)
+    for device in found:
+        print(f"{device['type']:22} {device['ip']:21} {device['name']}")
+    if args.write:
+        changed = update_config(args.config, found)
+        print(f"{len(changed)} device(s) added or updated")
+    return 0
+
+
+def cmd_schedules(controller: Controller, args) -> int:
+    from scheduler import planned, state_path
+
+    for schedule in planned(controller.config, state_path(args.config)):
+        data = schedule.as_dict()
+        trigger = data.get("at") or f"every {data['every']:g}s"
+        print(f"{data['next'] or '-':19}  {trigger:16}  {schedule.name}")
+    return 0
+
+
+def cmd_energy(controller: Controller, args) -> int:
+    from telemetry import store_from_config
+
+    store = store_from_config(controller.config, args.config)
+    if store is None:
+        print(f'No "telemetry" section in {args.config.name}', file=sys.stderr)
+        return 1
+    device = controller.find(args.name)
+    end = time.time()
+    data = store.query(device.name, end - args.hours * 3600, end, args.bucket)
+    if not data["points"]:
+        print(f"No samples of {device.name}", file=sys.stderr)
+        return 1
+    print(f"{'time':19}  {'avg W':>9}  {'min W':>9}  {'max W':>9}  {'kWh':>10}")
+    for point in data["points"]:
+        moment = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(point["t"]))
+        print(
+            f"{moment:19}  {point['avg']:9.1f}  {point['min']:9.1f}  "
+            f"{point['max']:9.1f}  {point['energy']:10.3f}"
+        )
+    print(f"{data['kwh']:.3f} kWh used, {data['bucket']}s per line")
+    return 0
+
+
+def cmd_serve(controller: Controller, args) -> int:
+    from api import API_HOST, API_PORT, ApiServer
+    from mqtt import transport_from_config
+    from scheduler import Scheduler, state_path
+    from telemetry import TelemetryCollector, store_from_config
+
+    options = controller.config.api or {}
+    if args.shards:
+        from sharding import ShardedController
+
+        # the workers own the connections, MQTT included
+        controller = ShardedController(
+            controller.config, args.shards, log_level=args.log_level
+        )
+    else:
+        controller.mqtt = transport_from_config(controller.cache, controller.config)
+        for device in controller.config.devices:
+            controller.connect(device)
+    scheduler = Scheduler(controller, state_path(args.config))
+    collectors = []
+
+    def _telemetry_start():
+        # the interval follows the config, the retention is read once
+        store = store_from_config(controller.config, args.config)
+        if store is not None and not collectors:
+            collectors.append(TelemetryCollector(controller, store))
+            collectors[0].start()
+        return store
+
+    def _reload(config) -> None:
+        controller.reload(config)
+        scheduler.reload(config)
+        if not collectors:
+            server.telemetry = _telemetry_start()
+
+    watcher = ConfigWatcher(
+        args.config,
+        on_change=_reload,
+        on_error=lambda e: print(e, file=sys.stderr),
+    )
+    server = ApiServer(
+        controller,
+        host=args.host or options.get("host", API_HOST),
+        port=args.port or int(options.get("port", API_PORT)),
+        scheduler=scheduler,
+        telemetry=_telemetry_start(),
+    )
+    watcher.start()
+    scheduler.start()
+    print(f"Serving on http://{server.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        scheduler.stop()
+        for collector in collectors:
+            collector.stop()
+        if args.shards:
+            controller.close()
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Control IoT devices")
+    parser.add_argument(
+        "--config",
+        type=Path,
+        default=Path(BASE_PATH, IOT_JSON_FILE),
+        help="path of iot_devices.json",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="log messages on stderr from this level on",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sub = commands.add_parser("list", help="list the devices")
+    sub.set_defaults(func=cmd_list)
+
+    sub = commands.add_parser("state", help="print the state of a device as json")
+    sub.add_argument("name", help="device name")
+    sub.set_defaults(func=cmd_state)
+
+    sub = commands.add_parser("toggle", help="toggle the power of a device")
+    sub.add_argument("name", help="device name")
+    sub.set_defaults(func=cmd_toggle)
+
+    sub = commands.add_parser("set", help="apply settings to a device")
+    sub.add_argument("name", help="device name")
+    sub.add_argument(
+        "settings",
+        nargs="+",
+        help="power=on|off|toggle dimmer=0..100 ct=153..500 color=#rrggbb",
+    )
+    sub.set_defaults(func=cmd_set)
+
+    sub = commands.add_parser("scene", help="apply a scene")
+    sub.add_argument("name", help="scene name")
+    sub.set_defaults(func=cmd_scene)
+
+    sub = commands.add_parser("effect", help="play a light effect")
+    sub.add_argument("kind", choices=("fade", "loop"))
+    sub.add_argument("target", help="device or group name, all for every light")
+    sub.add_argument("--color", help="fade to this color, eg: #ff8800")
+    sub.add_argument(
+        "--duration", type=float, help="seconds, a loop runs until interrupted"
+    )
+    sub.add_argument("--easing", default="ease-in-out", help="curve of a fade")
+    sub.add_argument("--period", type=float, default=30.0, help="seconds per turn")
+    sub.add_argument(
+        "--spread", type=float, default=0.0, help="degrees between two lights"
+    )
+    sub.add_argument("--fps", type=float, default=20.0, help="frames per second")
+    sub.set_defaults(func=cmd_effect)
+
+    sub = commands.add_parser("discover", help="find Tasmota and Yeelight devices")
+    sub.add_argument(
+        "subnet", nargs="?", help="subnet to sweep for tasmota, eg: 192.168.15.0/24"
+    )
+    sub.add_argument(
+        "--ports", default="80", help="tasmota ports, eg: 80,8080 or 8000-8099"
+    )
+    sub.add_argument("--write", action="store_true", help="update iot_devices.json")
+    sub.set_defaults(func=cmd_discover)
+
+    sub = commands.add_parser("schedules", help="list the schedules and next runs")
+    sub.set_defaults(func=cmd_schedules)
+
+    sub = commands.add_parser("energy", help="power and energy use of a plug")
+    sub.add_argument("name", help="device name")
+    sub.add_argument("--hours", type=float, default=24.0, help="hours back from now")
+    sub.add_argument("--bucket", type=int, help="seconds per line")
+    sub.set_defaults(func=cmd_energy)
+
+    sub = commands.add_parser("serve", help="run the HTTP/JSON API")
+    sub.add_argument("--host", help="address to listen on")
+    sub.add_argument("--port", type=int, help="port to listen on")
+    sub.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="worker processes sharing the devices, 0 to run them all here",
+    )
+    # long-running, keep-alive connections pay off
+    sub.set_defaults(func=cmd_serve, pooled=True)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    http = None if getattr(args, "pooled", False) else TasmotaHttpClient()
+    try:
+        config = load_config(args.config)
+    except (ConfigError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    controller = Controller(config, http=http)
+    try:
+        return args.func(controller, args)
+    except Exception as e:
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return 1
+    finally:
+        controller.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
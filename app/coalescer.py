@@ -0,0 +1,188 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
+
+"""
+Latest-value-wins scheduling of device commands.
+
+A ``ttk.Scale`` calls its command for every intermediate value while it is
+dragged. Sending all of them floods the device (Yeelight rate-limits and drops
+the connection). Commands are grouped by a key, usually (device, property):
+
+    * at most one command per key is in flight
+    * a command submitted while another one is in flight replaces any command
+      already waiting for that key, intermediate values are dropped
+    * two commands of the same key are at least ``min_interval`` seconds apart
+    * the last value of a key is always sent, and retried on failure when no
+      newer value replaced it
+
+"""
+
+
+# seconds between two commands of the same key
+DEFAULT_MIN_INTERVAL = 0.2
+# extra attempts for a value that was not replaced by a newer one
+DEFAULT_FINAL_RETRIES = 1
+
+
+class _Job:
+    __slots__ = ("func", "args", "on_done", "on_error", "min_interval", "superseded")
+
+    def __init__(self, func, args, on_done, on_error, min_interval) -> None:
+        self.func = func
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.min_interval = min_interval
+        self.superseded = False
+
+
+class _KeyState:
+    __slots__ = ("pending", "in_flight", "last_sent", "timer")
+
+    def __init__(self) -> None:
+        self.pending = None
+        self.in_flight = False
+        self.last_sent = 0.0
+        self.timer = None
+
+
+class CommandCoalescer:
+    def __init__(
+        self,
+        engine,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        final_retries: int = DEFAULT_FINAL_RETRIES,
+    ) -> None:
+        self.engine = engine
+        self.min_interval = min_interval
+        self.final_retries = final_retries
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        key: Hashable,
+        func: Callable[..., Any],
+        *args,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        min_interval: Optional[float] = None,
+    ) -> None:
+        """
+        Schedule ``func(*args)`` for ``key``, replacing any command of the
+        same key that has not started yet.
+
+        Parameters
+        ----------
+        key : hashable
+            Commands sharing a key are coalesced, e.g. ("192.168.15.44", "Dimmer").
+
+        func : callable
+            Blocking function doing the device I/O.
+
+        on_done, on_error : callable, optional
+            Same as ``CommandEngine.submit``. Replaced commands never call them.
+
+        min_interval : float, optional
+            Overrides the default minimum interval for this command.
+
+        """
+        job = _Job(
+            func,
+            args,
+            on_done,
+            on_error,
+            self.min_interval if min_interval is None else min_interval,
+        )
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = _KeyState()
+            if state.pending is not None:
+                state.pending.superseded = True
+            state.pending = job
+            future = None
+            if not state.in_flight and state.timer is None:
+                future = self._dispatch(key, state)
+        self._watch(key, future)
+
+    def cancel(self) -> None:
+        """Drop every waiting command, in flight commands complete normally."""
+        with self._lock:
+            for state in self._keys.values():
+                if state.timer is not None:
+                    state.timer.cancel()
+                    state.timer = None
+                state.pending = None
+
+    def _dispatch(self, key: Hashable, state: _KeyState) -> Optional[Future]:
+        # called with self._lock held, the caller passes the future to _watch
+        # once the lock is released
+        job = state.pending
+        if job is None:
+            return None
+        wait = job.min_interval - (time.monotonic() - state.last_sent)
+        if wait > 0:
+            state.timer = threading.Timer(wait, self._fire, args=(key,))
+            state.timer.daemon = True
+            state.timer.start()
+            return None
+        state.pending = None
+        state.in_flight = True
+        state.last_sent = time.monotonic()
+
+        def _on_error(e: BaseException) -> None:
+            if not job.superseded:
+                job.on_error(e)
+
+        try:
+            future = self.engine.submit(
+                self._run,
+                key,
+                job,
+                on_done=job.on_done,
+                on_error=None if job.on_error is None else _on_error,
+            )
+        except RuntimeError:
+            # engine shut down
+            state.in_flight = False
+            return None
+        return future
+
+    def _watch(self, key: Hashable, future: Optional[Future]) -> None:
+        # a finished future runs the callback at once, in this thread: never
+        # called with self._lock held
+        if future is not None:
+            future.add_done_callback(lambda f: self._release(key))
+
+    def _fire(self, key: Hashable) -> None:
+        future = None
+        with self._lock:
+            state = self._keys[key]
+            state.timer = None
+            if not state.in_flight:
+                future = self._dispatch(key, state)
+        self._watch(key, future)
+
+    def _release(self, key: Hashable) -> None:
+        future = None
+        with self._lock:
+            state = self._keys[key]
+            state.in_flight = False
+            if state.timer is None:
+                future = self._dispatch(key, state)
+        self._watch(key, future)
+
+    def _run(self, key: Hashable, job: _Job) -> Any:
+        attempts = 0
+        while True:
+            try:
+                return job.func(*job.args)
+            except Exception:
+                with self._lock:
+                    job.superseded = self._keys[key].pending is not None
+                if job.superseded or attempts >= self.final_retries:
+                    raise
+                attempts += 1
@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+"""
+iot_devices.json loading.
+
+    {
+        "iot": {
+            "devices": [
+                {"type": "tasmota-plug", "name": "Plug", "ip": "192.168.15.41", "confirm": false},
+                ...
+            ],
+            "groups": {
+                "bedroom": ["Plug", "Bulb"]
+            },
+            "scenes": {
+                "all off": [{"group": "all", "power": "off"}],
+                "evening": [
+                    {"group": "bedroom", "power": "on"},
+                    {"device": "Bulb", "dimmer": 40, "ct": 400}
+                ]
+            }
+        }
+    }
+
+The group "all" always exists and holds every device.
+
+The file is validated by config_schema.py, then compiled into ``Config`` and
+one ``Device`` record per device, indexed by name and address. The validated
+section is kept in a cache file next to the config, keyed by the size and
+modification time of iot_devices.json, so only the first start after an edit
+pays for pydantic.
+
+``ConfigWatcher`` reloads the file when it changes, ``diff_devices`` tells which
+devices were added, removed or got a new connection (type, address, port or
+topic); the others keep their connections and cached state.
+"""
+
+
+GROUP_ALL = "all"
+# bumped when the compiled form changes, older caches are ignored
+CONFIG_CACHE_VERSION = 4
+# seconds between two checks of the config file
+WATCH_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Device:
+    __slots__ = ("type", "name", "ip", "confirm", "port", "id", "topic")
+
+    def __init__(
+        self,
+        type: str,
+        name: str,
+        ip: str,
+        confirm: bool = False,
+        port: Optional[int] = None,
+        id: Optional[str] = None,
+        topic: Optional[str] = None,
+    ) -> None:
+        self.type = type
+        self.name = name
+        self.ip = ip
+        self.confirm = confirm
+        self.port = port
+        self.id = id
+        self.topic = topic
+
+    @property
+    def connection(self) -> tuple:
+        """Settings a change of which requires a new connection."""
+        return (self.type, self.ip, self.port, self.topic)
+
+    def as_dict(self) -> dict:
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if getattr(self, name) is not None
+        }
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Device):
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.connection))
+
+    def __repr__(self) -> str:
+        return f"Device({self.name!r}, {self.type!r}, {self.ip!r})"
+
+
+class Config:
+    __slots__ = (
+        "devices",
+        "groups",
+        "scenes",
+        "mqtt",
+        "http",
+        "api",
+        "schedules",
+        "location",
+        "telemetry",
+        "_by_name",
+        "_by_ip",
+    )
+
+    def __init__(
+        self,
+        devices: tuple,
+        groups: dict,
+        scenes: dict,
+        mqtt: Optional[dict] = None,
+        http: Optional[dict] = None,
+        api: Optional[dict] = None,
+        schedules: tuple = (),
+        location: Optional[dict] = None,
+        telemetry: Optional[dict] = None,
+    ) -> None:
+        self.devices = devices
+        self.groups = groups
+        self.scenes = scenes
+        self.mqtt = mqtt
+        self.http = http
+        self.api = api
+        # definitions, see scheduler.py
+        self.schedules = schedules
+        # {"latitude": ..., "longitude": ...} of sunrise and sunset schedules
+        self.location = location
+        # energy sampling of the plugs, see telemetry.py
+        self.telemetry = telemetry
+        self._by_name = {device.name: device for device in devices}
+        self._by_ip = {device.ip: device for device in devices}
+
+    def device(self, name: str) -> Optional[Device]:
+        return self._by_name.get(name)
+
+    def device_at(self, ip: str) -> Optional[Device]:
+        return self._by_ip.get(ip)
+
+
+def compile_config(section: dict) -> Config:
+    """Build the records of a validated "iot" section."""
+    return Config(
+        devices=tuple(Device(**device) for device in section["devices"]),
+        groups=section.get("groups", {}),
+        scenes=section.get("scenes", {}),
+        mqtt=section.get("mqtt"),
+        http=section.get("http"),
+        api=section.get("api"),
+        schedules=tuple(section.get("schedules", ())),
+        location=section.get("location"),
+        telemetry=section.get("telemetry"),
+    )
+
+
+def load_config(path: Path) -> Config:
+    """
+    Read, validate and compile iot_devices.json.
+
+    Raises
+    ----------
+    ConfigError
+        The file is not valid json, or does not match config_schema.py.
+
+    """
+    path = Path(path)
+    stat = path.stat()
+    key = [CONFIG_CACHE_VERSION, stat.st_size, stat.st_mtime_ns]
+    cache = _cache_path(path)
+    try:
+        with cache.open("r") as filehandle:
+            cached = json.load(filehandle)
+        if cached["key"] == key:
+            return compile_config(cached["iot"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from config_schema import validate_config
+
+    try:
+        with path.open("r") as filehandle:
+            section = validate_config(json.load(filehandle)["iot"])
+    except ValueError as e:
+        # json.JSONDecodeError and pydantic.ValidationError
+        raise ConfigError(f"{path.name}: {e}")
+    except (KeyError, TypeError):
+        raise ConfigError(f'{path.name}: missing "iot" section')
+    try:
+        tmp = Path(f"{cache}.tmp")
+        with tmp.open("w") as filehandle:
+            json.dump({"key": key, "iot": section}, filehandle)
+        os.replace(tmp, cache)
+    except OSError:
+        # read-only install, validate on every start
+        pass
+    return compile_config(section)
+
+
+def _cache_path(path: Path) -> Path:
+    return Path(path.parent, f".{path.name}.cache")
+
+
+def group_devices(config: Config, group: str) -> list:
+    if group == GROUP_ALL:
+        return list(config.devices)
+    members = set(config.groups[group])
+    return [device for device in config.devices if device.name in members]
+
+
+class ConfigDiff:
+    __slots__ = ("added", "removed", "changed")
+
+    def __init__(self, added: list, removed: list, changed: list) -> None:
+        self.added = added
+        self.removed = removed
+        # (old, new) records of the devices that need a new connection
+        self.changed = changed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def diff_devices(old: Config, new: Config) -> ConfigDiff:
+    """Compare the devices of two configs by name."""
+    added, changed = [], []
+    for device in new.devices:
+        previous = old.device(device.name)
+        if previous is None:
+            added.append(device)
+        elif previous.connection != device.connection:
+            changed.append((previous, device))
+    removed = [device for device in old.devices if new.device(device.name) is None]
+    return ConfigDiff(added, removed, changed)
+
+
+class ConfigWatcher:
+    def __init__(
+        self,
+        path: Path,
+        on_change: Callable[[Config], None],
+        on_error: Optional[Callable[[ConfigError], None]] = None,
+        interval: float = WATCH_INTERVAL,
+    ) -> None:
+        """
+        Reload iot_devices.json in a background thread when it changes.
+
+        Parameters
+        ----------
+        on_change : callable
+            Called with the new ``Config``, in the watcher thread.
+
+        on_error : callable, optional
+            Called with the ``ConfigError`` of an invalid edit, the previous
+            config stays in use.
+
+        """
+        self.path = Path(path)
+        self.on_change = on_change
+        self.on_error = on_error
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._signature = self._stat()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="iot-config", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                config = load_config(self.path)
+            except (ConfigError, OSError) as e:
+                logger.warning("%s not reloaded: %s", self.path.name, e)
+                if self.on_error is not None:
+                    self.on_error(ConfigError(str(e)))
+                continue
+            logger.info("%s reloaded", self.path.name)
+            self.on_change(config)
@@ -0,0 +1,262 @@
+import ipaddress
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Extra, Field, root_validator, validator
+
+from config import GROUP_ALL
+from drivers import has_driver
+
+"""
+Validation of iot_devices.json.
+
+Only imported by config.py when iot_devices.json changed since its last
+validation, reading a config that was already validated does not pay for
+pydantic.
+"""
+
+
+POWER_VALUES = ("on", "off", "toggle")
+COLOR_PATTERN = re.compile(r"^#?[0-9a-fA-F]{6}$")
+HOSTNAME_PATTERN = re.compile(r"^[A-Za-z0-9]([A-Za-z0-9.-]*[A-Za-z0-9])?$")
+TIME_PATTERN = re.compile(r"^([01]?[0-9]|2[0-3]):[0-5][0-9]$")
+SUN_EVENTS = ("sunrise", "sunset")
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+CATCH_UP_POLICIES = ("skip", "once", "all")
+
+
+class DeviceModel(BaseModel, extra=Extra.forbid):
+    type: str
+    name: str = Field(..., min_length=1)
+    ip: str
+    confirm: bool = False
+    port: Optional[int] = Field(None, ge=1, le=65535)
+    id: Optional[str] = None
+    topic: Optional[str] = None
+
+    @validator("type")
+    def check_type(cls, value: str) -> str:
+        if not has_driver(value):
+            raise ValueError(f"no driver for device type '{value}'")
+        return value
+
+    @validator("ip")
+    def check_ip(cls, value: str) -> str:
+        host, sep, port = value.partition(":")
+        if sep and not (port.isdigit() and 0 < int(port) < 65536):
+            raise ValueError(f"invalid port in '{value}'")
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            if not HOSTNAME_PATTERN.match(host):
+                raise ValueError(f"invalid address '{value}'")
+        return value
+
+
+class ActionModel(BaseModel, extra=Extra.forbid):
+    device: Optional[str] = None
+    group: Optional[str] = None
+    power: Optional[str] = None
+    dimmer: Optional[int] = Field(None, ge=0, le=100)
+    ct: Optional[int] = Field(None, ge=153, le=500)
+    color: Optional[str] = None
+
+    @validator("power")
+    def check_power(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None and value.lower() not in POWER_VALUES:
+            raise ValueError(f"must be one of {', '.join(POWER_VALUES)}")
+        return None if value is None else value.lower()
+
+    @validator("color")
+    def check_color(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None and not COLOR_PATTERN.match(value):
+            raise ValueError("must be a rgb hex color, eg: #ff8800")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def check_target(cls, values: dict) -> dict:
+        if (values.get("device") is None) == (values.get("group") is None):
+            raise ValueError("an action needs either a device or a group")
+        return values
+
+
+class LocationModel(BaseModel, extra=Extra.forbid):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+
+class ScheduleModel(BaseModel, extra=Extra.forbid):
+    name: str = Field(..., min_length=1)
+    at: Optional[str] = None
+    every: Optional[float] = Field(None, gt=0)
+    days: List[str] = []
+    offset: float = 0
+    jitter: float = Field(0, ge=0)
+    scene: Optional[str] = None
+    actions: List[ActionModel] = []
+    catch_up: str = "skip"
+    grace: float = Field(3600, gt=0)
+
+    @validator("at")
+    def check_at(cls, value: Optional[str]) -> Optional[str]:
+        if value is None or value in SUN_EVENTS or TIME_PATTERN.match(value):
+            return value
+        try:
+            datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError("must be HH:MM, sunrise, sunset or an ISO date and time")
+        return value
+
+    @validator("days", each_item=True)
+    def check_day(cls, value: str) -> str:
+        if value.lower() not in WEEKDAYS:
+            raise ValueError(f"must be one of {', '.join(WEEKDAYS)}")
+        return value.lower()
+
+    @validator("catch_up")
+    def check_catch_up(cls, value: str) -> str:
+        if value not in CATCH_UP_POLICIES:
+            raise ValueError(f"must be one of {', '.join(CATCH_UP_POLICIES)}")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def check_trigger(cls, values: dict) -> dict:
+        if (values.get("at") is None) == (values.get("every") is None):
+            raise ValueError("a schedule needs either at or every")
+        if (values.get("scene") is None) == (not values.get("actions")):
+            raise ValueError("a schedule needs either a scene or actions")
+        return values
+
+
+class MqttModel(BaseModel, extra=Extra.forbid):
+    # unset values take the defaults of mqtt.py
+    host: str = Field(..., min_length=1)
+    port: Optional[int] = Field(None, ge=1, le=65535)
+    username: Optional[str] = None
+    password: Optional[str] = None
+    client_id: Optional[str] = None
+
+
+class HttpModel(BaseModel, extra=Extra.forbid):
+    # unset values take the defaults of http_pool.py
+    pool_size: Optional[int] = Field(None, ge=1)
+    retries: Optional[int] = Field(None, ge=0)
+    backoff_factor: Optional[float] = Field(None, ge=0)
+    idle_timeout: Optional[float] = Field(None, gt=0)
+
+
+class ApiModel(BaseModel, extra=Extra.forbid):
+    # unset values take the defaults of api.py
+    host: Optional[str] = Field(None, min_length=1)
+    port: Optional[int] = Field(None, ge=1, le=65535)
+
+
+class TelemetryModel(BaseModel, extra=Extra.forbid):
+    interval: int = Field(10, ge=1, le=3600)
+    path: str = Field(".telemetry", min_length=1)
+    raw_days: float = Field(2, gt=0)
+    five_minute_days: float = Field(90, gt=0)
+    hourly_days: float = Field(1095, gt=0)
+
+
+class ConfigModel(BaseModel, extra=Extra.allow):
+    devices: List[DeviceModel]
+    groups: Dict[str, List[str]] = {}
+    scenes: Dict[str, List[ActionModel]] = {}
+    schedules: List[ScheduleModel] = []
+    location: Optional[LocationModel] = None
+    telemetry: Optional[TelemetryModel] = None
+    mqtt: Optional[MqttModel] = None
+    http: Optional[HttpModel] = None
+    api: Optional[ApiModel] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_references(cls, values: dict) -> dict:
+        names = set()
+        for device in values["devices"]:
+            if device.name in names:
+                raise ValueError(f"Duplicate device name: {device.name}")
+            names.add(device.name)
+        for group, members in values["groups"].items():
+            for name in members:
+                if name not in names:
+                    raise ValueError(f"Group '{group}': unknown device '{name}'")
+        for scene, actions in values["scenes"].items():
+            check_actions(f"Scene '{scene}'", actions, names, values["groups"])
+        schedules = set()
+        for schedule in values["schedules"]:
+            if schedule.name in schedules:
+                raise ValueError(f"Duplicate schedule name: {schedule.name}")
+            schedules.add(schedule.name)
+            check_schedule(
+                schedule,
+                names,
+                values["groups"],
+                values["scenes"],
+                values.get("location") is not None,
+            )
+        return values
+
+
+def check_actions(where: str, actions: list, names: set, groups: dict) -> None:
+    for action in actions:
+        if action.device is not None and action.device not in names:
+            raise ValueError(f"{where}: unknown device '{action.device}'")
+        if action.group is not None and action.group != GROUP_ALL:
+            if action.group not in groups:
+                raise ValueError(f"{where}: unknown group '{action.group}'")
+
+
+def check_schedule(
+    schedule: ScheduleModel,
+    names: set,
+    groups: dict,
+    scenes: dict,
+    has_location: bool,
+) -> None:
+    where = f"Schedule '{schedule.name}'"
+    if schedule.scene is not None and schedule.scene not in scenes:
+        raise ValueError(f"{where}: unknown scene '{schedule.scene}'")
+    check_actions(where, schedule.actions, names, groups)
+    if schedule.at in SUN_EVENTS and not has_location:
+        raise ValueError(f"{where}: {schedule.at} needs a location")
+
+
+def validate_config(data: dict) -> dict:
+    """
+    Validate the "iot" section of iot_devices.json.
+
+    Returns
+    ----------
+    dict
+        The section with defaults applied and unset keys removed, ready for
+        ``config.compile_config``.
+
+    Raises
+    ----------
+    pydantic.ValidationError
+        Listing every invalid field with its location.
+
+    """
+    return ConfigModel.parse_obj(data).dict(exclude_none=True)
+
+
+def validate_schedule(data: dict, config) -> dict:
+    """
+    Validate a schedule added at runtime against the compiled ``config``.
+
+    Raises
+    ----------
+    pydantic.ValidationError or ValueError
+
+    """
+    schedule = ScheduleModel.parse_obj(data)
+    check_schedule(
+        schedule,
+        {device.name for device in config.devices},
+        config.groups,
+        config.scenes,
+        config.location is not None,
+    )
+    return schedule.dict(exclude_none=True)
@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config import Config, ConfigDiff, Device, diff_devices
+from drivers import Driver, load_driver
+from health import DeviceUnavailableError, HealthTracker
+from metrics import OPERATION_SECONDS, OPERATIONS_TOTAL, metrics
+from scenes import action_settings, scene_settings
+from state import StateCache
+
+"""
+Device operations, without any GUI.
+
+``Controller`` is the single entry point to the devices of iot_devices.json,
+shared by the windows of main.py and the command line of cli.py. It owns the
+shared connections (Tasmota HTTP client, optional MQTT), the state cache, and
+one driver per device type (see drivers.py). All methods are blocking: the GUI
+runs them on the command engine, the command line calls them directly.
+
+Drivers and their connections are only created when a device needs them, so a
+single command line call does not pay for requests, yeelight or tkinter.
+
+Device operations go through the circuit breaker of health.py: once a device
+is known to be down they fail at once with ``DeviceUnavailableError``, and
+scenes skip it, until a background probe reaches it again.
+
+    controller = Controller(load_config(path))
+    controller.toggle(controller.find("Smart Plug - computer"))
+
+"""
+
+
+# devices updated at the same time by a scene
+SCENE_MAX_WORKERS = 32
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceNotFoundError(Exception):
+    pass
+
+
+class Controller:
+    def __init__(
+        self,
+        config: Config,
+        http=None,
+        mqtt=None,
+        cache: Optional[StateCache] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        config : Config
+            The "iot" section of iot_devices.json, see config.load_config.
+
+        http : TasmotaSessionPool or TasmotaHttpClient, optional
+            Client of the Tasmota web requests. Defaults to the keep-alive
+            pool configured by the "http" section of the config.
+
+        mqtt : MqttTransport, optional
+            Commands of devices reachable through the broker use it.
+
+        cache : StateCache, optional
+            Receives every state read or reply from the devices.
+
+        """
+        self.config = config
+        self.cache = cache if cache is not None else StateCache()
+        self.mqtt = mqtt
+        self._http = http
+        self._drivers = {}
+        self._lock = threading.Lock()
+        self.health = HealthTracker(probe=self._probe)
+
+    @property
+    def http(self):
+        with self._lock:
+            if self._http is None:
+                from http_pool import pool_from_config
+
+                self._http = pool_from_config(self.config.http)
+            return self._http
+
+    def find(self, name: str) -> Device:
+        """Return a device by name, exact match first, then case insensitive."""
+        device = self.config.device(name)
+        if device is not None:
+            return device
+        matches = [
+            device
+            for device in self.config.devices
+            if device.name.lower() == name.lower()
+        ]
+        if len(matches) != 1:
+            raise DeviceNotFoundError(f"Unknown device: {name}")
+        return matches[0]
+
+    def device(self, ip: str) -> Device:
+        device = self.config.device_at(ip)
+        if device is None:
+            raise DeviceNotFoundError(f"Unknown device: {ip}")
+        return device
+
+    def driver(self, device: Device) -> Driver:
+        """Return the driver of a device, loading it on first use."""
+        with self._lock:
+            driver = self._drivers.get(device.type)
+            if driver is None:
+                driver = load_driver(device.type)(self)
+                self._drivers[device.type] = driver
+            return driver
+
+    def connect(self, device: Device) -> None:
+        self.driver(device).connect(device)
+
+    def disconnect(self, device: Device) -> None:
+        self.driver(device).disconnect(device)
+        self.cache.invalidate(device.ip)
+        self.health.forget(device)
+
+    def reload(self, config: Config, connect: bool = True) -> ConfigDiff:
+        """
+        Switch to a new config, only the devices that were added, removed or
+        got new connection settings are disconnected and (re)connected. The
+        others keep their connections and cached state.
+        """
+        diff = diff_devices(self.config, config)
+        for device in diff.removed + [old for old, _ in diff.changed]:
+            self.disconnect(device)
+        self.config = config
+        if connect:
+            for device in diff.added + [new for _, new in diff.changed]:
+                self.connect(device)
+        return diff
+
+    def is_pushing(self, device: Device) -> bool:
+        return self.driver(device).is_pushing(device)
+
+    def is_available(self, device: Device) -> bool:
+        """False while the circuit breaker of the device is open."""
+        return self.health.is_available(device)
+
+    def get_state(self, device: Device) -> dict:
+        return self._call(device, "get_state")
+
+    def toggle(self, device: Device) -> dict:
+        """Toggle the power of a device, returns the reply of the device."""
+        return self._call(device, "toggle")
+
+    def set(self, device: Device, settings: dict) -> dict:
+        """
+        Apply settings to a device.
+
+        Parameters
+        ----------
+        settings : dict
+            Same keys as a scene action: power ("on", "off", "toggle"),
+            dimmer (0..100), ct (153..500 mireds), color ("#rrggbb").
+
+        """
+        return self._call(device, "set", settings)
+
+    def batch(self, device: Device, settings: list) -> dict:
+        """Apply several settings in order, in one request when possible."""
+        return self._call(device, "batch", settings)
+
+    def command(self, device: Device, cmnd, *args):
+        """
+        Raw command of the device protocol, e.g. "Dimmer 10" for Tasmota, see
+        the ``command`` method of the driver for ``cmnd`` and ``args``.
+        Guarded by the circuit breaker like the other operations.
+
+        """
+        return self._call(device, "command", cmnd, *args)
+
+    def frame_interval(self, device: Device) -> Optional[float]:
+        """Seconds between two effect frames, None when the device has no color."""
+        return self.driver(device).frame_interval
+
+    def frame(
+        self, device: Device, hue: int, sat: int, bri: int, first: bool = False
+    ) -> None:
+        """Show one frame of a light effect, see effects.py."""
+        self._call(device, "frame", hue, sat, bri, first)
+
+    def energy(self, device: Device) -> Optional[dict]:
+        """Power and energy counter, None without an energy monitor, see telemetry.py."""
+        return self._call(device, "energy")
+
+    def expected_state(self, device: Device, settings: dict, state: dict) -> dict:
+        """Partial state ``set(device, settings)`` should lead to, see optimistic.py."""
+        return self.driver(device).expected_state(device, settings, state or {})
+
+    def _call(self, device: Device, operation: str, *args):
+        driver = self.driver(device)
+        start = time.perf_counter()
+        result = "error"
+        try:
+            reply = self.health.call(
+                device,
+                getattr(driver, operation),
+                *args,
+                is_unreachable=driver.is_unreachable,
+            )
+            result = "ok"
+            return reply
+        except DeviceUnavailableError:
+            result = "unavailable"
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            if result != "unavailable":
+                metrics.observe(
+                    OPERATION_SECONDS, seconds, device=device.name, operation=operation
+                )
+            metrics.inc(
+                OPERATIONS_TOTAL, device=device.name, operation=operation, result=result
+            )
+            logger.debug(
+                "%s %s: %s in %.1f ms", device.name, operation, result, seconds * 1000
+            )
+
+    def _probe(self, device: Device) -> None:
+        # half-open probe of health.py, the state read is not wasted
+        self.cache.set(device.ip, self.driver(device).get_state(device))
+
+    def scene(self, name: str) -> dict:
+        """
+        Apply a scene to all its devices at once, blocking until all are done.
+
+        Returns
+        ----------
+        dict
+            {device name: None on success or the exception}, devices known
+            to be down are skipped with a ``DeviceUnavailableError``.
+
+        """
+        return self.apply(scene_settings(self.config, name))
+
+    def actions(self, actions: list) -> dict:
+        """Same as ``scene`` for a list of scene actions."""
+        return self.apply(action_settings(self.config, actions))
+
+    def apply(self, device_settings: list) -> dict:
+        """Apply [(device, settings), ...] concurrently, see ``scene``."""
+        results = {}
+        targets = []
+        for device, settings in device_settings:
+            if self.is_available(device):
+                targets.append((device, settings))
+            else:
+                results[device.name] = DeviceUnavailableError(
+                    f"{device.name} is unreachable"
+                )
+        if not targets:
+            return results
+        with ThreadPoolExecutor(
+            max_workers=min(SCENE_MAX_WORKERS, len(targets))
+        ) as executor:
+            futures = {
+                device.name: executor.submit(self.set, device, settings)
+                for device, settings in targets
+            }
+            for device_name, future in futures.items():
+                results[device_name] = future.exception()
+        return results
+
+    def close(self) -> None:
+        self.health.stop()
+        with self._lock:
+            drivers = list(self._drivers.values())
+            self._drivers.clear()
+        for driver in drivers:
+            driver.close()
+        if self.mqtt is not None:
+            self.mqtt.stop()
+        if self._http is not None:
+            self._http.close()
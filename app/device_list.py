@@ -0,0 +1,219 @@
+from typing import Callable, Iterable
+
+import ttkbootstrap as ttk
+
+"""
+Scrollable device list of the main window.
+
+Only the rows that fit in the window exist as widgets: scrolling or filtering
+assigns other devices to the same rows instead of creating new widgets, so
+the startup time and the memory of the window do not grow with the number of
+devices.
+
+The filter keeps the devices whose name, type or group contains every word
+typed, eg: "bedroom light". Devices known to be down are greyed out.
+"""
+
+
+# height in pixels of a device row
+ROW_HEIGHT = 44
+# rows scrolled by one mouse wheel step
+WHEEL_ROWS = 1
+
+
+class _Row:
+    __slots__ = ("frame", "toggle", "settings", "device", "style")
+
+    def __init__(self, frame, toggle, settings) -> None:
+        self.frame = frame
+        self.toggle = toggle
+        self.settings = settings
+        self.device = None
+        # bootstyle of the toggle button
+        self.style = "outline"
+
+
+class DeviceList(ttk.Frame):
+    def __init__(
+        self,
+        master,
+        on_toggle: Callable,
+        on_settings: Callable,
+        has_settings: Callable,
+        icon=None,
+        **kwargs,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        on_toggle, on_settings : callable
+            Called with the ``Device`` of the clicked toggle or cog button.
+
+        has_settings : callable
+            Tells if a ``Device`` has a settings window, ie: a cog button.
+
+        """
+        super().__init__(master, **kwargs)
+        self.on_toggle = on_toggle
+        self.on_settings = on_settings
+        self.has_settings = has_settings
+        self.icon = icon
+        self.devices = []
+        self.visible = []
+        self.offset = 0
+        self.rows = []
+        # ip: power of the devices with a known state
+        self.powers = {}
+        # ip of the devices known to be down, greyed out
+        self.offline = set()
+        self._search = []
+        self._settings = {}
+
+        self.filter_var = ttk.StringVar(master=self)
+        self.filter_var.trace_add("write", lambda *args: self.filter())
+        entry = ttk.Entry(self, textvariable=self.filter_var)
+        entry.grid(column=0, row=0, columnspan=2, sticky="ew", padx=5, pady=(0, 5))
+
+        self.body = ttk.Frame(self)
+        self.body.grid(column=0, row=1, sticky="nsew")
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.scrollbar.grid(column=1, row=1, sticky="ns")
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+        self.body.bind("<Configure>", lambda event: self.render())
+        self._bind_wheel(self.body)
+
+    def set_devices(self, devices: Iterable, groups: dict) -> None:
+        self.devices = list(devices)
+        member_of = {}
+        for group, names in groups.items():
+            for name in names:
+                member_of.setdefault(name, []).append(group)
+        self._search = [
+            " ".join(
+                [device.name, device.type, *member_of.get(device.name, ())]
+            ).lower()
+            for device in self.devices
+        ]
+        self._settings = {}
+        known = {device.ip for device in self.devices}
+        self.powers = {ip: on for ip, on in self.powers.items() if ip in known}
+        self.offline &= known
+        for row in self.rows:
+            row.device = None
+        self.filter()
+
+    def filter(self) -> None:
+        words = self.filter_var.get().lower().split()
+        self.visible = [
+            device
+            for device, text in zip(self.devices, self._search)
+            if all(word in text for word in words)
+        ]
+        self.offset = 0
+        self.render()
+
+    def set_power(self, ip: str, on: bool) -> None:
+        self.powers[ip] = on
+        self._restyle(ip)
+
+    def set_available(self, ip: str, available: bool) -> None:
+        if available:
+            self.offline.discard(ip)
+        else:
+            self.offline.add(ip)
+        self._restyle(ip)
+
+    def _restyle(self, ip: str) -> None:
+        for row in self.rows:
+            if row.device is not None and row.device.ip == ip:
+                self._style(row)
+
+    def yview(self, action: str, value, units: str = "units") -> None:
+        """Command of the scrollbar, "moveto" fraction or "scroll" n units."""
+        if action == "moveto":
+            offset = float(value) * len(self.visible) * ROW_HEIGHT
+        elif units == "pages":
+            offset = self.offset + int(value) * self.body.winfo_height()
+        else:
+            offset = self.offset + int(value) * ROW_HEIGHT
+        self.scroll_to(offset)
+
+    def scroll_to(self, offset: float) -> None:
+        height = self.body.winfo_height()
+        end = max(0, len(self.visible) * ROW_HEIGHT - height)
+        offset = int(min(max(offset, 0), end))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def render(self) -> None:
+        """Assign the devices in view to the rows, creating rows if needed."""
+        height = self.body.winfo_height()
+        total = len(self.visible) * ROW_HEIGHT
+        self.offset = max(0, min(self.offset, total - height))
+        first = self.offset // ROW_HEIGHT
+        count = min(len(self.visible) - first, height // ROW_HEIGHT + 2)
+        while len(self.rows) < count:
+            self.rows.append(self._new_row())
+        for index, row in enumerate(self.rows):
+            if index >= count:
+                row.frame.place_forget()
+                continue
+            device = self.visible[first + index]
+            if row.device is not device:
+                self._assign(row, device)
+            y = (first + index) * ROW_HEIGHT - self.offset
+            row.frame.place(x=0, y=y, relwidth=1, height=ROW_HEIGHT)
+        if total <= height:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / total, (self.offset + height) / total)
+
+    def _new_row(self) -> _Row:
+        frame = ttk.Frame(self.body)
+        frame.grid_columnconfigure(0, weight=1)
+        toggle = ttk.Button(frame, bootstyle="outline")  # type: ignore
+        toggle.grid(column=0, row=0, sticky="ew", padx=5, pady=4)
+        settings = ttk.Button(
+            frame, image=self.icon, bootstyle="link-light"  # type: ignore
+        )
+        row = _Row(frame, toggle, settings)
+        toggle.configure(command=lambda: self.on_toggle(row.device))
+        settings.configure(command=lambda: self.on_settings(row.device))
+        for widget in (frame, toggle, settings):
+            self._bind_wheel(widget)
+        return row
+
+    def _assign(self, row: _Row, device) -> None:
+        row.device = device
+        row.toggle.configure(text=f"{device.name} Toggle")
+        has_settings = self._settings.get(device.type)
+        if has_settings is None:
+            has_settings = self._settings[device.type] = self.has_settings(device)
+        if has_settings:
+            row.settings.grid(column=1, row=0, sticky="ew")
+        else:
+            row.settings.grid_remove()
+        self._style(row)
+
+    def _style(self, row: _Row) -> None:
+        ip = row.device.ip
+        if ip in self.offline:
+            style = "outline-secondary"
+        elif self.powers.get(ip):
+            style = "success"
+        else:
+            style = "outline"
+        if style != row.style:
+            row.style = style
+            row.toggle.configure(bootstyle=style)  # type: ignore
+
+    def _bind_wheel(self, widget) -> None:
+        widget.bind("<MouseWheel>", self._wheel)
+        # x11
+        widget.bind("<Button-4>", lambda event: self.yview("scroll", -WHEEL_ROWS))
+        widget.bind("<Button-5>", lambda event: self.yview("scroll", WHEEL_ROWS))
+
+    def _wheel(self, event) -> None:
+        self.yview("scroll", -WHEEL_ROWS if event.delta > 0 else WHEEL_ROWS)
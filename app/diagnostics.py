@@ -0,0 +1,141 @@
+from tkinter import TclError
+
+import ttkbootstrap as ttk
+
+from metrics import (
+    ENGINE_IN_FLIGHT,
+    ENGINE_QUEUED,
+    OPERATION_SECONDS,
+    OPERATIONS_TOTAL,
+    PHASE_SECONDS,
+    RESULTS_QUEUED,
+    metrics,
+)
+
+"""
+Diagnostics window.
+
+Live view of the metrics registry (metrics.py), refreshed every second:
+
+    operations  count, p50 and p95 per device and operation
+    phases      where the time of the commands goes: queue, connect, device,
+                dispatch to the Tk thread
+    engine      commands queued and running, results waiting for Tk
+
+Opened from the main window with F12.
+"""
+
+
+# milliseconds between two refreshes
+REFRESH_INTERVAL = 1000
+PHASES = ("queue", "connect", "device", "dispatch")
+
+
+class DiagnosticsWindow:
+    def __init__(self, primary) -> None:
+        self.primary = primary
+        self.primary.title("Diagnostics")
+        self.primary.geometry("520x420")
+        self.primary.minsize(400, 300)
+
+        self.frame = ttk.Frame(self.primary, padding=10)
+        self.frame.grid_columnconfigure(0, weight=1)
+        self.frame.grid_rowconfigure(0, weight=1)
+        self.frame.pack(fill="both", expand=1)
+
+        self.tree = ttk.Treeview(
+            self.frame,
+            columns=("count", "errors", "p50", "p95"),
+            show="tree headings",
+        )
+        self.tree.heading("#0", text="")
+        self.tree.column("#0", width=180)
+        for column, text in (
+            ("count", "Count"),
+            ("errors", "Errors"),
+            ("p50", "p50 ms"),
+            ("p95", "p95 ms"),
+        ):
+            self.tree.heading(column, text=text)
+            self.tree.column(column, width=70, anchor="e")
+        self.tree.grid(column=0, row=0, sticky="nsew")
+        self.node_operations = self.tree.insert("", "end", text="Operations", open=True)
+        self.node_phases = self.tree.insert("", "end", text="Phases", open=True)
+
+        self.engine_var = ttk.StringVar(master=self.primary)
+        l = ttk.Label(self.frame, textvariable=self.engine_var)
+        l.grid(column=0, row=1, sticky="ew", pady=5)
+
+        b = ttk.Button(self.frame, text="Reset", command=self.reset)
+        b.grid(column=0, row=2, sticky="w")
+
+        self.primary.bind("<Escape>", self.window_close)
+        self.refresh()
+
+    def refresh(self) -> None:
+        if not self.window_exists():
+            return
+        errors = {}
+        for key, count in metrics.counters(OPERATIONS_TOTAL).items():
+            labels = dict(key)
+            if labels["result"] != "ok":
+                name = (labels["device"], labels["operation"])
+                errors[name] = errors.get(name, 0) + count
+
+        rows = []
+        for key, histogram in sorted(metrics.histograms(OPERATION_SECONDS).items()):
+            name = (dict(key)["device"], dict(key)["operation"])
+            rows.append((" ".join(name), histogram, f"{errors.get(name, 0):g}"))
+        self._fill(self.node_operations, rows)
+
+        phases = metrics.histograms(PHASE_SECONDS)
+        rows = []
+        for phase in PHASES:
+            histogram = phases.get((("phase", phase),))
+            if histogram is not None:
+                rows.append((phase, histogram, ""))
+        self._fill(self.node_phases, rows)
+
+        self.engine_var.set(
+            f"queued {metrics.value(ENGINE_QUEUED):g}   "
+            f"running {metrics.value(ENGINE_IN_FLIGHT):g}   "
+            f"results waiting {metrics.value(RESULTS_QUEUED):g}"
+        )
+        self.primary.after(REFRESH_INTERVAL, self.refresh)
+
+    def _fill(self, node: str, rows: list) -> None:
+        self.tree.delete(*self.tree.get_children(node))
+        for text, histogram, errors in rows:
+            self.tree.insert(
+                node,
+                "end",
+                text=text,
+                values=(
+                    histogram.count,
+                    errors,
+                    _ms(histogram.quantile(0.5)),
+                    _ms(histogram.quantile(0.95)),
+                ),
+            )
+
+    def reset(self) -> None:
+        metrics.reset()
+        self.tree.delete(*self.tree.get_children(self.node_operations))
+        self.tree.delete(*self.tree.get_children(self.node_phases))
+
+    def window_close(self, event=None) -> None:
+        self.primary.destroy()
+
+    def window_exists(self) -> bool:
+        try:
+            return bool(self.primary.winfo_exists())
+        except TclError:
+            return False
+
+    def window_bring_to_front(self) -> None:
+        self.primary.lift()
+        self.primary.focus_force()
+
+
+def _ms(seconds) -> str:
+    return "" if seconds is None else f"{seconds * 1000:.1f}"
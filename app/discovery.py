@@ -0,0 +1,304 @@
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+"""
+Device discovery.
+
+Yeelight bulbs answer a SSDP search sent on the multicast group
+239.255.255.250:1982. Tasmota has no discovery protocol over HTTP, so a subnet
+is swept instead: every address, on each of the given ports, gets a
+``/cm?cmnd=Status`` request, all of them at the same time up to
+``concurrency`` open connections. A /24 sweep takes about
+``connect_timeout + read_timeout`` seconds, whatever the number of hosts.
+Lights are told apart by the color in ``Status 11``, plugs by their energy
+monitor in ``Status 8``, other devices are switches.
+
+Found devices are merged into iot_devices.json: a known device (same yeelight
+"id" or tasmota "topic", else same "ip") gets its new address, an unknown one
+is appended.
+
+    python cli.py discover 192.168.15.0/24 --write
+    python cli.py discover 127.0.0.1 --ports 32768-60999   # simulator.py
+
+"""
+
+
+YEELIGHT_MULTICAST = ("239.255.255.250", 1982)
+YEELIGHT_SEARCH = (
+    "M-SEARCH * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1982\r\n"
+    'MAN: "ssdp:discover"\r\n'
+    "ST: wifi_bulb\r\n"
+)
+# seconds to wait for SSDP answers
+YEELIGHT_TIMEOUT = 2.0
+# open connections during a subnet sweep
+SWEEP_CONCURRENCY = 256
+# seconds to wait for a host to accept the connection
+SWEEP_CONNECT_TIMEOUT = 1.0
+# seconds to wait for the reply of a connected host
+SWEEP_READ_TIMEOUT = 1.5
+# tasmota replies are small, bigger ones are not tasmota
+SWEEP_MAX_REPLY = 64 * 1024
+
+
+def discover_yeelight(
+    timeout: float = YEELIGHT_TIMEOUT, address: tuple = YEELIGHT_MULTICAST
+) -> list:
+    """
+    Search Yeelight bulbs with SSDP.
+
+    Parameters
+    ----------
+    timeout : float
+        Seconds to collect answers.
+
+    address : tuple
+        (host, port) the search is sent to, the multicast group by default.
+
+    Returns
+    ----------
+    list
+        Devices as in iot_devices.json, plus the "id" of the bulb.
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    sock.settimeout(0.2)
+    found = {}
+    try:
+        sock.sendto(YEELIGHT_SEARCH.encode("ascii"), address)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                data, _ = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            headers = _parse_headers(data.decode("utf8", errors="replace"))
+            location = headers.get("location", "")
+            if not location.startswith("yeelight://"):
+                continue
+            host, _, port = location[len("yeelight://") :].partition(":")
+            bulb_id = headers.get("id", host)
+            device = {
+                "type": "yeelight-bulb",
+                "name": headers.get("name") or f"Yeelight {headers.get('model', '')}",
+                "ip": host,
+                "id": bulb_id,
+                "confirm": False,
+            }
+            if port and int(port) != 55443:
+                device["port"] = int(port)
+            found[bulb_id] = device
+    finally:
+        sock.close()
+    return list(found.values())
+
+
+def _parse_headers(text: str) -> dict:
+    headers = {}
+    for line in text.split("\r\n")[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> bytes:
+    raw = b""
+    while len(raw) < SWEEP_MAX_REPLY:
+        chunk = await reader.read(SWEEP_MAX_REPLY - len(raw))
+        if not chunk:
+            break
+        raw += chunk
+    return raw
+
+
+async def _http_json(host: str, port: int, cmnd: str) -> Optional[dict]:
+    path = "/cm?cmnd=" + cmnd.replace(" ", "%20")
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), SWEEP_CONNECT_TIMEOUT
+        )
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.0\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        raw = await asyncio.wait_for(_read_reply(reader), SWEEP_READ_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        writer.close()
+    _, _, body = raw.partition(b"\r\n\r\n")
+    try:
+        reply = json.loads(body)
+    except ValueError:
+        return None
+    return reply if isinstance(reply, dict) else None
+
+
+async def _probe_tasmota(
+    host: str, port: int, semaphore: asyncio.Semaphore
+) -> Optional[dict]:
+    async with semaphore:
+        reply = await _http_json(host, port, "Status")
+        if reply is None or "Status" not in reply:
+            return None
+        # lights report their color in the status of the light module
+        sts = await _http_json(host, port, "Status 11") or {}
+        if "HSBColor" in sts.get("StatusSTS", {}):
+            device_type = "tasmota-light-RGBCCT"
+        else:
+            # plugs have an energy monitor, switches only a relay
+            sns = await _http_json(host, port, "Status 8") or {}
+            metered = "ENERGY" in sns.get("StatusSNS", {})
+            device_type = "tasmota-plug" if metered else "tasmota-switch"
+    status = reply["Status"]
+    names = status.get("FriendlyName") or [status.get("DeviceName") or host]
+    device = {
+        "type": device_type,
+        "name": names[0],
+        "ip": host if port == 80 else f"{host}:{port}",
+        "topic": status.get("Topic", ""),
+        "confirm": False,
+    }
+    return device
+
+
+def parse_ports(text: str) -> list:
+    """
+    Ports of a sweep, e.g. "80,8080" or "8000-8099".
+
+    Raises
+    ----------
+    ValueError
+        Not a port, or an empty range.
+
+    """
+    ports = []
+    for part in text.split(","):
+        first, sep, last = part.strip().partition("-")
+        span = range(int(first), int(last if sep else first) + 1)
+        if not span or not 0 < span[0] <= span[-1] <= 65535:
+            raise ValueError(f"Invalid ports: {part}")
+        ports.extend(span)
+    return ports
+
+
+async def sweep_tasmota(
+    subnet: str,
+    ports: Iterable[int] = (80,),
+    concurrency: int = SWEEP_CONCURRENCY,
+) -> list:
+    """
+    Find Tasmota devices of a subnet, e.g. "192.168.15.0/24".
+
+    Parameters
+    ----------
+    subnet : str
+        Network of the hosts, a single address is a /32.
+
+    ports : Iterable[int]
+        Every host is probed on each of them.
+
+    concurrency : int
+        Probes running at the same time.
+
+    Returns
+    ----------
+    list
+        Devices as in iot_devices.json, plus their MQTT "topic".
+
+    """
+    network = ipaddress.ip_network(subnet, strict=False)
+    hosts = [str(host) for host in network.hosts()] or [str(network.network_address)]
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *(
+            _probe_tasmota(host, port, semaphore)
+            for host in hosts
+            for port in list(ports)
+        )
+    )
+    return [device for device in results if device is not None]
+
+
+def discover(
+    subnet: Optional[str] = None, tasmota_ports: Iterable[int] = (80,)
+) -> list:
+    """Run the Yeelight search and the Tasmota sweep at the same time."""
+
+    async def _all() -> list:
+        loop = asyncio.get_running_loop()
+        yeelight = loop.run_in_executor(None, discover_yeelight)
+        tasmota = sweep_tasmota(subnet, ports=tasmota_ports) if subnet else None
+        found = []
+        if tasmota is not None:
+            found.extend(await tasmota)
+        found.extend(await yeelight)
+        return found
+
+    return asyncio.run(_all())
+
+
+def merge_devices(devices: list, found: list) -> tuple:
+    """
+    Merge discovered devices into the device list of iot_devices.json.
+
+    Returns
+    ----------
+    tuple
+        (devices, changed) the updated list, and the names of the devices
+        that were added or updated.
+
+    """
+    devices = [dict(device) for device in devices]
+    changed = []
+    for new in found:
+        key = "id" if new["type"] == "yeelight-bulb" else "topic"
+        match = None
+        for device in devices:
+            if new.get(key) and device.get(key) == new[key]:
+                match = device
+                break
+        if match is None:
+            match = next((d for d in devices if d["ip"] == new["ip"]), None)
+        if match is None:
+            if any(device["name"] == new["name"] for device in devices):
+                # names are unique in iot_devices.json
+                new = dict(new, name=f"{new['name']} ({new['ip']})")
+            devices.append(new)
+            changed.append(new["name"])
+            continue
+        updated = match["ip"] != new["ip"]
+        match["ip"] = new["ip"]
+        for extra in ("id", "topic", "port"):
+            if new.get(extra) and not match.get(extra):
+                match[extra] = new[extra]
+                updated = True
+        if updated:
+            changed.append(match["name"])
+    return devices, changed
+
+
+def update_config(path: Path, found: list) -> list:
+    """Write the discovered devices into iot_devices.json, returns changes."""
+    with Path(path).open("r") as filehandle:
+        data = json.load(filehandle)
+    devices, changed = merge_devices(data["iot"]["devices"], found)
+    if changed:
+        data["iot"]["devices"] = devices
+        tmp = Path(f"{path}.tmp")
+        with tmp.open("w") as filehandle:
+            json.dump(data, filehandle, indent=4)
+        os.replace(tmp, path)
+    return changed
@@ -0,0 +1,172 @@
+import importlib
+from typing import Optional
+
+from config import Device
+
+"""
+Device drivers.
+
+A driver implements the operations of one or more device "type" of
+iot_devices.json. The controller creates one driver per type on first use,
+so only the modules of the device types present in the config are imported.
+
+    connect(device)            start optional background work (notifications)
+    disconnect(device)         release the connection of a removed device
+    get_state(device)          blocking state read
+    set(device, settings)      power, dimmer, ct, color (see scenes.py)
+    toggle(device)             power toggle
+    batch(device, settings)    several ``set`` at once, in order
+    expected_state(device, settings, state)
+                               state the device should report after ``set``
+    command(device, cmnd, ...) raw command of the device protocol, used by its
+                               settings window
+    is_unreachable(error)      the error means the device could not be reached
+    frame(device, hue, sat, bri, first)
+                               one frame of a light effect (see effects.py),
+                               at most one per ``frame_interval`` seconds
+    energy(device)             power and energy counter, None without a meter
+                               (see telemetry.py)
+    close()                    release the connections
+
+Drivers of other device types are found through the "iot_controller.drivers"
+entry point group, the name of the entry point being the device type:
+
+    [tool.poetry.plugins."iot_controller.drivers"]
+    "shelly-plug" = "iot_shelly:ShellyDriver"
+
+"""
+
+
+ENTRY_POINT_GROUP = "iot_controller.drivers"
+# "module:class" of the builtin drivers, imported on first use
+BUILTIN_DRIVERS = {
+    "tasmota-plug": "tasmota_driver:TasmotaDriver",
+    "tasmota-switch": "tasmota_driver:TasmotaDriver",
+    "tasmota-light-RGBCCT": "tasmota_driver:TasmotaLightDriver",
+    "yeelight-bulb": "yeelight_driver:YeelightDriver",
+}
+
+
+class DriverNotFoundError(Exception):
+    pass
+
+
+class Driver:
+    # settings window of the GUI, None when the device can only be toggled
+    window = None
+    # seconds between two effect frames, None when the device has no color
+    frame_interval = None
+
+    def __init__(self, controller) -> None:
+        """
+        Parameters
+        ----------
+        controller : Controller
+            Shared state cache and connections (Tasmota HTTP client, MQTT).
+
+        """
+        self.controller = controller
+
+    def connect(self, device: Device) -> None:
+        pass
+
+    def disconnect(self, device: Device) -> None:
+        pass
+
+    def is_pushing(self, device: Device) -> bool:
+        """The device reports its state by itself, polling is not needed."""
+        return False
+
+    def get_state(self, device: Device) -> dict:
+        raise NotImplementedError
+
+    def set(self, device: Device, settings: dict) -> dict:
+        raise NotImplementedError
+
+    def toggle(self, device: Device) -> dict:
+        return self.set(device, {"power": "toggle"})
+
+    def batch(self, device: Device, settings: list) -> dict:
+        reply = {}
+        for values in settings:
+            reply = self.set(device, values)
+        return reply
+
+    def expected_state(self, device: Device, settings: dict, state: dict) -> dict:
+        """
+        Partial state the device should report once ``settings`` are applied,
+        shown by the GUI before the reply (see optimistic.py). Empty when not
+        known.
+
+        Parameters
+        ----------
+        state : dict
+            Current state of the device, to resolve a power "toggle".
+
+        """
+        return {}
+
+    def command(self, device: Device, cmnd, *args):
+        raise NotImplementedError
+
+    def is_unreachable(self, error: Exception) -> bool:
+        """Only these errors count towards the circuit breaker, see health.py."""
+        return isinstance(error, OSError)
+
+    def frame(
+        self, device: Device, hue: int, sat: int, bri: int, first: bool = False
+    ) -> None:
+        """
+        Show one frame of an effect, as fast as possible.
+
+        Parameters
+        ----------
+        hue, sat, bri : int
+            0..359, 0..100, 0..100, the values of Tasmota's HSBColor.
+
+        first : bool
+            First frame of an effect on this device, switch it to color mode.
+
+        """
+        raise NotImplementedError
+
+    def energy(self, device: Device) -> Optional[dict]:
+        """
+        Energy monitor reading.
+
+        Returns
+        ----------
+        dict or None
+            {"power": W, "energy": kWh counter, "voltage": V, "current": A},
+            None when the device has no energy monitor.
+
+        """
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+def has_driver(device_type: str) -> bool:
+    if device_type in BUILTIN_DRIVERS:
+        return True
+    from importlib.metadata import entry_points
+
+    return any(
+        entry_point.name == device_type
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP)
+    )
+
+
+def load_driver(device_type: str) -> type:
+    """Return the driver class of a device type, importing it if needed."""
+    target = BUILTIN_DRIVERS.get(device_type)
+    if target is None:
+        from importlib.metadata import entry_points
+
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            if entry_point.name == device_type:
+                return entry_point.load()
+        raise DriverNotFoundError(f"No driver for device type: {device_type}")
+    module, _, name = target.partition(":")
+    return getattr(importlib.import_module(module), name)
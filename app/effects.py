@@ -0,0 +1,433 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Union
+
+try:
+    import numpy
+except ImportError:  # optional dependency: pip install numpy
+    numpy = None
+
+from colors import rgb2hsv
+from config import Device
+from health import DeviceUnavailableError
+from metrics import EFFECT_FRAMES_TOTAL, metrics
+
+"""
+Light effects: fades and color loops over many lights at once.
+
+An effect computes the color of all its lights for a point in time, as a
+batch: HSB arrays (hue 0..359, saturation and brightness 0..100, the values of
+Tasmota's HSBColor) with numpy when installed, plain lists otherwise. Easing
+curves are lookup tables computed once, colors are parsed when the effect is
+created, a frame is only arithmetic.
+
+``EffectRunner`` ticks at a fixed frame rate and streams the frames to the
+devices through the controller (``Controller.frame``). Each device takes at
+most one frame per ``frame_interval`` of its driver (Tasmota web server,
+Yeelight quota and music mode), and a device still busy with its previous
+frame skips the new one: late frames are dropped, never queued. Unchanged
+frames are not sent. The last frame of an effect is always delivered.
+
+    runner = EffectRunner(controller)
+    runner.play(ColorLoop(lights, period=20, spread=360 / len(lights)))
+    runner.play(Fade(lights, "#ff8800", duration=5))
+    runner.wait()
+    runner.close()
+
+"""
+
+
+# frames computed per second
+DEFAULT_FPS = 20
+# devices sent a frame at the same time
+EFFECT_MAX_WORKERS = 16
+# entries of the easing lookup tables
+EASING_STEPS = 1024
+EASINGS = {
+    "linear": lambda x: x,
+    "ease-in": lambda x: x * x,
+    "ease-out": lambda x: 1 - (1 - x) * (1 - x),
+    "ease-in-out": lambda x: x * x * (3 - 2 * x),
+    "sine": lambda x: (1 - math.cos(math.pi * x)) / 2,
+}
+# consecutive failed frames before a device is left out of the effect
+FRAME_MAX_ERRORS = 3
+
+logger = logging.getLogger(__name__)
+
+# easing name: lookup table of EASING_STEPS values
+_easing_tables = {}
+
+
+def easing_table(name: str):
+    """Lookup table of an easing curve, computed on first use."""
+    table = _easing_tables.get(name)
+    if table is None:
+        if name not in EASINGS:
+            raise ValueError(f"Unknown easing: {name}")
+        curve = EASINGS[name]
+        values = [curve(i / (EASING_STEPS - 1)) for i in range(EASING_STEPS)]
+        table = numpy.array(values) if numpy is not None else tuple(values)
+        _easing_tables[name] = table
+    return table
+
+
+def parse_colors(colors: Union[str, Sequence[str]], count: int) -> list:
+    """One (hue, sat, bri) per light from a "#rrggbb" or a list of them."""
+    if isinstance(colors, str):
+        return [rgb2hsv(colors)] * count
+    if len(colors) != count:
+        raise ValueError(f"Expected {count} colors, got {len(colors)}")
+    return [rgb2hsv(color) for color in colors]
+
+
+def state_color(state: Optional[dict]) -> tuple:
+    """(hue, sat, bri) of a cached Tasmota or Yeelight state, black if unknown."""
+    state = state or {}
+    if "HSBColor" in state:
+        try:
+            h, s, b = (int(v) for v in str(state["HSBColor"]).split(","))
+        except ValueError:
+            return (0, 0, 0)
+        return (h, s, b)
+    if "hue" in state:
+        try:
+            return (int(state["hue"]), int(state["sat"]), int(state["bright"]))
+        except (KeyError, TypeError, ValueError):
+            return (0, 0, 0)
+    return (0, 0, 0)
+
+
+class Effect:
+    """
+    Frames of a set of lights.
+
+    Parameters
+    ----------
+    devices : sequence of Device
+        The lights, in the order of the frames.
+
+    duration : float, optional
+        Seconds, None runs until stopped.
+
+    """
+
+    def __init__(self, devices: Sequence[Device], duration: Optional[float]) -> None:
+        self.devices = tuple(devices)
+        self.duration = duration
+
+    def prepare(self, states: list) -> None:
+        """Called by the runner before the first frame, with the cached states."""
+
+    def frame(self, elapsed: float) -> list:
+        """(hue, sat, bri) ints of every light, ``elapsed`` seconds in."""
+        raise NotImplementedError
+
+
+class Fade(Effect):
+    """
+    Transition of every light from its color to ``end``, all in step.
+
+    Parameters
+    ----------
+    end : str or list of str
+        "#rrggbb", or one per light.
+
+    start : str or list of str, optional
+        Defaults to the current color of each light (state cache).
+
+    easing : str
+        Name of an ``EASINGS`` curve.
+
+    Hues take the shortest way around the color wheel.
+    """
+
+    def __init__(
+        self,
+        devices: Sequence[Device],
+        end: Union[str, Sequence[str]],
+        duration: float,
+        start: Union[str, Sequence[str], None] = None,
+        easing: str = "ease-in-out",
+    ) -> None:
+        super().__init__(devices, max(0.0, duration))
+        self.table = easing_table(easing)
+        self.end = parse_colors(end, len(self.devices))
+        self.start = None
+        if start is not None:
+            self._set_start(parse_colors(start, len(self.devices)))
+
+    def prepare(self, states: list) -> None:
+        if self.start is None:
+            self._set_start([state_color(state) for state in states])
+
+    def _set_start(self, start: list) -> None:
+        self.start = start
+        # hue steps along the shortest arc, -180..180
+        delta = [
+            (((e[0] - s[0]) + 180) % 360 - 180, e[1] - s[1], e[2] - s[2])
+            for s, e in zip(start, self.end)
+        ]
+        if numpy is not None:
+            self._origin = numpy.array(start, dtype=float).reshape(-1, 3)
+            self._delta = numpy.array(delta, dtype=float).reshape(-1, 3)
+        else:
+            self._origin = start
+            self._delta = delta
+
+    def frame(self, elapsed: float) -> list:
+        if not self.duration or elapsed >= self.duration:
+            return list(self.end)
+        x = self.table[int(elapsed / self.duration * (EASING_STEPS - 1))]
+        if numpy is not None:
+            hsb = numpy.rint(self._origin + self._delta * x).astype(int)
+            hsb[:, 0] %= 360
+            return [tuple(row) for row in hsb.tolist()]
+        return [
+            (
+                round(h + dh * x) % 360,
+                round(s + ds * x),
+                round(b + db * x),
+            )
+            for (h, s, b), (dh, ds, db) in zip(self._origin, self._delta)
+        ]
+
+
+class ColorLoop(Effect):
+    """
+    Hue going around the color wheel every ``period`` seconds.
+
+    Parameters
+    ----------
+    spread : float
+        Degrees between the hues of two consecutive lights, 0 keeps all the
+        lights on the same color, ``360 / len(devices)`` spreads them around
+        the wheel.
+
+    """
+
+    def __init__(
+        self,
+        devices: Sequence[Device],
+        period: float = 30.0,
+        spread: float = 0.0,
+        sat: int = 100,
+        bri: int = 100,
+        duration: Optional[float] = None,
+    ) -> None:
+        super().__init__(devices, duration)
+        self.period = max(0.1, period)
+        self.sat = sat
+        self.bri = bri
+        offsets = [i * spread for i in range(len(self.devices))]
+        self._offsets = numpy.array(offsets) if numpy is not None else offsets
+
+    def frame(self, elapsed: float) -> list:
+        turn = elapsed / self.period * 360
+        if numpy is not None:
+            hues = numpy.rint(self._offsets + turn).astype(int) % 360
+            return [(hue, self.sat, self.bri) for hue in hues.tolist()]
+        return [
+            (round(offset + turn) % 360, self.sat, self.bri) for offset in self._offsets
+        ]
+
+
+class _Stream:
+    __slots__ = ("device", "interval", "next_at", "busy", "sent", "errors", "failed")
+
+    def __init__(self, device: Device, interval: float) -> None:
+        self.device = device
+        # seconds between two frames, from the driver
+        self.interval = interval
+        self.next_at = 0.0
+        # a frame is on its way, the next ones are dropped until it is done
+        self.busy = False
+        # last frame delivered, None before the first one
+        self.sent = None
+        self.errors = 0
+        # unavailable or failing, the effect goes on without it
+        self.failed = False
+
+
+class _Playing:
+    __slots__ = ("effect", "streams", "started", "done")
+
+    def __init__(self, effect: Effect, streams: list, started: float) -> None:
+        self.effect = effect
+        self.streams = streams
+        self.started = started
+        self.done = False
+
+
+class EffectRunner:
+    def __init__(
+        self,
+        controller,
+        fps: float = DEFAULT_FPS,
+        max_workers: int = EFFECT_MAX_WORKERS,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        controller : Controller
+            Frames are sent with ``Controller.frame``, devices known to be
+            down are left out of the effect.
+
+        """
+        self.controller = controller
+        self.tick = 1.0 / fps
+        self.max_workers = max_workers
+        self._playing = []
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def play(self, effect: Effect) -> None:
+        """
+        Start an effect. Lights of an effect already playing are taken over,
+        that effect goes on with its other lights.
+
+        Raises
+        ----------
+        ValueError
+            None of the devices can play effects.
+
+        """
+        streams = []
+        for device in effect.devices:
+            interval = self.controller.frame_interval(device)
+            if interval is None:
+                raise ValueError(f"{device.name} does not support effects")
+            streams.append(_Stream(device, interval))
+        if not streams:
+            raise ValueError("No device to play the effect on")
+        effect.prepare([self.controller.cache.get(d.ip) for d in effect.devices])
+        ips = {device.ip for device in effect.devices}
+        with self._wakeup:
+            for playing in self._playing:
+                for stream in playing.streams:
+                    if stream.device.ip in ips:
+                        stream.failed = True
+            self._playing.append(_Playing(effect, streams, time.monotonic()))
+            self._start()
+            self._wakeup.notify_all()
+
+    def stop(self, effect: Optional[Effect] = None) -> None:
+        """Stop an effect, or all of them. Lights keep their last frame."""
+        with self._wakeup:
+            self._playing = [
+                p
+                for p in self._playing
+                if effect is not None and p.effect is not effect
+            ]
+            self._wakeup.notify_all()
+
+    def is_playing(self) -> bool:
+        with self._wakeup:
+            return bool(self._playing)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until every effect ended, False on timeout."""
+        with self._wakeup:
+            return self._wakeup.wait_for(
+                lambda: not self._playing or self._stopped, timeout
+            )
+
+    def close(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._playing = []
+            self._wakeup.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start(self) -> None:
+        # called with self._wakeup held, starts the ticking thread on first use
+        if self._thread is None and not self._stopped:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="iot-effect-send"
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="iot-effects", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        deadline = time.monotonic()
+        while True:
+            with self._wakeup:
+                while not self._playing and not self._stopped:
+                    self._wakeup.wait()
+                    deadline = time.monotonic()
+                if self._stopped:
+                    return
+                playing = list(self._playing)
+            now = time.monotonic()
+            for entry in playing:
+                self._render(entry, now)
+            with self._wakeup:
+                self._playing = [p for p in self._playing if not p.done]
+                if not self._playing:
+                    self._wakeup.notify_all()
+            deadline += self.tick
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                # this tick was late, start again from now instead of
+                # computing the missed frames in a burst
+                deadline = time.monotonic()
+                continue
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._stopped, delay)
+
+    def _render(self, entry: _Playing, now: float) -> None:
+        effect = entry.effect
+        if all(stream.failed for stream in entry.streams):
+            # every light is down or was taken over by another effect
+            entry.done = True
+            return
+        elapsed = now - entry.started
+        last = effect.duration is not None and elapsed >= effect.duration
+        frame = effect.frame(effect.duration if last else elapsed)
+        pending = False
+        for stream, hsb in zip(entry.streams, frame):
+            if stream.failed or stream.sent == hsb:
+                continue
+            pending = True
+            if stream.busy:
+                # late device, this frame is skipped, the next one is newer
+                metrics.inc(EFFECT_FRAMES_TOTAL, result="dropped")
+                continue
+            if now < stream.next_at:
+                # faster than the device takes them
+                continue
+            stream.busy = True
+            stream.next_at = now + stream.interval
+            try:
+                self._executor.submit(self._send, stream, hsb)
+            except RuntimeError:
+                # closed
+                return
+        # the last frame is repeated until every light has it
+        entry.done = last and not pending
+
+    def _send(self, stream: _Stream, hsb: tuple) -> None:
+        try:
+            self.controller.frame(stream.device, *hsb, first=stream.sent is None)
+        except DeviceUnavailableError:
+            stream.failed = True
+            metrics.inc(EFFECT_FRAMES_TOTAL, result="error")
+        except Exception as e:
+            logger.debug("%s frame failed: %s", stream.device.name, e)
+            metrics.inc(EFFECT_FRAMES_TOTAL, result="error")
+            stream.errors += 1
+            stream.failed = stream.failed or stream.errors >= FRAME_MAX_ERRORS
+        else:
+            stream.sent = hsb
+            stream.errors = 0
+            metrics.inc(EFFECT_FRAMES_TOTAL, result="sent")
+        finally:
+            stream.busy = False
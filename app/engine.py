@@ -0,0 +1,211 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional
+
+from coalescer import CommandCoalescer
+from metrics import (
+    ENGINE_IN_FLIGHT,
+    ENGINE_QUEUED,
+    PHASE_SECONDS,
+    RESULTS_QUEUED,
+    metrics,
+)
+
+"""
+Background command engine.
+
+Device I/O (Tasmota web requests, Yeelight sockets) must never run inside a Tk
+callback: a single unreachable device would freeze the whole window until its
+timeout expires. Commands are submitted to a bounded thread pool instead, and
+their results are queued back to the thread that owns the widgets, which drains
+the queue periodically through ``widget.after()``.
+
+    engine = CommandEngine()
+    engine.attach(root)
+    engine.submit(requests.get, url, on_done=update_label, on_error=show_error)
+
+Slider driven commands go through ``submit_latest`` instead, which only keeps
+the newest value per key (see coalescer.py).
+
+"""
+
+
+# number of device commands allowed to run at the same time
+DEFAULT_MAX_WORKERS = 32
+# milliseconds between two checks of the result queue
+DEFAULT_POLL_INTERVAL = 50
+
+
+class CommandEngine:
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        poll_interval: int = DEFAULT_POLL_INTERVAL,
+    ) -> None:
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="iot-cmd"
+        )
+        self._results = queue.SimpleQueue()
+        self._widget = None
+        self._after_id = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self.coalescer = CommandCoalescer(self)
+
+    def submit(
+        self,
+        func: Callable[..., Any],
+        *args,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Run ``func(*args, **kwargs)`` on the worker pool.
+
+        Parameters
+        ----------
+        func : callable
+            Blocking function doing the device I/O. It must not touch any widget.
+
+        on_done : callable, optional
+            Called with the return value of ``func``, in the thread that calls
+            ``process_results`` (the Tk thread once ``attach`` was called).
+
+        on_error : callable, optional
+            Called with the exception raised by ``func``, in the same thread as
+            ``on_done``.
+
+        Returns
+        ----------
+        Future
+            The future of the command. Blocking on it from the Tk thread defeats
+            the purpose of the engine, use the callbacks instead.
+
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("CommandEngine is shut down")
+            future = self._executor.submit(
+                self._run, time.perf_counter(), func, args, kwargs
+            )
+            metrics.gauge_add(ENGINE_QUEUED, 1)
+        if on_done is not None or on_error is not None:
+            future.add_done_callback(
+                lambda f: self._results.put(
+                    lambda done=time.perf_counter(): self._dispatch(
+                        f, on_done, on_error, done
+                    )
+                )
+            )
+        return future
+
+    def post(self, callback: Callable[..., None], *args) -> None:
+        """
+        Run ``callback(*args)`` in the thread draining the result queue.
+        Safe to call from any thread, e.g. to update widgets from a listener.
+        """
+        self._results.put(lambda: callback(*args))
+
+    def submit_latest(
+        self,
+        key: Hashable,
+        func: Callable[..., Any],
+        *args,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        min_interval: Optional[float] = None,
+    ) -> None:
+        """
+        Like ``submit``, but a newer command with the same ``key`` replaces
+        this one if it did not start yet. See ``CommandCoalescer.submit``.
+        """
+        self.coalescer.submit(
+            key,
+            func,
+            *args,
+            on_done=on_done,
+            on_error=on_error,
+            min_interval=min_interval,
+        )
+
+    def process_results(self, max_items: int = 100) -> int:
+        """
+        Dispatch finished commands to their callbacks.
+
+        Parameters
+        ----------
+        max_items : int
+            Upper bound of callbacks run in one call, so a burst of results
+            can not starve the event loop.
+
+        Returns
+        ----------
+        int
+            Number of results dispatched.
+
+        """
+        count = 0
+        while count < max_items:
+            try:
+                callback = self._results.get_nowait()
+            except queue.Empty:
+                break
+            count += 1
+            callback()
+        metrics.gauge_set(RESULTS_QUEUED, self._results.qsize())
+        return count
+
+    @staticmethod
+    def _run(submitted: float, func, args, kwargs):
+        started = time.perf_counter()
+        metrics.gauge_add(ENGINE_QUEUED, -1)
+        metrics.gauge_add(ENGINE_IN_FLIGHT, 1)
+        metrics.observe(PHASE_SECONDS, started - submitted, phase="queue")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.gauge_add(ENGINE_IN_FLIGHT, -1)
+
+    @staticmethod
+    def _dispatch(future: Future, on_done, on_error, done: float) -> None:
+        if future.cancelled():
+            return
+        metrics.observe(PHASE_SECONDS, time.perf_counter() - done, phase="dispatch")
+        error = future.exception()
+        if error is None:
+            if on_done is not None:
+                on_done(future.result())
+        elif on_error is not None:
+            on_error(error)
+
+    def attach(self, widget) -> None:
+        """Start draining the result queue from the event loop of ``widget``."""
+        self._widget = widget
+        self._schedule_poll()
+
+    def _schedule_poll(self) -> None:
+        if self._closed or self._widget is None:
+            return
+        self._after_id = self._widget.after(self.poll_interval, self._poll)
+
+    def _poll(self) -> None:
+        try:
+            self.process_results()
+        finally:
+            self._schedule_poll()
+
+    def shutdown(self, wait: bool = False) -> None:
+        self.coalescer.cancel()
+        with self._lock:
+            self._closed = True
+        if self._widget is not None and self._after_id is not None:
+            try:
+                self._widget.after_cancel(self._after_id)
+            except Exception:
+                pass
+        self._widget = None
+        self._executor.shutdown(wait=wait, cancel_futures=True)
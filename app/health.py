@@ -0,0 +1,284 @@
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from config import Device
+
+"""
+Device health and circuit breaker.
+
+Every device operation of the controller goes through ``HealthTracker.call``,
+which keeps rolling latency and error statistics per device. A device failing
+``failure_threshold`` times in a row with a connection error is considered
+down: its breaker opens and operations fail at once with
+``DeviceUnavailableError`` instead of waiting for a timeout.
+
+While a breaker is open, the device is probed in the background, with a
+growing interval. The first successful probe closes the breaker.
+
+    closed  --failures-->  open  --probe-->  half-open  --ok-->  closed
+                            ^                    |
+                            +------failure-------+
+
+Errors of a device that answered (wrong response code, bad request) are
+counted in the error rate but do not open the breaker.
+"""
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+# consecutive connection errors opening the breaker
+DEFAULT_FAILURE_THRESHOLD = 2
+# seconds before the first probe of a device that went down
+DEFAULT_PROBE_INTERVAL = 5.0
+# the probe interval doubles up to this many seconds
+DEFAULT_MAX_PROBE_INTERVAL = 60.0
+# operations kept for the latency and error rate statistics
+HEALTH_WINDOW = 50
+# devices probed at the same time
+PROBE_MAX_WORKERS = 8
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceUnavailableError(Exception):
+    pass
+
+
+class DeviceHealth:
+    __slots__ = (
+        "state",
+        "failures",
+        "samples",
+        "probe_interval",
+        "retry_at",
+        "last_error",
+    )
+
+    def __init__(self) -> None:
+        self.state = CLOSED
+        # consecutive connection errors
+        self.failures = 0
+        # (seconds, ok) of the last operations
+        self.samples = deque(maxlen=HEALTH_WINDOW)
+        self.probe_interval = 0.0
+        self.retry_at = 0.0
+        self.last_error = None
+
+    def as_dict(self) -> dict:
+        latencies = sorted(seconds for seconds, _ in self.samples)
+        errors = sum(1 for _, ok in self.samples if not ok)
+        count = len(latencies)
+        return {
+            "state": self.state,
+            "samples": count,
+            "error_rate": round(errors / count, 3) if count else 0.0,
+            "latency_avg_ms": round(sum(latencies) / count * 1000, 1)
+            if count
+            else None,
+            "latency_p95_ms": round(
+                latencies[min(count - 1, int(count * 0.95))] * 1000, 1
+            )
+            if count
+            else None,
+            "last_error": self.last_error,
+        }
+
+
+class HealthTracker:
+    def __init__(
+        self,
+        probe: Callable[[Device], None],
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        probe_interval: float = DEFAULT_PROBE_INTERVAL,
+        max_probe_interval: float = DEFAULT_MAX_PROBE_INTERVAL,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        probe : callable
+            Blocking ``probe(device)``, raises when the device is still down.
+            Runs in the probe threads.
+
+        """
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self._health = {}
+        self._devices = {}
+        self._heap = []
+        self._listeners = []
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def subscribe(self, listener: Callable[[str, bool], None]) -> None:
+        """``listener(ip, available)`` is called when a breaker opens or closes."""
+        self._listeners.append(listener)
+
+    def is_available(self, device: Device) -> bool:
+        with self._wakeup:
+            health = self._health.get(device.ip)
+            return health is None or health.state == CLOSED
+
+    def stats(self, device: Device) -> dict:
+        with self._wakeup:
+            health = self._health.get(device.ip)
+            return (health or DeviceHealth()).as_dict()
+
+    def forget(self, device: Device) -> None:
+        """Drop the statistics of a removed device."""
+        with self._wakeup:
+            self._health.pop(device.ip, None)
+            self._devices.pop(device.ip, None)
+
+    def call(
+        self,
+        device: Device,
+        function: Callable,
+        *args,
+        is_unreachable: Callable[[Exception], bool] = lambda e: True,
+    ):
+        """
+        Run ``function(device, *args)``, failing fast while the breaker of the
+        device is open.
+
+        Parameters
+        ----------
+        is_unreachable : callable
+            Tells if an exception of ``function`` means the device could not be
+            reached, only those count towards opening the breaker.
+
+        Raises
+        ----------
+        DeviceUnavailableError
+            The device is down, ``function`` was not called.
+
+        """
+        with self._wakeup:
+            health = self._health.get(device.ip)
+            if health is not None and health.state != CLOSED:
+                raise DeviceUnavailableError(f"{device.name} is unreachable")
+        start = time.perf_counter()
+        try:
+            result = function(device, *args)
+        except Exception as e:
+            self._record(device, time.perf_counter() - start, e, is_unreachable(e))
+            raise
+        self._record(device, time.perf_counter() - start)
+        return result
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _record(
+        self,
+        device: Device,
+        seconds: float,
+        error: Optional[Exception] = None,
+        unreachable: bool = False,
+    ) -> None:
+        with self._wakeup:
+            health = self._health.get(device.ip)
+            if health is None:
+                health = self._health[device.ip] = DeviceHealth()
+            health.samples.append((seconds, error is None))
+            if error is not None:
+                health.last_error = str(error)
+            if not unreachable:
+                health.failures = 0
+                return
+            health.failures += 1
+            if health.state != CLOSED or health.failures < self.failure_threshold:
+                return
+            health.state = OPEN
+            health.probe_interval = self.probe_interval
+            self._devices[device.ip] = device
+            self._schedule(device.ip, health)
+        logger.warning("%s is unreachable: %s", device.name, error)
+        self._notify(device.ip, False)
+
+    def _schedule(self, ip: str, health: DeviceHealth) -> None:
+        # called with self._wakeup held, starts the probe thread on first use
+        health.retry_at = time.monotonic() + health.probe_interval
+        heapq.heappush(self._heap, (health.retry_at, ip))
+        if self._thread is None and not self._stopped:
+            self._executor = ThreadPoolExecutor(
+                max_workers=PROBE_MAX_WORKERS, thread_name_prefix="iot-probe"
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="iot-health", daemon=True
+            )
+            self._thread.start()
+        self._wakeup.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    retry_at, ip = heapq.heappop(self._heap)
+                    health = self._health.get(ip)
+                    if health is None or health.state != OPEN:
+                        continue
+                    if health.retry_at != retry_at:
+                        continue
+                    health.state = HALF_OPEN
+                    due.append(self._devices[ip])
+            for device in due:
+                try:
+                    self._executor.submit(self._probe, device)
+                except RuntimeError:
+                    # stopped
+                    return
+
+    def _probe(self, device: Device) -> None:
+        start = time.perf_counter()
+        try:
+            self.probe(device)
+        except Exception as e:
+            with self._wakeup:
+                health = self._health.get(device.ip)
+                if health is None:
+                    return
+                health.samples.append((time.perf_counter() - start, False))
+                health.last_error = str(e)
+                health.state = OPEN
+                health.probe_interval = min(
+                    self.max_probe_interval, health.probe_interval * 2
+                )
+                self._schedule(device.ip, health)
+            return
+        with self._wakeup:
+            health = self._health.get(device.ip)
+            if health is None:
+                return
+            health.samples.append((time.perf_counter() - start, True))
+            health.state = CLOSED
+            health.failures = 0
+        logger.info("%s is reachable again", device.name)
+        self._notify(device.ip, True)
+
+    def _notify(self, ip: str, available: bool) -> None:
+        for listener in list(self._listeners):
+            listener(ip, available)
@@ -0,0 +1,193 @@
+import threading
+import time
+from typing import Optional
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import PHASE_SECONDS, metrics
+from tasmota import ConnectionError
+
+"""
+Keep-alive HTTP sessions for Tasmota devices.
+
+A bare ``requests.get`` opens a new TCP connection for every command, and on
+the ESP8266 the handshake costs more than the command itself. Each device gets
+its own ``requests.Session`` here, so consecutive commands (e.g. scrubbing a
+slider) reuse the same socket. Sessions left unused for ``idle_timeout``
+seconds are closed by a background timer, so a device that is switched off
+does not keep a half-open socket around.
+
+    pool = TasmotaSessionPool(pool_size=2, retries=1)
+    r = pool.get("192.168.15.41", "Power Toggle", timeout=3)
+
+"""
+
+
+# connections kept alive per device
+DEFAULT_POOL_SIZE = 2
+# connection attempts retried before giving up
+DEFAULT_RETRIES = 1
+# seconds to wait between retries: backoff_factor * (2 ** (retry - 1))
+DEFAULT_BACKOFF_FACTOR = 0.1
+# seconds of inactivity after which a device session is closed
+DEFAULT_IDLE_TIMEOUT = 30.0
+
+
+class TasmotaSessionPool:
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        retries: int = DEFAULT_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ) -> None:
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._closed = False
+
+    def session(self, ip: str) -> requests.Session:
+        """Return the session of the device, creating it on first use."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("TasmotaSessionPool is closed")
+            session = self._sessions.get(ip)
+            if session is None:
+                session = self._new_session()
+                self._sessions[ip] = session
+                self._schedule_reaper()
+            self._last_used[ip] = time.monotonic()
+            return session
+
+    def get(self, ip: str, cmnd, timeout: float) -> requests.Response:
+        """
+        Send a command to the device.
+            http://device_ip/cm?cmnd={cmnd}
+
+        Parameters
+        ----------
+        ip : str
+            Address of the device.
+
+        cmnd : str or Backlog
+            The Tasmota command, e.g. "Dimmer 10".
+
+        timeout : float
+            Seconds to wait for the device.
+
+        Returns
+        ----------
+        requests.Response
+            The raw response, status code is not checked.
+
+        Raises
+        ----------
+        ConnectionError
+            The device could not be reached in time.
+
+        """
+        start = time.perf_counter()
+        try:
+            r = self.session(ip).get(
+                url=f"http://{ip}/cm?cmnd={quote(str(cmnd))}", timeout=timeout
+            )
+        except requests.exceptions.Timeout:
+            raise ConnectionError("Connection Time out")
+        except requests.exceptions.TooManyRedirects:
+            raise ConnectionError("Connection Too Many Redirects")
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(e)
+        # elapsed: request sent to headers parsed, the rest is spent getting a
+        # connection from the pool (or opening it) and reading the body
+        device = r.elapsed.total_seconds()
+        metrics.observe(PHASE_SECONDS, device, phase="device")
+        metrics.observe(
+            PHASE_SECONDS,
+            max(0.0, time.perf_counter() - start - device),
+            phase="connect",
+        )
+        return r
+
+    def discard(self, ip: str) -> None:
+        """Close the connections of a device, e.g. after its address changed."""
+        with self._lock:
+            session = self._sessions.pop(ip, None)
+            self._last_used.pop(ip, None)
+        if session is not None:
+            session.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            self._last_used.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for session in sessions:
+            session.close()
+
+    def _new_session(self) -> requests.Session:
+        # Only failed connection attempts are retried. A command whose
+        # request reached the device is never replayed: "Power Toggle" is
+        # not idempotent.
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=self.backoff_factor,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        return session
+
+    def _schedule_reaper(self) -> None:
+        # called with self._lock held
+        if self._timer is None and self.idle_timeout > 0:
+            self._timer = threading.Timer(self.idle_timeout / 2, self._reap_idle)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _reap_idle(self) -> None:
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            self._timer = None
+            for ip, last_used in list(self._last_used.items()):
+                if now - last_used >= self.idle_timeout:
+                    idle.append(self._sessions.pop(ip))
+                    del self._last_used[ip]
+            if self._sessions and not self._closed:
+                self._schedule_reaper()
+        for session in idle:
+            session.close()
+
+
+def pool_from_config(config: Optional[dict]) -> TasmotaSessionPool:
+    """
+    Build a pool from the optional "http" section of iot_devices.json.
+
+        "http": {"pool_size": 2, "retries": 1, "idle_timeout": 30}
+
+    """
+    config = config or {}
+    return TasmotaSessionPool(
+        pool_size=int(config.get("pool_size", DEFAULT_POOL_SIZE)),
+        retries=int(config.get("retries", DEFAULT_RETRIES)),
+        backoff_factor=float(config.get("backoff_factor", DEFAULT_BACKOFF_FACTOR)),
+        idle_timeout=float(config.get("idle_timeout", DEFAULT_IDLE_TIMEOUT)),
+    )
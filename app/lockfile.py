@@ -0,0 +1,66 @@
+import logging
+import os
+import time
+from pathlib import Path
+
+"""
+Lock file electing the single process running a background job.
+
+The GUI and ``cli.py serve`` may run at the same time on the same config; jobs
+that must only run once (the schedules, the energy telemetry) take a lock file
+first. The owner refreshes it, a lock file not refreshed for a while is left by
+a dead process and taken over.
+
+    lock = OwnerLock(path)
+    if lock.acquire():
+        ...
+        lock.refresh()  # every LOCK_REFRESH_INTERVAL
+        ...
+        lock.release()
+"""
+
+
+# seconds between two refreshes of the lock file by its owner
+LOCK_REFRESH_INTERVAL = 60.0
+# a lock file not refreshed for this many seconds is left by a dead process
+LOCK_STALE_AFTER = 180.0
+
+logger = logging.getLogger(__name__)
+
+
+class OwnerLock:
+    def __init__(self, path: Path, stale_after: float = LOCK_STALE_AFTER) -> None:
+        self.path = Path(path)
+        self.stale_after = stale_after
+
+    def acquire(self) -> bool:
+        """Take the lock, False when another live process holds it."""
+        try:
+            age = time.time() - self.path.stat().st_mtime
+            if age > self.stale_after:
+                logger.info("Removing stale %s", self.path.name)
+                self.path.unlink()
+        except OSError:
+            pass
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            logger.warning("%s not created: %s", self.path.name, e)
+            return False
+        with os.fdopen(fd, "w") as filehandle:
+            filehandle.write(str(os.getpid()))
+        return True
+
+    def refresh(self) -> None:
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+
+    def release(self) -> None:
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
@@ -1,13 +1,20 @@
-import colorsys
-import json
-import re
+import logging
+import os
 from pathlib import Path
+from tkinter import TclError
 
-import requests
 import ttkbootstrap as ttk
-from ttkbootstrap.dialogs.colorchooser import ColorChooserDialog
-from ttkbootstrap.dialogs.dialogs import Messagebox
-from yeelight import Bulb
+
+from colors import clamp, hsv2rgb, rgb2hsv
+from config import Config, ConfigError, ConfigWatcher, Device, load_config
+from controller import Controller
+from device_list import DeviceList
+from engine import CommandEngine
+from health import DeviceUnavailableError
+from optimistic import OptimisticState
+from scenes import SceneRunner, scene_settings
+from state import StatePoller, is_on
+from tasmota import Backlog, merge_reply
 
 """
 Default factory:
@@ -59,18 +66,25 @@ IOT_JSON_FILE = "iot_devices.json"
 SLIDER_DIMMER_MULTIPLIER = 10
 # 500 - 153 = 347 -> 10 steps ~ 35
 SLIDER_CT_MULTIPLIER = 35
+# seconds between two commands sent while a slider is dragged
+SLIDER_TASMOTA_MIN_INTERVAL = 0.2
+# yeelight allows ~60 commands per minute
+SLIDER_YEELIGHT_MIN_INTERVAL = 0.5
+# set to print "first-frame" once the main window is drawn, see startup_benchmark.py
+STARTUP_BENCHMARK_ENV = "IOT_STARTUP_BENCHMARK"
+# log level of the messages printed on stderr, eg: DEBUG
+LOG_LEVEL_ENV = "IOT_LOG_LEVEL"
 
+# PhotoImage by file name, shared by all windows
+_images = {}
 
-class ConnectionError(Exception):
-    pass
-
-
-class ResponseCodeError(Exception):
-    pass
 
-
-class RequestError(Exception):
-    pass
+def load_image(name: str) -> ttk.PhotoImage:
+    """Return an image of the resources folder, read from disk only once."""
+    image = _images.get(name)
+    if image is None:
+        image = _images[name] = ttk.PhotoImage(file=Path(BASE_PATH, "resources", name))
+    return image
 
 
 class MainWindow:
@@ -83,123 +97,307 @@ class MainWindow:
 
         self.frame = ttk.Frame(self.primary, padding=10)
         self.frame.grid_columnconfigure(0, weight=1, minsize=200)
+        self.frame.grid_rowconfigure(1, weight=1)
         self.frame.pack(fill="both", expand=1, padx=10, pady=10)
 
         title = ttk.Label(self.frame, text="Welcome to IoT Controller")
         title.grid(column=0, row=0, columnspan=2, padx=5, pady=5)
-        self.icon_cog = ttk.PhotoImage(file=Path(BASE_PATH, "resources", "cog.png"))
-
-        with Path(BASE_PATH, IOT_JSON_FILE).open("r") as filehandle:
-            data = json.load(filehandle)
-            for row_number, device in enumerate(data["iot"]["devices"], start=1):
-                if (
-                    device["type"] == "tasmota-plug"
-                    or device["type"] == "tasmota-switch"
-                ):
-                    btn = ttk.Button(
-                        self.frame,
-                        text=f"{device['name']} -  Toggle",
-                        command=lambda ip=device["ip"], confirm=device[
-                            "confirm"
-                        ]: self.tasmota_smart_plug_toogle(ip, confirm),
-                        bootstyle="outline",  # type: ignore
-                    )
-                    btn.grid(
-                        column=0,
-                        columnspan=1,
-                        row=row_number,
-                        sticky="ew",
-                        padx=5,
-                        pady=8,
-                    )
-                elif device["type"] == "tasmota-light-RGBCCT":
-                    btn = ttk.Button(
-                        self.frame,
-                        text=f"{device['name']} Toggle",
-                        command=lambda ip=device["ip"], confirm=device[
-                            "confirm"
-                        ]: self.tasmota_smart_plug_toogle(ip, confirm),
-                        bootstyle="outline",  # type: ignore
-                    )
-                    btn.grid(column=0, row=row_number, sticky="ew", padx=5, pady=8)
-                    btn2 = ttk.Button(
-                        self.frame,
-                        command=lambda ip=device["ip"]: self.window_tasmota_light_open(
-                            ip
-                        ),
-                        image=self.icon_cog,
-                        bootstyle="link-light",  # type: ignore
-                    )
-                    btn2.grid(column=1, row=row_number, sticky="ew")
-                elif device["type"] == "yeelight-bulb":
-                    btn = ttk.Button(
-                        self.frame,
-                        text=f"{device['name']} Toggle",
-                        command=lambda ip=device["ip"], confirm=device[
-                            "confirm"
-                        ]: self.yeelight_toggle(ip, confirm),
-                        bootstyle="outline",  # type: ignore
-                    )
-                    btn.grid(column=0, row=row_number, sticky="ew", padx=5, pady=8)
-                    btn2 = ttk.Button(
-                        self.frame,
-                        command=lambda ip=device["ip"]: self.window_yeelight_open(ip),
-                        image=self.icon_cog,
-                        bootstyle="link-light",  # type: ignore
-                    )
-                    btn2.grid(column=1, row=row_number, sticky="ew")
-                btn = None
-                btn2 = None
+        self.icon_cog = load_image("cog.png")
+
+        self.engine = CommandEngine()
+        self.engine.attach(self.primary)
+        self.primary.protocol("WM_DELETE_WINDOW", self.window_close)
+
+        self.config = load_config(Path(BASE_PATH, IOT_JSON_FILE))
+        self.controller = Controller(self.config)
+        self.state_cache = self.controller.cache
+        # states shown by the windows, commands show up before their reply
+        self.view = OptimisticState(self.state_cache)
+        self.view.subscribe(
+            lambda ip, state: self.engine.post(self.device_state_changed, ip, state)
+        )
+        self.controller.health.subscribe(
+            lambda ip, available: self.engine.post(
+                self.device_available_changed, ip, available
+            )
+        )
+        self.scenes = SceneRunner(self.engine, self.controller)
+        self.poller = StatePoller(
+            self.engine,
+            self.state_cache,
+            self.controller.get_state,
+            skip=self.controller.is_pushing,
+        )
+        self.api = None
+        self.scheduler = None
+        self.telemetry = None
+        self.watcher = None
+        self.started = False
+        self.settings_windows = {}
+        self.diagnostics = None
+        self.device_list = DeviceList(
+            self.frame,
+            on_toggle=self.device_toggle,
+            on_settings=self.window_settings_open,
+            has_settings=lambda device: self.controller.driver(device).window
+            is not None,
+            icon=self.icon_cog,
+        )
+        self.device_list.grid(column=0, row=1, columnspan=2, sticky="nsew")
+        self.frame_scenes = None
+        self.status_var = ttk.StringVar(master=self.primary)
+        status = ttk.Label(self.frame, textvariable=self.status_var)
+        status.grid(column=0, row=3, columnspan=2, sticky="ew")
+        self.build_devices()
 
         self.frame.pack()
         self.window_center()
-
-    def tasmota_smart_plug_toogle(self, ip: str, confirm: bool = False) -> bool:
-        query_string = "cmnd=Power%20Toggle"
-        answer = True if not confirm else self.dialog_confirm()
-        if answer:
-            try:
-                url = f"http://{ip}/cm?{query_string}"
-                r = requests.get(url=url, timeout=3, verify=False)
-                if r.status_code == 200:
-                    j = r.json()
-                    if j.get("POWER") is not None:
-                        return True
-                    else:
-                        return False
-            except Exception as e:
-                self.dialog_error(
-                    title="Toogle Error",
-                    message="Unable to complete action.\n Please check if device is connect to network.",
+        self.primary.bind("<Map>", self.window_mapped, add="+")
+        self.primary.bind("<F12>", self.window_diagnostics_open)
+
+    def build_devices(self) -> None:
+        """(Re)build the device list and the scene buttons from the config."""
+        self.device_list.set_devices(self.config.devices, self.config.groups)
+        for device in self.config.devices:
+            state = self.view.get(device.ip)
+            if state is not None:
+                self.device_list.set_power(device.ip, is_on(state))
+
+        if self.frame_scenes is not None:
+            self.frame_scenes.destroy()
+            self.frame_scenes = None
+        if self.config.scenes:
+            self.frame_scenes = ttk.Labelframe(self.frame, text="Scenes", padding=5)
+            self.frame_scenes.grid(column=0, row=2, columnspan=2, sticky="ew", pady=10)
+            for column, name in enumerate(self.config.scenes):
+                btn = ttk.Button(
+                    self.frame_scenes,
+                    text=name,
+                    command=lambda name=name: self.scene_run(name),
+                    bootstyle="outline-info",  # type: ignore
                 )
-        return False
+                btn.grid(column=column % 3, row=column // 3, padx=5, pady=5)
+
+    def window_mapped(self, event) -> None:
+        # <Map> of the window and of each of its widgets
+        if event.widget is self.primary and not self.started:
+            self.started = True
+            # connections start once the first frame is drawn, the redraw is
+            # an idle task queued by the mapping: start on the next idle pass
+            self.primary.after_idle(self.primary.after_idle, self.devices_start)
+
+    def devices_start(self) -> None:
+        # optional modules, only imported when configured
+        if self.config.mqtt is not None:
+            from mqtt import transport_from_config
+
+            self.controller.mqtt = transport_from_config(self.state_cache, self.config)
+        for device in self.config.devices:
+            self.controller.connect(device)
+        self.poller.start(self.config.devices)
+        self.schedules_start()
+        self.telemetry_start()
+        if self.config.api:
+            from api import server_from_config
+
+            self.api = server_from_config(
+                self.controller,
+                self.scheduler,
+                None if self.telemetry is None else self.telemetry.store,
+            )
+        self.watcher = ConfigWatcher(
+            Path(BASE_PATH, IOT_JSON_FILE),
+            on_change=lambda config: self.engine.post(self.config_reloaded, config),
+            on_error=lambda e: self.engine.post(self.status_var.set, str(e)),
+        )
+        self.watcher.start()
+
+    def schedules_start(self) -> None:
+        # schedules of the config, or added through the HTTP API
+        if self.scheduler is not None or not (self.config.schedules or self.config.api):
+            return
+        from scheduler import Scheduler, state_path
+
+        self.scheduler = Scheduler(
+            self.controller,
+            state_path(Path(BASE_PATH, IOT_JSON_FILE)),
+            on_run=lambda name, results: self.engine.post(
+                self.schedule_done, name, results
+            ),
+        )
+        self.scheduler.start()
+
+    def telemetry_start(self) -> None:
+        # the interval follows the config, the retention is read once
+        if self.telemetry is not None or self.config.telemetry is None:
+            return
+        from telemetry import TelemetryCollector, store_from_config
+
+        self.telemetry = TelemetryCollector(
+            self.controller,
+            store_from_config(self.config, Path(BASE_PATH, IOT_JSON_FILE)),
+            on_error=lambda e: self.engine.post(
+                self.status_var.set, f"Telemetry not saved: {e}"
+            ),
+        )
+        self.telemetry.start()
+        if self.api is not None:
+            self.api.telemetry = self.telemetry.store
+
+    def schedule_done(self, name: str, results: dict) -> None:
+        failed = [device for device, error in results.items() if error is not None]
+        if failed:
+            self.status_var.set(f"Schedule {name}: {', '.join(failed)} failed")
+        else:
+            self.status_var.set(f"Schedule {name} ran")
+
+    def config_reloaded(self, config: Config) -> None:
+        diff = self.controller.reload(config)
+        self.config = config
+        if self.scheduler is not None:
+            self.scheduler.reload(config)
+        else:
+            self.schedules_start()
+        self.telemetry_start()
+        self.poller.set_devices(config.devices)
+        for device in diff.removed + [old for old, _ in diff.changed]:
+            app = self.settings_windows.pop(device.ip, None)
+            if app is not None and app.window_exists():
+                app.window_close()
+        self.build_devices()
+        self.status_var.set(
+            f"{IOT_JSON_FILE} reloaded: {len(diff.added)} added, "
+            f"{len(diff.removed)} removed, {len(diff.changed)} changed"
+        )
 
-    def yeelight_toggle(self, ip: str, confirm: bool = False) -> bool:
-        answer = True if not confirm else self.dialog_confirm()
+    def device_state_changed(self, ip: str, state: dict) -> None:
+        self.device_list.set_power(ip, is_on(state))
+
+    def device_available_changed(self, ip: str, available: bool) -> None:
+        self.device_list.set_available(ip, available)
+        if available:
+            self.poller.refresh(ip)
+
+    def scene_run(self, name: str) -> None:
+        confirm = any(device.confirm for device, _ in scene_settings(self.config, name))
+        if confirm and not self.dialog_confirm():
+            return
+        self.status_var.set(f"{name}: running...")
+        tokens = {
+            device.name: self.view.apply(
+                device.ip,
+                self.controller.expected_state(
+                    device, settings, self.view.get(device.ip)
+                ),
+            )
+            for device, settings in scene_settings(self.config, name)
+        }
+        self.scenes.run(
+            name, on_done=lambda results: self.scene_done(name, results, tokens)
+        )
+
+    def scene_done(self, name: str, results: dict, tokens: dict) -> None:
+        for device, _ in scene_settings(self.config, name):
+            error = results.get(device.name)
+            if device.name in tokens:
+                if error is None:
+                    # settled by the next poll
+                    self.view.settle(tokens[device.name], None)
+                else:
+                    self.view.rollback(tokens[device.name])
+            self.poller.refresh(device.ip)
+        skipped = [
+            device
+            for device, error in results.items()
+            if isinstance(error, DeviceUnavailableError)
+        ]
+        failed = [
+            device
+            for device, error in results.items()
+            if error is not None and device not in skipped
+        ]
+        self.status_var.set(
+            f"{name}: {len(results) - len(failed) - len(skipped)} ok, "
+            f"{len(failed)} failed, {len(skipped)} unreachable"
+        )
+        if failed:
+            self.dialog_error(
+                title="Scene Error",
+                message="Unable to reach:\n" + "\n".join(failed),
+            )
+
+    def device_toggle(self, device: Device) -> None:
+        def _done(reply: dict) -> None:
+            self.view.settle(token, reply)
+            # devices replying with their state already updated the cache
+            if not reply:
+                self.poller.refresh(device.ip)
+
+        def _error(e: Exception) -> None:
+            self.view.rollback(token)
+            if isinstance(e, DeviceUnavailableError):
+                # no dialog for a device already shown as down
+                self.status_var.set(f"{device.name}: unreachable")
+                return
+            self.dialog_error(
+                title="Toogle Error",
+                message="Unable to complete action.\n Please check if device is connect to network.",
+            )
+
+        answer = True if not device.confirm else self.dialog_confirm()
         if answer:
-            try:
-                bulb = Bulb(ip=ip)
-                bulb.toggle()
-                return True
-            except:
-                print("Failed to toggle Yeelight bulb")
-        return False
+            # shown as toggled right away, see optimistic.py
+            token = self.view.apply(
+                device.ip,
+                self.controller.expected_state(
+                    device, {"power": "toggle"}, self.view.get(device.ip)
+                ),
+            )
+            self.engine.submit(
+                self.controller.toggle, device, on_done=_done, on_error=_error
+            )
 
-    def window_yeelight_open(self, ip: str) -> None:
+    def window_settings_open(self, device: Device) -> None:
+        app = self.settings_windows.get(device.ip)
+        if app is not None and app.window_exists():
+            app.window_bring_to_front()
+            return
+        window_class = SETTINGS_WINDOWS[self.controller.driver(device).window]
         new_window = ttk.Toplevel(self.primary)
-        app = YeelightWindow(new_window, ip)
+        app = window_class(
+            new_window, device.ip, self.engine, self.controller, self.view
+        )
+        self.settings_windows[device.ip] = app
 
-    def window_tasmota_light_open(self, ip: str) -> None:
-        new_window = ttk.Toplevel(self.primary)
-        app = TasmotaLightWindow(new_window, ip)
+    def window_diagnostics_open(self, event=None) -> None:
+        if self.diagnostics is not None and self.diagnostics.window_exists():
+            self.diagnostics.window_bring_to_front()
+            return
+        # imported on first use, most sessions never open it
+        from diagnostics import DiagnosticsWindow
+
+        self.diagnostics = DiagnosticsWindow(ttk.Toplevel(self.primary))
 
     def window_close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        self.poller.stop()
+        if self.api is not None:
+            self.api.stop()
+        self.engine.shutdown()
+        self.view.close()
+        self.controller.close()
         self.primary.destroy()
 
     def window_center(self) -> None:
-        self.primary.update()
-        w = self.primary.winfo_width()
-        h = self.primary.winfo_height()
+        # geometry only, the window is drawn by the event loop
+        self.primary.update_idletasks()
+        w = max(self.primary.winfo_width(), self.primary.winfo_reqwidth())
+        h = max(self.primary.winfo_height(), self.primary.winfo_reqheight())
         ws = self.primary.winfo_screenwidth()
         hs = self.primary.winfo_screenheight()
         x = (ws / 2) - (w / 2)
@@ -207,6 +405,8 @@ class MainWindow:
         self.primary.geometry("+%d+%d" % (x, y))
 
     def dialog_confirm(self) -> bool:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
         result = Messagebox.okcancel(
             message="Toogle the device?", title="Confirm", parent=self.primary
         )
@@ -215,18 +415,34 @@ class MainWindow:
         return False
 
     def dialog_error(self, message: str, title: str = "Error") -> None:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
         Messagebox.show_error(message=message, title=title, parent=self.primary)
 
 
 class TasmotaLightWindow:
-    def __init__(self, primary, ip: str) -> None:
+    def __init__(
+        self,
+        primary,
+        ip: str,
+        engine: CommandEngine,
+        controller: Controller,
+        view: OptimisticState,
+    ) -> None:
         self.ip = ip
+        self.engine = engine
+        self.device = controller.device(ip)
+        self.controller = controller
+        self.state_cache = controller.cache
+        self.view = view
         self.is_on = False
         self.curr_color = None
         self.curr_state = {}
         self.dimmer_cmd_disabled = False
         self.ct_cmd_disabled = False
         self.using_rgb_channels = False
+        # panel and color on screen, widgets are only touched when these change
+        self.shown = {}
         self.primary = primary
         self.primary.title("Settings")
         self.primary.geometry("350x350")
@@ -234,9 +450,7 @@ class TasmotaLightWindow:
         self.primary.iconbitmap(Path(BASE_PATH, "resources", "window.ico"))
         self.primary.focus_set()
 
-        self.icon_color_picker = ttk.PhotoImage(
-            file=Path(BASE_PATH, "resources", "color_picker.png")
-        )
+        self.icon_color_picker = load_image("color_picker.png")
         self.frame = ttk.Labelframe(self.primary, text="Tasmota Light")
         self.frame.grid_columnconfigure(0, weight=2, minsize=200)
         self.frame.pack(fill="both", expand=1, padx=10, pady=10)
@@ -289,14 +503,58 @@ class TasmotaLightWindow:
         self.input_led_option_var.set("white")
 
         # ROW 4
-        # rbg frame or white/CT
-        self.input_ct_var = ttk.IntVar(master=self.primary)
+        # rbg frame or white/CT, both built once and shown in turn
         self.frame_rgb_or_ct = ttk.Frame(self.frame)
         self.frame_rgb_or_ct.columnconfigure(0, weight=1)
         self.frame_rgb_or_ct.grid(
             column=0, row=4, columnspan=2, sticky="ew", padx=0, pady=10
         )
 
+        #  White/CT widgets
+        self.frame_ct = ttk.Frame(self.frame_rgb_or_ct)
+        self.frame_ct.columnconfigure(0, weight=1)
+        self.frame_ct.grid(column=0, row=0, sticky="ew")
+        # row 0
+        l = ttk.Label(self.frame_ct, text="Color Temperature")
+        l.grid(column=0, row=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        # row 1
+        self.input_ct_var = ttk.IntVar(master=self.primary)
+        self.input_ct_field = ttk.Scale(
+            self.frame_ct,
+            variable=self.input_ct_var,
+            # tickinterval=1, missin from ttkbootstrap
+            value=0,
+            from_=round(153 / SLIDER_CT_MULTIPLIER) - 1,
+            to=round(500 / SLIDER_CT_MULTIPLIER) + 1,
+            orient=ttk.HORIZONTAL,
+            bootstyle="warning",  # type: ignore
+        )
+        self.input_ct_field.grid(
+            column=0, row=1, columnspan=2, sticky="ew", padx=10, pady=10
+        )
+
+        #  RGB color widgets
+        self.frame_rgb = ttk.Frame(self.frame_rgb_or_ct)
+        self.frame_rgb.columnconfigure(0, weight=1)
+        self.frame_rgb.grid(column=0, row=0, sticky="ew")
+        # row 0
+        l = ttk.Label(self.frame_rgb, text="Color")
+        l.grid(column=0, row=0, sticky="ew", padx=5, pady=5)
+        # row 1
+        self.rgb_color_canvas = ttk.Canvas(
+            self.frame_rgb, width=200, height=40, bg="#FFFFFF"
+        )
+        self.rgb_color_canvas.grid(column=0, row=1, sticky="ew", padx=20, pady=10)
+        b = ttk.Button(
+            self.frame_rgb,
+            text=f"pick",
+            command=self.window_color_chooser_open,
+            image=self.icon_color_picker,
+            bootstyle="link-light",  # type: ignore
+        )
+        b.grid(column=1, row=1, sticky="ew", padx=5, pady=10)
+        self.frame_rgb.grid_remove()
+
         # ROW 5
         # close button
         b = ttk.Button(self.frame, text="Close Window", command=self.window_close)
@@ -308,95 +566,67 @@ class TasmotaLightWindow:
         self.setup_bulb_props()
 
     def setup_bulb_props(self) -> None:
-        try:
-            self.get_device_state()
-            self.toggle_frame_rgb_or_ct()
-            self.update_gui()
-            self.input_dimmer_field["command"] = self.change_dimmer
-            self.input_ct_field["command"] = self.change_ct
-            self.is_on = True
-        except Exception as e:
-            self.is_on = False
+        cached = self.view.get(self.ip)
+        if cached is not None and "Dimmer" in cached:
+            # opened from the poller cache, no round-trip to the device
+            self.curr_state = cached
+            self.using_rgb_channels = cached.get("HSBColor", "0,0,0") != "0,0,0"
+            self.setup_bulb_props_done()
+            return
+        self.get_device_state(
+            on_done=self.setup_bulb_props_done, on_error=self.setup_bulb_props_error
+        )
+
+    def setup_bulb_props_done(self) -> None:
+        self.toggle_frame_rgb_or_ct()
+        self.update_gui()
+        self.input_dimmer_field["command"] = self.change_dimmer
+        self.input_ct_field["command"] = self.change_ct
+        self.is_on = True
+
+    def setup_bulb_props_error(self, e: BaseException) -> None:
+        self.is_on = False
+        if self.window_exists():
             self.dialog_error(
                 title="Error",
                 message=f"{e}",
             )
 
     def update_gui(self):
+        """Bring the widgets to ``curr_state``, only those whose value changed."""
         self.dimmer_cmd_disabled = True
         self.ct_cmd_disabled = True
 
-        self.input_dimmer_var.set(
-            int(self.curr_state["Dimmer"] / SLIDER_DIMMER_MULTIPLIER)
-        )
-        self.input_dimmer_field.set(
-            int(self.curr_state["Dimmer"] / SLIDER_DIMMER_MULTIPLIER)
-        )
-        self.input_ct_var.set(int(self.curr_state["CT"] / SLIDER_CT_MULTIPLIER))
-        self.input_ct_field.set(int(self.curr_state["CT"] / SLIDER_CT_MULTIPLIER))
-        if self.curr_state["HSBColor"] == "0,0,0":
-            self.using_rgb_channels = False
-            self.input_led_option_var.set("white")
-        else:
-            self.using_rgb_channels = True
-            self.input_led_option_var.set("rgb")
-            self.toggle_frame_rgb_or_ct()
-            self.rgb_color_canvas.config(bg=self.hsv2rgb(self.curr_state["HSBColor"]))
+        # the sliders move without telling, compare with what they show
+        dimmer = int(self.curr_state["Dimmer"] / SLIDER_DIMMER_MULTIPLIER)
+        if self.input_dimmer_var.get() != dimmer:
+            self.input_dimmer_var.set(dimmer)
+        ct = int(self.curr_state["CT"] / SLIDER_CT_MULTIPLIER)
+        if self.input_ct_var.get() != ct:
+            self.input_ct_var.set(ct)
+        self.using_rgb_channels = self.curr_state["HSBColor"] != "0,0,0"
+        self.toggle_frame_rgb_or_ct()
         self.dimmer_cmd_disabled = False
         self.ct_cmd_disabled = False
 
     def toggle_frame_rgb_or_ct(self):
-        for widgets in self.frame_rgb_or_ct.winfo_children():
-            widgets.destroy()
-        #  White/CT widgets
-        if not self.using_rgb_channels:
-            # row 0
-            l = ttk.Label(self.frame_rgb_or_ct, text="Color Temperature")
-            l.grid(column=0, row=0, columnspan=2, sticky="ew", padx=5, pady=5)
-            # row 1
-            min_v = round(153 / SLIDER_CT_MULTIPLIER) - 1
-            max_v = round(500 / SLIDER_CT_MULTIPLIER) + 1
-            self.input_ct_field = ttk.Scale(
-                self.frame_rgb_or_ct,
-                variable=self.input_ct_var,
-                # tickinterval=1, missin from ttkbootstrap
-                value=0,
-                from_=min_v,
-                to=max_v,
-                orient=ttk.HORIZONTAL,
-                bootstyle="warning",  # type: ignore
-            )
-            self.input_ct_field.grid(
-                column=0, row=1, columnspan=2, sticky="ew", padx=10, pady=10
-            )
-        #  RGB color widget
-        else:
-            # row 0
-            l = ttk.Label(self.frame_rgb_or_ct, text="Color")
-            l.grid(column=0, row=0, sticky="ew", padx=5, pady=5)
-
-            self.rgb_color_canvas = ttk.Canvas(
-                self.frame_rgb_or_ct,
-                width=200,
-                height=40,
-            )
-            # row 1
-            self.rgb_color_canvas.grid(column=0, row=1, sticky="ew", padx=20, pady=10)
-            if self.curr_state["HSBColor"] != "0,0,0":
-                self.rgb_color_canvas.config(
-                    bg=self.hsv2rgb(self.curr_state["HSBColor"])
-                )
+        """Show the RGB or the white/CT panel, as ``using_rgb_channels`` tells."""
+        option = "rgb" if self.using_rgb_channels else "white"
+        if self.shown.get("option") != option:
+            self.input_led_option_var.set(option)
+            if self.using_rgb_channels:
+                self.frame_ct.grid_remove()
+                self.frame_rgb.grid()
             else:
-                self.rgb_color_canvas.config(bg="#FFFFFF")
-
-            b = ttk.Button(
-                self.frame_rgb_or_ct,
-                text=f"pick",
-                command=self.window_color_chooser_open,
-                image=self.icon_color_picker,
-                bootstyle="link-light",  # type: ignore
+                self.frame_rgb.grid_remove()
+                self.frame_ct.grid()
+            self.shown["option"] = option
+        color = self.curr_state.get("HSBColor", "0,0,0")
+        if self.using_rgb_channels and self.shown.get("HSBColor") != color:
+            self.rgb_color_canvas.config(
+                bg=self.hsv2rgb(color) if color != "0,0,0" else "#FFFFFF"
             )
-            b.grid(column=1, row=1, sticky="ew", padx=5, pady=10)
+            self.shown["HSBColor"] = color
 
     def check_radio_option(self):
         opt = self.input_led_option_var.get()
@@ -406,22 +636,27 @@ class TasmotaLightWindow:
             self.using_rgb_channels = True
         else:
             self.using_rgb_channels = False
-            self.send_cmd(cmnd="Color 0000008000")
+            self.send_cmd(cmnd=Backlog.white(cold=0x80))
             self.input_dimmer_var.set(int(50 / SLIDER_DIMMER_MULTIPLIER))
-            self.input_dimmer_field.set(int(50 / SLIDER_DIMMER_MULTIPLIER))
         self.toggle_frame_rgb_or_ct()
         self.dimmer_cmd_disabled = False
         self.ct_cmd_disabled = False
 
-    def send_cmd(self, cmnd: str) -> None:
+    def send_cmd(
+        self, cmnd: str | Backlog, on_done=None, on_error=None, key=None, expected=None
+    ) -> None:
         """
-        Send web request to device.
+        Queue a web request to the device on the command engine.
             http://device_ip/cm?cmnd={cmnd}
 
+        The reply is merged into ``curr_state`` once it arrives, then
+        ``on_done`` is called. Nothing blocks the Tk event loop meanwhile.
+
         Parameters
         ----------
-        cmnd : str
-            The command to be attached to Web Request
+        cmnd : str or Backlog
+            The command to be attached to Web Request. Use a Backlog to send
+            several commands in a single round-trip.
 
             e.g.:
                 Dimmer 10
@@ -430,81 +665,113 @@ class TasmotaLightWindow:
 
                 HSBColor 250,55,44
 
+        on_done : callable, optional
+            Called without arguments after ``curr_state`` was updated.
+
+        on_error : callable, optional
+            Called with the exception. Defaults to an error dialog.
+
+        key : str, optional
+            Coalescing key for slider commands, e.g. "Dimmer". A newer
+            command with the same key replaces this one if it was not sent yet.
+
+        expected : dict, optional
+            Values the reply should carry, e.g. {"Dimmer": 40}. They are
+            shown at once (see optimistic.py); if the device replies other
+            values or fails, the window goes back to the device state.
+
         """
-        try:
-            print("cmnd =", cmnd)
-            url = f"http://{self.ip}/cm?cmnd={cmnd}"
-            r = requests.get(url=url, timeout=4, verify=False)
-            if r.status_code == 200:
-                state = r.json()
-                self.curr_state = state
-                print("state: ", state)
-                return
-            else:
-                raise ResponseCodeError()
-        except requests.exceptions.Timeout:
-            raise ConnectionError("Connection Time out")
-        except requests.exceptions.TooManyRedirects:
-            raise ConnectionError("Connection Too Many Redirects")
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
-        except ResponseCodeError:
-            raise ResponseCodeError("Got Wrong responde code from device")
-        except:
-            raise RequestError("Unknow Request Error")
-
-    def get_device_state(self) -> None:
-        self.send_cmd(cmnd="STATE")
-        if (
-            self.curr_state.get("HSBColor") is not None
-            and self.curr_state.get("HSBColor") != "0,0,0"
-        ):
-            self.using_rgb_channels = True
+        token = None
+        if expected:
+            token = self.view.apply(self.ip, expected)
+            self.curr_state.update(expected)
+
+        def _done(state: dict) -> None:
+            agreed = token is None or self.view.settle(token, state)
+            merge_reply(self.curr_state, state)
+            self.state_cache.update(self.ip, self.curr_state)
+            if not agreed and self.window_exists():
+                self.update_gui()
+            if on_done is not None and self.window_exists():
+                on_done()
+
+        def _error(e: BaseException) -> None:
+            if token is not None:
+                self.view.rollback(token)
+                self.curr_state = self.view.get(self.ip) or self.curr_state
+                if self.window_exists() and "Dimmer" in self.curr_state:
+                    self.update_gui()
+            (on_error or self.cmd_error)(e)
+
+        if key is None:
+            self.engine.submit(
+                self.controller.command,
+                self.device,
+                cmnd,
+                on_done=_done,
+                on_error=_error,
+            )
+        else:
+            self.engine.submit_latest(
+                (self.ip, key),
+                self.controller.command,
+                self.device,
+                cmnd,
+                on_done=_done,
+                on_error=_error,
+                min_interval=SLIDER_TASMOTA_MIN_INTERVAL,
+            )
+
+    def cmd_error(self, e: BaseException) -> None:
+        if self.window_exists():
+            self.dialog_error(
+                title="Error",
+                message=f"Code: {e} \n Unable to complete action.\n Please check if device is connect to network.",
+            )
+
+    def get_device_state(self, on_done=None, on_error=None) -> None:
+        def _done() -> None:
+            if (
+                self.curr_state.get("HSBColor") is not None
+                and self.curr_state.get("HSBColor") != "0,0,0"
+            ):
+                self.using_rgb_channels = True
+            if on_done is not None:
+                on_done()
+
+        self.send_cmd(cmnd="STATE", on_done=_done, on_error=on_error)
 
     def change_dimmer(self, value) -> None:
         if self.is_on and not self.dimmer_cmd_disabled:
-            try:
-                # 0..100 = set dimmer value from 0 to 100%
-                dv = round(SLIDER_DIMMER_MULTIPLIER * self.input_dimmer_var.get())
-                val = self.clamp(value=dv, minx=0, maxx=100)
-                if self.curr_state["Dimmer"] != val:
-                    self.send_cmd(cmnd=f"Dimmer {val}")
-            except Exception as e:
-                self.dialog_error(
-                    title="Error",
-                    message="Code: {e} \n Unable to complete action.\n Please check if device is connect to network.",
+            # 0..100 = set dimmer value from 0 to 100%
+            dv = round(SLIDER_DIMMER_MULTIPLIER * self.input_dimmer_var.get())
+            val = self.clamp(value=dv, minx=0, maxx=100)
+            if self.curr_state["Dimmer"] != val:
+                self.send_cmd(
+                    cmnd=f"Dimmer {val}", key="Dimmer", expected={"Dimmer": val}
                 )
 
     def change_ct(self, value) -> None:
         if self.is_on and not self.ct_cmd_disabled:
-            try:
-                # set CT value from 153 to 500
-                dv = round(SLIDER_CT_MULTIPLIER * self.input_ct_var.get())
-                val = self.clamp(value=dv, minx=153, maxx=500)
-                # if abs(self.curr_state["CT"] - val) > 50:
-                if self.curr_state["CT"] != val:
-                    self.send_cmd(cmnd=f"CT {val}")
-            except Exception as e:
-                self.dialog_error(
-                    title="Error",
-                    message="Code: {e} \n Unable to complete action.\n Please check if device is connect to network.",
-                )
+            # set CT value from 153 to 500
+            dv = round(SLIDER_CT_MULTIPLIER * self.input_ct_var.get())
+            val = self.clamp(value=dv, minx=153, maxx=500)
+            # if abs(self.curr_state["CT"] - val) > 50:
+            if self.curr_state["CT"] != val:
+                self.send_cmd(cmnd=f"CT {val}", key="CT", expected={"CT": val})
 
     def change_rgb_channel(self, rgb_str: str) -> None:
         if self.is_on:
-            try:
-                # Reset all channels to zero to avoid any chance to bulb damaged
-                self.send_cmd(cmnd=f"Color 0000000000")
-                # Set color using HSBColor parameter
-                h, s, v = self.rgb2hsv(rgb_str)
-                self.send_cmd(cmnd=f"HSBColor {h},{s},{v}")
-            except Exception as e:
-                self.dialog_error(
-                    title="Error",
-                    message="Code: {e} \n Unable to complete action.\n Please check if device is connect to network.",
-                )
+            h, s, v = self.rgb2hsv(rgb_str)
+            # Reset all channels to zero to avoid any chance to bulb damaged,
+            # then set color using HSBColor parameter, in one request.
+            self.send_cmd(
+                cmnd=Backlog.rgb_color(h, s, v), expected={"HSBColor": f"{h},{s},{v}"}
+            )
 
     def dialog_confirm(self) -> bool:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
         result = Messagebox.okcancel(
             message="Confirm action?", title="Confirm", parent=self.primary
         )
@@ -513,6 +780,8 @@ class TasmotaLightWindow:
         return False
 
     def window_color_chooser_open(self) -> None:
+        from ttkbootstrap.dialogs.colorchooser import ColorChooserDialog
+
         cd = ColorChooserDialog()
         if self.curr_state["HSBColor"] != "0,0,0":
             cd.initialcolor = self.hsv2rgb(self.curr_state["HSBColor"])
@@ -526,16 +795,24 @@ class TasmotaLightWindow:
             # HSV(HSB) not available
             self.change_rgb_channel(rgb_str=colors.hex)
             self.color = colors.hex
-            self.rgb_color_canvas.config(bg=colors.hex)
             self.using_rgb_channels = True
+            self.toggle_frame_rgb_or_ct()
+            self.rgb_color_canvas.config(bg=colors.hex)
 
     def window_close(self, event=None) -> None:
         self.primary.destroy()
 
+    def window_exists(self) -> bool:
+        try:
+            return bool(self.primary.winfo_exists())
+        except TclError:
+            return False
+
     def window_center(self) -> None:
-        self.primary.update()
-        w = self.primary.winfo_width()
-        h = self.primary.winfo_height()
+        # geometry only, the window is drawn by the event loop
+        self.primary.update_idletasks()
+        w = max(self.primary.winfo_width(), self.primary.winfo_reqwidth())
+        h = max(self.primary.winfo_height(), self.primary.winfo_reqheight())
         ws = self.primary.winfo_screenwidth()
         hs = self.primary.winfo_screenheight()
         x = (ws / 2) - (w / 2)
@@ -547,143 +824,33 @@ class TasmotaLightWindow:
         self.primary.attributes("-topmost", 0)
 
     def dialog_error(self, message: str, title: str = "Error") -> None:
-        Messagebox.show_error(message=message, title=title, parent=self.primary)
-
-    @staticmethod
-    def clamp(value: int | float, minx: int | float, maxx: int | float) -> int | float:
-        """
-        Constrain a value between a minimum and a maximum.
-            If the value is larger than the maximum or lower than the minimum, the
-            maximum or minimum will be returned instead.
-
-        Parameters
-        ----------
-        value : int or float
-            The value to clamp.
-
-        minx: int or float
-            Lower limit the value can take.
+        from ttkbootstrap.dialogs.dialogs import Messagebox
 
-        maxx: int or float
-            Upper limit the value can take.
-
-        Returns
-        ----------
-        int or float
-            If initial value > max_value, return celing value max_value
-
-        """
-        return max(minx, min(maxx, value))
-
-    @staticmethod
-    def hsv2rgb(hsb_str: str) -> str:
-        """
-        Convert a HSB|HSV from tasmosta light to rgb
-
-        Parameters
-        ----------
-        hsb_str : str
-            From HSB, aka HSV, value
-            e.g. 245,97,97
-
-        Returns
-        ----------
-        str
-            A rgb string
-            e.g.: #1b07f7
-
-        https://en.wikipedia.org/wiki/HSL_and_HSV
-        """
-
-        def _clamp(value: float, minx: int, maxx: int):
-            return max(minx, min(maxx, round(value)))
-
-        hsb_str = hsb_str.strip()
-        # re.match() method only checks if the RE matches at the start of a string, start() will always be zero.
-        # The "^" is already set
-        # https://regex101.com/
-        if (
-            bool(
-                re.match(
-                    r"^(3[0-5][0-9]|[12][0-9][0-9]|[1-9][0-9]|[0-9]),(100|[1-9][0-9]|[0-9]),(100|[1-9][0-9]|[0-9])$",
-                    hsb_str,
-                )
-            )
-            is not True
-        ):
-            return "#000000"
-
-        hsb = hsb_str.split(",")
-        # convert 0..359|0..100 to 0..1
-        hue = int(hsb[0]) / 359
-        sat = int(hsb[1]) / 100
-        val = int(hsb[2]) / 100
-        r, g, b = colorsys.hsv_to_rgb(hue, sat, val)
-        # convert 0..1 to 0..255
-        red = r * 255
-        green = g * 255
-        blue = b * 255
-
-        return "#%02x%02x%02x" % (
-            _clamp(red, 0, 255),
-            _clamp(green, 0, 255),
-            _clamp(blue, 0, 255),
-        )
-
-    @staticmethod
-    def rgb2hsv(rgbhex: str) -> tuple:
-        """
-        Convert RGB (#1b07f7) to HSB, aka HSV, in tuple (245,97,97)
-
-        Parameters
-        ----------
-        rgbhex : str
-            The rgb color
-            eg: #1b07f7 or 1b07f7
-
-        Returns
-        ----------
-        tuple
-            A tuple of values (hue, saturation, value)
-            eg: (245,97,97)
-
-        https://en.wikipedia.org/wiki/HSL_and_HSV
-        """
+        Messagebox.show_error(message=message, title=title, parent=self.primary)
 
-        def _clamp(value: float, minx: int, maxx: int):
-            return max(minx, min(maxx, round(value)))
-
-        rgbhex = rgbhex.strip()
-        # re.match() method only checks if the RE matches at the start of a string, start() will always be zero.
-        # The "^" is already set
-        if (
-            bool(re.match(r"^(#|)([a-fA-F0-9]{6}|([0-9a-fA-F]){3})$", rgbhex))
-            is not True
-        ):
-            return (0, 0, 0)
-
-        hex = rgbhex.replace("#", "")
-        r, g, b = tuple(int(hex[i : i + 2], 16) for i in (0, 2, 4))
-        # convert 0..255 to 0..1
-        red = r / 255
-        green = g / 255
-        blue = b / 255
-        h, s, v = colorsys.rgb_to_hsv(red, green, blue)
-        # convert 0..1 to 0..359|0..100
-        hue = h * 359
-        sat = s * 100
-        val = v * 100
-
-        return (_clamp(hue, 0, 359), _clamp(sat, 0, 100), _clamp(val, 0, 100))
+    clamp = staticmethod(clamp)
+    hsv2rgb = staticmethod(hsv2rgb)
+    rgb2hsv = staticmethod(rgb2hsv)
 
 
 class YeelightWindow:
-    def __init__(self, primary, ip: str) -> None:
+    def __init__(
+        self,
+        primary,
+        ip: str,
+        engine: CommandEngine,
+        controller: Controller,
+        view: OptimisticState,
+    ) -> None:
         self.bulb_ip = ip
         self.bulb_is_on = False
         self.bulb_rgb = ""
         self.bulb_brightness = 0
-        self.bulb = Bulb(ip=self.bulb_ip)
+        self.device = controller.device(ip)
+        self.controller = controller
+        self.engine = engine
+        self.state_cache = controller.cache
+        self.view = view
 
         self.primary = primary
         self.primary.title("Settings")
@@ -692,9 +859,7 @@ class YeelightWindow:
         self.primary.iconbitmap(Path(BASE_PATH, "resources", "window.ico"))
         self.primary.focus_set()
 
-        self.icon_color_picker = ttk.PhotoImage(
-            file=Path(BASE_PATH, "resources", "color_picker.png")
-        )
+        self.icon_color_picker = load_image("color_picker.png")
         self.frame = ttk.Labelframe(self.primary, text="Yeelight")
         self.frame.grid_columnconfigure(0, weight=1, minsize=200)
         self.frame.pack(fill="both", expand=1, padx=10, pady=10)
@@ -743,24 +908,52 @@ class YeelightWindow:
         self.get_bulb_props()
 
     def get_bulb_props(self) -> None:
-        try:
-            props = self.bulb.get_properties()
-            hex_rgb = self._rgbint_to_rgbhex(props["rgb"])
-            self.input_brightness_var = props["bright"]
-            self.input_brightness_field.set(props["bright"])
-            self.rgb_color_canvas.config(bg=hex_rgb)
-            self.bulb_color = hex_rgb
-            self.bulb_brightness = int(float(props["bright"]))
-            self.bulb_is_on = True
-        except:
-            self.bulb_is_on = False
+        self.bulb_is_on = False
+        cached = self.view.get(self.bulb_ip)
+        if cached is not None and "bright" in cached:
+            # opened from the poller cache, no round-trip to the bulb
+            self.set_bulb_props(cached)
+            return
+        self.engine.submit(
+            self.controller.get_state,
+            self.device,
+            on_done=self.set_bulb_props,
+        )
+
+    def set_bulb_props(self, props: dict) -> None:
+        if not self.window_exists():
+            return
+        self.state_cache.update(self.bulb_ip, props)
+        hex_rgb = self._rgbint_to_rgbhex(props["rgb"])
+        self.input_brightness_var.set(int(props["bright"]))
+        self.input_brightness_field.set(props["bright"])
+        self.rgb_color_canvas.config(bg=hex_rgb)
+        self.bulb_color = hex_rgb
+        self.bulb_brightness = int(float(props["bright"]))
+        self.bulb_is_on = True
 
     def change_brightness(self, value) -> None:
         if self.bulb_is_on:
             brightness = int(float(value))
-            self.bulb.set_brightness(brightness)
+            # confirmed by the notification of the bulb, see optimistic.py
+            token = self.view.apply(self.bulb_ip, {"bright": str(brightness)})
+            self.engine.submit_latest(
+                (self.bulb_ip, "bright"),
+                self._set_brightness,
+                brightness,
+                on_done=lambda _: self.view.settle(token, None),
+                on_error=lambda e: self.view.rollback(token),
+                min_interval=SLIDER_YEELIGHT_MIN_INTERVAL,
+            )
+
+    def _set_brightness(self, brightness: int) -> None:
+        self.controller.command(
+            self.device, ("set_brightness", brightness), True  # continuous
+        )
 
     def dialog_confirm(self) -> bool:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
         result = Messagebox.okcancel(
             message="Confirm action?", title="Confirm", parent=self.primary
         )
@@ -769,6 +962,8 @@ class YeelightWindow:
         return False
 
     def window_color_chooser_open(self) -> None:
+        from ttkbootstrap.dialogs.colorchooser import ColorChooserDialog
+
         cd = ColorChooserDialog()
         cd.initialcolor = self.bulb_color
         cd.show()
@@ -776,17 +971,26 @@ class YeelightWindow:
 
         if cd.result:
             colors = cd.result
-            self.bulb.set_rgb(colors.rgb[0], colors.rgb[1], colors.rgb[2])
+            self.engine.submit(
+                self.controller.command, self.device, ("set_rgb", *colors.rgb[:3])
+            )
             self.bulb_color = colors.hex
             self.rgb_color_canvas.config(bg=colors.hex)
 
     def window_close(self, event=None) -> None:
         self.primary.destroy()
 
+    def window_exists(self) -> bool:
+        try:
+            return bool(self.primary.winfo_exists())
+        except TclError:
+            return False
+
     def window_center(self) -> None:
-        self.primary.update()
-        w = self.primary.winfo_width()
-        h = self.primary.winfo_height()
+        # geometry only, the window is drawn by the event loop
+        self.primary.update_idletasks()
+        w = max(self.primary.winfo_width(), self.primary.winfo_reqwidth())
+        h = max(self.primary.winfo_height(), self.primary.winfo_reqheight())
         ws = self.primary.winfo_screenwidth()
         hs = self.primary.winfo_screenheight()
         x = (ws / 2) - (w / 2)
@@ -798,6 +1002,8 @@ class YeelightWindow:
         self.primary.attributes("-topmost", 0)
 
     def dialog_error(self, message: str, title: str = "Error") -> None:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
         Messagebox.show_error(message=message, title=title, parent=self.primary)
 
     @staticmethod
@@ -819,12 +1025,46 @@ class YeelightWindow:
         return "#%02x%02x%02x" % (r, g, b)
 
 
-def main():
+# settings window of each Driver.window
+SETTINGS_WINDOWS = {
+    "tasmota-light": TasmotaLightWindow,
+    "yeelight": YeelightWindow,
+}
 
+
+def main():
+    logging.basicConfig(
+        level=os.environ.get(LOG_LEVEL_ENV, "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
     root = ttk.Window()
-    app = MainWindow(root)
+    try:
+        app = MainWindow(root)
+    except ConfigError as e:
+        from ttkbootstrap.dialogs.dialogs import Messagebox
+
+        Messagebox.show_error(message=str(e), title="Configuration Error")
+        root.destroy()
+        return
+    if os.environ.get(STARTUP_BENCHMARK_ENV):
+        startup_benchmark_hook(app)
     root.mainloop()
 
 
+def startup_benchmark_hook(app: MainWindow) -> None:
+    """Print "first-frame" once the mapped window was redrawn, then close it."""
+
+    def _mapped(event) -> None:
+        if event.widget is app.primary:
+            # runs after the redraw, before MainWindow.devices_start
+            app.primary.after_idle(_drawn)
+
+    def _drawn() -> None:
+        print("first-frame", flush=True)
+        app.window_close()
+
+    app.primary.bind("<Map>", _mapped, add="+")
+
+
 if __name__ == "__main__":
     main()
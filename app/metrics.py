@@ -0,0 +1,200 @@
+import bisect
+import threading
+from typing import Optional
+
+"""
+Metrics of the device operations.
+
+A single in-process registry, ``metrics``, filled on the hot path by the
+controller, the command engine and the HTTP clients, and read by the
+Prometheus endpoint of the HTTP API (GET /metrics) and the diagnostics window.
+Recording a value is a dict lookup and a bisect under a lock, no allocation
+once the label set exists.
+
+    iot_operation_seconds{device, operation}   controller operations
+    iot_phase_seconds{phase}                   where the time of a command goes:
+        queue       waiting for a worker of the command engine
+        connect     name resolution and TCP connect (or keep-alive pool wait)
+        device      request sent to reply received
+        dispatch    reply waiting for the Tk thread
+    iot_operations_total{device, operation, result}    ok, error or unavailable
+    iot_engine_queued, iot_engine_in_flight    commands of the command engine
+    iot_results_queued                         results waiting for the Tk thread
+    iot_effect_frames_total{result}            sent, dropped (device late) or error
+    iot_schedule_runs_total{result}            ok or error
+    iot_telemetry_samples_total{result}        ok, late (previous read not done)
+                                               or error
+
+    metrics.observe(OPERATION_SECONDS, 0.12, device="Plug", operation="toggle")
+    metrics.render()  ->  text exposition format
+
+"""
+
+
+OPERATION_SECONDS = "iot_operation_seconds"
+PHASE_SECONDS = "iot_phase_seconds"
+OPERATIONS_TOTAL = "iot_operations_total"
+ENGINE_QUEUED = "iot_engine_queued"
+ENGINE_IN_FLIGHT = "iot_engine_in_flight"
+RESULTS_QUEUED = "iot_results_queued"
+EFFECT_FRAMES_TOTAL = "iot_effect_frames_total"
+SCHEDULE_RUNS_TOTAL = "iot_schedule_runs_total"
+TELEMETRY_SAMPLES_TOTAL = "iot_telemetry_samples_total"
+# name: (type, help)
+DESCRIPTIONS = {
+    OPERATION_SECONDS: ("histogram", "Duration of the device operations."),
+    PHASE_SECONDS: ("histogram", "Duration of the phases of the device commands."),
+    OPERATIONS_TOTAL: ("counter", "Device operations by result."),
+    ENGINE_QUEUED: ("gauge", "Commands waiting for a worker of the engine."),
+    ENGINE_IN_FLIGHT: ("gauge", "Commands running on the engine."),
+    RESULTS_QUEUED: ("gauge", "Results waiting for the Tk thread."),
+    EFFECT_FRAMES_TOTAL: ("counter", "Effect frames sent, dropped or failed."),
+    SCHEDULE_RUNS_TOTAL: ("counter", "Scheduled runs by result."),
+    TELEMETRY_SAMPLES_TOTAL: ("counter", "Energy samples by result."),
+}
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        # the last one counts the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate, interpolated inside the bucket holding the quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # name: {labels: value}, labels being a sorted tuple of (key, value)
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge_add(self, name: str, delta: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + delta
+
+    def gauge_set(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def histograms(self, name: str) -> dict:
+        """Copy of the histograms of a metric, {labels dict as tuple: Histogram}."""
+        with self._lock:
+            return {
+                key: histogram.copy()
+                for key, histogram in self._histograms.get(name, {}).items()
+            }
+
+    def counters(self, name: str) -> dict:
+        """Copy of the values of a counter, {labels dict as tuple: value}."""
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter or gauge, 0 when never set."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            for kind in (self._gauges, self._counters):
+                if name in kind:
+                    return kind[name].get(key, 0)
+        return 0
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            names = sorted({*self._histograms, *self._counters, *self._gauges})
+            for name in names:
+                kind, text = DESCRIPTIONS.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, histogram in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, count in zip(
+                        (*histogram.buckets, "+Inf"), histogram.counts
+                    ):
+                        cumulative += count
+                        le = ("le", bound if bound == "+Inf" else f"{bound:g}")
+                        lines.append(f"{name}_bucket{_labels((*key, le))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+                for series in (self._counters, self._gauges):
+                    for key, value in sorted(series.get(name, {}).items()):
+                        lines.append(f"{name}{_labels(key)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in key
+    )
+    return "{" + pairs + "}"
+
+
+# registry shared by the whole process
+metrics = Metrics()
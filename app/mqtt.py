@@ -0,0 +1,186 @@
+import json
+import threading
+from typing import Optional
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:  # optional dependency: pip install paho-mqtt
+    paho = None
+
+from config import Config
+from state import StateCache
+
+"""
+Optional MQTT transport for Tasmota devices.
+
+Tasmota publishes its state on the broker by itself: every command result on
+``stat/<topic>/RESULT``, power changes on ``stat/<topic>/POWER`` and a periodic
+``tele/<topic>/STATE``. Devices with a "topic" in iot_devices.json are kept up
+to date from those messages instead of being polled, and their commands are
+published on ``cmnd/<topic>/<command>``.
+
+    "iot": {
+        "mqtt": {"host": "192.168.15.10", "port": 1883},
+        "devices": [
+            {"type": "tasmota-plug", "name": "Plug", "ip": "192.168.15.41",
+             "topic": "tasmota_A1B2C3", "confirm": false}
+        ]
+    }
+
+https://tasmota.github.io/docs/MQTT/
+"""
+
+
+MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60
+# tele/ messages come every TelePeriod (300 seconds by default), the LWT
+# tells when a device goes offline before its entry expires
+MQTT_STATE_TTL = 900.0
+SUBSCRIPTIONS = ("stat/+/RESULT", "stat/+/POWER", "tele/+/STATE", "tele/+/LWT")
+
+
+class MqttUnavailableError(Exception):
+    pass
+
+
+class MqttTransport:
+    def __init__(
+        self,
+        cache: StateCache,
+        host: str,
+        port: int = MQTT_PORT,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        client_id: str = "",
+    ) -> None:
+        if paho is None:
+            raise MqttUnavailableError("paho-mqtt is not installed")
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self._topics = {}
+        self._ips = {}
+        self._lock = threading.Lock()
+        self.connected = threading.Event()
+        if hasattr(paho, "CallbackAPIVersion"):
+            # paho-mqtt >= 2.0, the callbacks take the 1.x arguments too
+            self._client = paho.Client(
+                paho.CallbackAPIVersion.VERSION2, client_id=client_id
+            )
+        else:
+            self._client = paho.Client(client_id=client_id)
+        if username:
+            self._client.username_pw_set(username, password)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+
+    def add_device(self, ip: str, topic: str) -> None:
+        with self._lock:
+            self._topics[topic] = ip
+            self._ips[ip] = topic
+        if self.connected.is_set():
+            self.send(ip, "STATE")
+
+    def remove_device(self, ip: str) -> None:
+        with self._lock:
+            topic = self._ips.pop(ip, None)
+            self._topics.pop(topic, None)
+
+    def has(self, ip: str) -> bool:
+        """The device is reachable through the broker."""
+        return ip in self._ips and self.connected.is_set()
+
+    def start(self) -> None:
+        """Connect in the background, reconnecting automatically."""
+        self._client.connect_async(self.host, self.port, MQTT_KEEPALIVE)
+        self._client.loop_start()
+
+    def stop(self) -> None:
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def send(self, ip: str, cmnd) -> None:
+        """
+        Publish a command for a device, the result arrives in the cache.
+
+        Parameters
+        ----------
+        ip : str
+            Address of the device, as in iot_devices.json.
+
+        cmnd : str or Backlog
+            The Tasmota command, e.g. "Dimmer 10".
+
+        """
+        topic = self._ips[ip]
+        command, _, payload = str(cmnd).partition(" ")
+        info = self._client.publish(f"cmnd/{topic}/{command}", payload)
+        if info.rc != 0:
+            raise ConnectionError(f"MQTT publish failed ({info.rc})")
+
+    def _on_connect(
+        self, client, userdata, flags, reason_code, properties=None
+    ) -> None:
+        # reason_code: a ReasonCode with paho-mqtt 2.x, an int with 1.x
+        if reason_code != 0:
+            return
+        for subscription in SUBSCRIPTIONS:
+            client.subscribe(subscription)
+        self.connected.set()
+        # messages are only published on change, ask every device once
+        with self._lock:
+            topics = list(self._topics)
+        for topic in topics:
+            client.publish(f"cmnd/{topic}/STATE", "")
+
+    def _on_disconnect(self, client, userdata, *args) -> None:
+        # (rc) with paho-mqtt 1.x, (flags, reason_code, properties) with 2.x
+        self.connected.clear()
+
+    def _on_message(self, client, userdata, message) -> None:
+        parts = message.topic.split("/")
+        if len(parts) != 3:
+            return
+        prefix, topic, name = parts
+        ip = self._topics.get(topic)
+        if ip is None:
+            return
+        payload = message.payload.decode("utf8", errors="replace")
+        if name == "LWT":
+            if payload != "Online":
+                self.cache.invalidate(ip)
+            return
+        if name == "POWER":
+            self.cache.update(ip, {"POWER": payload}, ttl=MQTT_STATE_TTL)
+            return
+        try:
+            state = json.loads(payload)
+        except ValueError:
+            return
+        if isinstance(state, dict):
+            self.cache.update(ip, state, ttl=MQTT_STATE_TTL)
+
+
+def transport_from_config(
+    cache: StateCache, config: Optional[Config]
+) -> Optional[MqttTransport]:
+    """
+    Build and start the transport from the optional "mqtt" section of
+    iot_devices.json. None when the section is missing or paho-mqtt is not
+    installed, devices are then polled over HTTP. Devices with a topic are
+    added by ``TasmotaDriver.connect``.
+    """
+    if config is None or config.mqtt is None or paho is None:
+        return None
+    options = config.mqtt
+    transport = MqttTransport(
+        cache,
+        host=options["host"],
+        port=int(options.get("port", MQTT_PORT)),
+        username=options.get("username"),
+        password=options.get("password"),
+        client_id=options.get("client_id", ""),
+    )
+    transport.start()
+    return transport
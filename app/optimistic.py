@@ -0,0 +1,239 @@
+import itertools
+import threading
+import time
+from typing import Callable, Optional
+
+from state import StateCache
+
+"""
+Optimistic device states for the GUI.
+
+A command takes a round-trip to the device before its reply confirms it. The
+windows do not wait for it: ``apply`` records the state the command should
+lead to (eg: {"POWER": "ON"}) as a pending operation, and listeners see it at
+once, on top of the last known state of the state cache.
+
+A pending operation ends
+
+    with its reply      ``settle``, the reported values replace the expected
+                        ones. Replies without the expected keys (MQTT, Yeelight)
+                        keep the operation until the next state of the device
+                        (push or poll) arrives.
+    with an error       ``rollback``, listeners get the last known state back.
+    after ``timeout``   the device never told, the cache is trusted again and
+                        listeners get it from the expiry timer.
+
+A state polled while a command is in flight does not undo the pending values,
+it may have been read before the command reached the device.
+
+    view = OptimisticState(cache)
+    token = view.apply(ip, {"POWER": "ON"})
+    view.settle(token, reply)  or  view.rollback(token)
+    view.close()
+
+"""
+
+
+# seconds after which an unconfirmed operation is dropped
+PENDING_TIMEOUT = 15.0
+
+
+class PendingOperation:
+    __slots__ = ("token", "ip", "expected", "sent", "expires")
+
+    def __init__(self, token: int, ip: str, expected: dict, expires: float) -> None:
+        self.token = token
+        self.ip = ip
+        self.expected = expected
+        # the command succeeded, the device did not report the values yet
+        self.sent = False
+        self.expires = expires
+
+
+class OptimisticState:
+    def __init__(self, cache: StateCache, timeout: float = PENDING_TIMEOUT) -> None:
+        self.cache = cache
+        self.timeout = timeout
+        self._pending = {}
+        self._by_token = {}
+        self._tokens = itertools.count(1)
+        self._listeners = []
+        self._lock = threading.Lock()
+        # fires at the earliest expiry of the pending operations
+        self._timer = None
+        self._timer_at = None
+        self._closed = False
+        cache.subscribe(self._cache_changed)
+
+    def subscribe(self, listener: Callable[[str, dict], None]) -> None:
+        """``listener(ip, state)`` is called with every change of the view."""
+        self._listeners.append(listener)
+
+    def get(self, ip: str) -> Optional[dict]:
+        """Last known state with the pending operations applied."""
+        state = self.cache.get(ip)
+        with self._lock:
+            expired = self._expire()
+            operations = self._pending.get(ip)
+            if operations:
+                state = dict(state or {})
+                for operation in operations:
+                    state.update(operation.expected)
+        for changed in expired:
+            self._notify(changed)
+        return state
+
+    def is_pending(self, ip: str) -> bool:
+        with self._lock:
+            expired = self._expire()
+            pending = ip in self._pending
+        for changed in expired:
+            self._notify(changed)
+        return pending
+
+    def apply(self, ip: str, expected: dict) -> int:
+        """
+        Show ``expected`` until the command is settled or rolled back.
+
+        Returns
+        ----------
+        int
+            Token of the operation, for ``settle`` or ``rollback``.
+
+        """
+        token = next(self._tokens)
+        if not expected:
+            return token
+        operation = PendingOperation(
+            token, ip, dict(expected), time.monotonic() + self.timeout
+        )
+        with self._lock:
+            # a newer command supersedes the values of the older ones, eg: the
+            # positions of a dragged slider
+            for older in list(self._pending.get(ip, [])):
+                for key in expected:
+                    older.expected.pop(key, None)
+                if not older.expected:
+                    self._remove(older)
+            self._pending.setdefault(ip, []).append(operation)
+            self._by_token[token] = operation
+            self._arm()
+        self._notify(ip)
+        return token
+
+    def settle(self, token: int, reply: Optional[dict]) -> bool:
+        """
+        The command succeeded with ``reply``.
+
+        Returns
+        ----------
+        bool
+            False when the device reported other values than expected, the
+            view went back to them.
+
+        """
+        reply = reply or {}
+        with self._lock:
+            operation = self._by_token.get(token)
+            if operation is None:
+                return True
+            reported = {key: reply[key] for key in operation.expected if key in reply}
+            agreed = all(
+                _same(value, operation.expected[key]) for key, value in reported.items()
+            )
+            if len(reported) < len(operation.expected):
+                # confirmed by the next state of the device
+                operation.sent = True
+                operation.expected.update(reported)
+                if agreed:
+                    return True
+            self._remove(operation)
+        self._notify(operation.ip)
+        return agreed
+
+    def rollback(self, token: int) -> None:
+        """The command failed, show the last known state again."""
+        with self._lock:
+            operation = self._by_token.get(token)
+            if operation is None:
+                return
+            self._remove(operation)
+        self._notify(operation.ip)
+
+    def close(self) -> None:
+        """Stop the expiry timer, operations then expire on the next read only."""
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _arm(self) -> None:
+        # called with self._lock held, (re)starts the timer for the earliest
+        # expiry
+        if self._closed or not self._by_token:
+            return
+        expires = min(operation.expires for operation in self._by_token.values())
+        if self._timer is not None:
+            if self._timer_at <= expires:
+                return
+            self._timer.cancel()
+        self._timer_at = expires
+        self._timer = threading.Timer(
+            max(0.0, expires - time.monotonic()), self._timer_fired
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timer_fired(self) -> None:
+        with self._lock:
+            if self._timer is threading.current_thread():
+                self._timer = None
+            expired = self._expire()
+            self._arm()
+        for changed in expired:
+            self._notify(changed)
+
+    def _expire(self) -> list:
+        # called with self._lock held, drops the expired operations, returns
+        # the devices to notify once the lock is released
+        now = time.monotonic()
+        expired = [
+            operation
+            for operations in self._pending.values()
+            for operation in operations
+            if operation.expires <= now
+        ]
+        for operation in expired:
+            self._remove(operation)
+        return list(dict.fromkeys(operation.ip for operation in expired))
+
+    def _remove(self, operation: PendingOperation) -> None:
+        # called with self._lock held
+        self._by_token.pop(operation.token, None)
+        operations = self._pending.get(operation.ip, [])
+        if operation in operations:
+            operations.remove(operation)
+        if not operations:
+            self._pending.pop(operation.ip, None)
+
+    def _cache_changed(self, ip: str, state: dict) -> None:
+        with self._lock:
+            expired = self._expire()
+            for operation in [o for o in self._pending.get(ip, []) if o.sent]:
+                self._remove(operation)
+        for changed in expired:
+            if changed != ip:
+                self._notify(changed)
+        self._notify(ip)
+
+    def _notify(self, ip: str) -> None:
+        state = self.get(ip) or {}
+        for listener in list(self._listeners):
+            listener(ip, dict(state))
+
+
+def _same(reported, expected) -> bool:
+    if isinstance(expected, str):
+        return str(reported).lower() == expected.lower()
+    return reported == expected
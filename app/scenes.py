@@ -0,0 +1,114 @@
+from typing import Callable
+
+from colors import clamp, rgb2hsv
+from config import Config, Device, group_devices
+from tasmota import Backlog
+
+"""
+Groups and scenes.
+
+A scene is a list of actions, each applied to a device or a group of devices:
+
+    {"group": "bedroom", "power": "on", "dimmer": 40}
+    {"device": "Bulb", "color": "#ff8800"}
+    {"device": "Bulb 2", "ct": 400}
+
+    power   "on", "off" or "toggle"
+    dimmer  brightness 0..100
+    ct      color temperature in mireds 153..500 (tasmota scale)
+    color   rgb hex color, lights only
+
+Later actions override earlier ones for the same device. Running a scene sends
+every device its settings concurrently, the scene takes about as long as the
+slowest device. The settings of a device are applied by ``Controller.set``,
+``Controller.apply`` runs them all, ``SceneRunner`` on the command engine.
+"""
+
+
+def scene_settings(config: Config, name: str) -> list:
+    """
+    Resolve a scene into the settings of each device.
+
+    Returns
+    ----------
+    list
+        [(device, settings), ...] in the order of the devices in the config.
+
+    """
+    return action_settings(config, config.scenes[name])
+
+
+def action_settings(config: Config, actions: list) -> list:
+    """Same as ``scene_settings`` for a list of actions, eg: of a schedule."""
+    settings = {}
+    for action in actions:
+        if "device" in action:
+            names = [action["device"]]
+        else:
+            names = [device.name for device in group_devices(config, action["group"])]
+        values = {k: v for k, v in action.items() if k not in ("device", "group")}
+        for device_name in names:
+            settings.setdefault(device_name, {}).update(values)
+    return [
+        (device, settings[device.name])
+        for device in config.devices
+        if device.name in settings
+    ]
+
+
+def tasmota_backlog(device: Device, settings: dict) -> Backlog:
+    """Build the single request applying ``settings`` to a tasmota device."""
+    backlog = Backlog()
+    power = settings.get("power")
+    if power == "on":
+        backlog.add("Power ON")
+    if device.type == "tasmota-light-RGBCCT":
+        if "color" in settings:
+            h, s, v = rgb2hsv(settings["color"])
+            backlog.extend([Backlog.rgb_color(h, s, v)])
+        elif "ct" in settings:
+            # white LEDs only, then the temperature
+            backlog.extend([Backlog.white(cold=0x80)])
+            ct = clamp(int(settings["ct"]), 153, 500)
+            backlog.add(f"CT {ct}")
+        if "dimmer" in settings:
+            dimmer = clamp(int(settings["dimmer"]), 0, 100)
+            backlog.add(f"Dimmer {dimmer}")
+    if power == "off":
+        backlog.add("Power OFF")
+    elif power == "toggle":
+        backlog.add("Power Toggle")
+    return backlog
+
+
+class SceneRunner:
+    def __init__(self, engine, controller) -> None:
+        self.engine = engine
+        self.controller = controller
+
+    def run(self, name: str, on_done: Callable[[dict], None]) -> None:
+        """
+        Apply a scene to all its devices at once.
+
+        Parameters
+        ----------
+        name : str
+            Scene name from the config.
+
+        on_done : callable
+            Called once every device answered or failed, with a dict
+            {device name: None on success or the exception}. Devices known to
+            be down are skipped.
+
+        """
+        targets = scene_settings(self.controller.config, name)
+        if not targets:
+            on_done({})
+            return
+        # the fan-out of Controller.apply, off the Tk thread
+        self.engine.submit(
+            self.controller.apply,
+            targets,
+            on_done=on_done,
+            on_error=lambda e: on_done({device.name: e for device, _ in targets}),
+        )
@@ -0,0 +1,630 @@
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+from config import Config
+from lockfile import LOCK_REFRESH_INTERVAL, OwnerLock
+from metrics import SCHEDULE_RUNS_TOTAL, metrics
+
+"""
+Timed and recurring device actions.
+
+Schedules are defined in iot_devices.json, or added at runtime through the
+HTTP API (kept in the state file):
+
+    "iot": {
+        "location": {"latitude": -23.55, "longitude": -46.63},
+        "schedules": [
+            {"name": "porch", "at": "sunset", "offset": -15, "scene": "evening"},
+            {"name": "plug off", "at": "23:30", "days": ["mon", "fri"],
+             "jitter": 10, "actions": [{"device": "Plug", "power": "off"}]},
+            {"name": "coffee", "at": "2026-10-18T07:00", "catch_up": "once",
+             "actions": [{"device": "Coffee", "power": "on"}]},
+            {"name": "pump", "every": 900, "actions": [...]}
+        ]
+    }
+
+    at          HH:MM every day (local time), sunrise, sunset, or an ISO date
+                and time for a single run
+    every       seconds between two runs, aligned on the epoch
+    days        mon..sun, only these days (default: every day)
+    offset      minutes added to ``at`` or to the alignment of ``every``
+    jitter      each run moves by up to this many minutes, earlier or later
+    scene or actions
+                what to do, same actions as a scene
+    catch_up    runs missed while nothing was running: "skip" them, run the
+                last one "once", or run "all" of them, in order
+    grace       seconds after which a missed run is skipped anyway
+
+Pending runs sit in a hierarchical timer wheel: adding, moving and firing a
+run is O(1), a tick (once per second) only looks at the slot that is due, so
+tens of thousands of schedules cost nothing while they wait. Due runs are
+dispatched on a thread pool, each run applying its actions to all its devices
+at once (``Controller.actions``).
+
+The next run of every schedule is saved in a state file next to
+iot_devices.json, so runs missed while the GUI or the API were not running
+are caught up at the next start. A lock file lets a single process (the GUI
+or ``cli.py serve``) run the schedules, the other one takes over when it ends.
+"""
+
+
+# seconds of a tick of the timer wheel
+TICK_SECONDS = 1.0
+# slots of each level of the timer wheel and levels: 64 ** 4 ticks, ~194 days
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+# schedules run at the same time
+SCHEDULE_MAX_WORKERS = 8
+# missed runs of one schedule run by the "all" catch up policy
+CATCH_UP_MAX_RUNS = 100
+STATE_VERSION = 1
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleError(Exception):
+    pass
+
+
+def state_path(config_path: Path) -> Path:
+    """State file of the schedules of a config file."""
+    config_path = Path(config_path)
+    return Path(config_path.parent, f".{config_path.name}.schedule")
+
+
+def sun_times(day: date, latitude: float, longitude: float) -> tuple:
+    """
+    Sunrise and sunset of a day as timestamps, None when the sun does not rise
+    or set that day (polar day or night).
+
+    https://en.wikipedia.org/wiki/Sunrise_equation
+    """
+    # julian date of the midnight starting the day
+    julian = day.toordinal() + 1721424.5
+    n = math.ceil(julian - 2451545.0 + 0.0008)
+    mean_noon = n - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_noon) % 360)
+    center = (
+        1.9148 * math.sin(anomaly)
+        + 0.0200 * math.sin(2 * anomaly)
+        + 0.0003 * math.sin(3 * anomaly)
+    )
+    ecliptic = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = (
+        2451545.0
+        + mean_noon
+        + 0.0053 * math.sin(anomaly)
+        - 0.0069 * math.sin(2 * ecliptic)
+    )
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    lat = math.radians(latitude)
+    cos_hour = (
+        math.sin(math.radians(-0.833)) - math.sin(lat) * math.sin(declination)
+    ) / (math.cos(lat) * math.cos(declination))
+    if not -1 <= cos_hour <= 1:
+        return None, None
+    hour = math.degrees(math.acos(cos_hour)) / 360
+    return (
+        (transit - hour - 2440587.5) * 86400,
+        (transit + hour - 2440587.5) * 86400,
+    )
+
+
+class Schedule:
+    __slots__ = (
+        "name",
+        "definition",
+        "key",
+        "added",
+        "location",
+        "nominal",
+        "due",
+        "generation",
+        "_kind",
+        "_time",
+    )
+
+    def __init__(
+        self, definition: dict, location: Optional[dict] = None, added: bool = False
+    ) -> None:
+        self.name = definition["name"]
+        self.definition = definition
+        # a changed definition does not keep the saved state
+        self.key = json.dumps(definition, sort_keys=True)
+        # added at runtime, not part of iot_devices.json
+        self.added = added
+        self.location = location
+        # time of the next run without jitter, None when there is none
+        self.nominal = None
+        # time the next run fires
+        self.due = None
+        # bumped when the run is moved, older wheel entries are ignored
+        self.generation = 0
+        at = definition.get("at")
+        if at is None:
+            self._kind, self._time = "every", float(definition["every"])
+        elif at in ("sunrise", "sunset"):
+            self._kind, self._time = at, None
+        elif len(at) <= 5:
+            hours, _, minutes = at.partition(":")
+            self._kind, self._time = "daily", (int(hours), int(minutes))
+        else:
+            self._kind, self._time = "once", datetime.fromisoformat(at).timestamp()
+
+    @property
+    def catch_up(self) -> str:
+        return self.definition.get("catch_up", "skip")
+
+    @property
+    def grace(self) -> float:
+        return float(self.definition.get("grace", 3600))
+
+    def next_after(self, moment: float) -> Optional[float]:
+        """Time of the first run strictly after ``moment``, without jitter."""
+        shift = float(self.definition.get("offset", 0)) * 60
+        if self._kind == "every":
+            every = self._time
+            return (math.floor((moment - shift) / every) + 1) * every + shift
+        if self._kind == "once":
+            when = self._time + shift
+            return when if when > moment else None
+        days = self.definition.get("days") or WEEKDAYS
+        start = date.fromtimestamp(moment - abs(shift)) - timedelta(days=1)
+        # a year covers the longest polar night
+        for index in range(8 if self._kind == "daily" else 370):
+            day = start + timedelta(days=index)
+            if WEEKDAYS[day.weekday()] not in days:
+                continue
+            base = self._base(day)
+            if base is not None and base + shift > moment:
+                return base + shift
+        return None
+
+    def _base(self, day: date) -> Optional[float]:
+        if self._kind == "daily":
+            hours, minutes = self._time
+            return datetime(day.year, day.month, day.day, hours, minutes).timestamp()
+        sunrise, sunset = sun_times(
+            day, self.location["latitude"], self.location["longitude"]
+        )
+        return sunrise if self._kind == "sunrise" else sunset
+
+    def jittered(self, nominal: float, rng: random.Random) -> float:
+        jitter = float(self.definition.get("jitter", 0)) * 60
+        return nominal + rng.uniform(-jitter, jitter) if jitter else nominal
+
+    def as_dict(self) -> dict:
+        return {
+            **self.definition,
+            "next": _isoformat(self.due),
+            "added": self.added,
+        }
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel: ``levels`` wheels of ``slots`` slots, a slot of
+    level n spanning ``slots ** n`` ticks. Entries further than the last level
+    wait in an overflow list, checked each time the last level moves.
+
+        wheel = TimerWheel(time.time())
+        wheel.add(time.time() + 90, item)
+        wheel.advance(time.time())  ->  items due
+    """
+
+    def __init__(
+        self,
+        now: float,
+        resolution: float = TICK_SECONDS,
+        slots: int = WHEEL_SLOTS,
+        levels: int = WHEEL_LEVELS,
+    ) -> None:
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.tick = int(now // resolution)
+        self._spans = [slots**level for level in range(levels + 1)]
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._overflow = []
+        self._due = []
+        # entries in the wheels and the overflow list
+        self._pending = 0
+
+    def __len__(self) -> int:
+        return self._pending + len(self._due)
+
+    def add(self, when: float, item) -> None:
+        self._place((int(when // self.resolution), item))
+
+    def advance(self, now: float) -> list:
+        """Move to ``now``, returns the items due, in no particular order."""
+        target = int(now // self.resolution)
+        while self.tick < target:
+            if not self._pending:
+                self.tick = target
+                break
+            self.tick += 1
+            # higher levels first, their entries may land in a lower slot
+            # that is cascaded right after
+            for level in range(self.levels - 1, 0, -1):
+                if self.tick % self._spans[level] == 0:
+                    self._cascade(self._wheels[level], self.tick, level)
+            if self._overflow and self.tick % self._spans[self.levels - 1] == 0:
+                entries, self._overflow = self._overflow, []
+                self._pending -= len(entries)
+                for entry in entries:
+                    self._place(entry)
+            slot = self.tick % self.slots
+            entries = self._wheels[0][slot]
+            if entries:
+                self._wheels[0][slot] = []
+                self._pending -= len(entries)
+                self._due.extend(entries)
+        due, self._due = self._due, []
+        return [item for _, item in due]
+
+    def _cascade(self, wheel: list, tick: int, level: int) -> None:
+        slot = (tick // self._spans[level]) % self.slots
+        entries = wheel[slot]
+        if entries:
+            wheel[slot] = []
+            self._pending -= len(entries)
+            for entry in entries:
+                self._place(entry)
+
+    def _place(self, entry: tuple) -> None:
+        delta = entry[0] - self.tick
+        if delta <= 0:
+            self._due.append(entry)
+            return
+        self._pending += 1
+        for level in range(self.levels):
+            if delta < self._spans[level + 1]:
+                slot = (entry[0] // self._spans[level]) % self.slots
+                self._wheels[level][slot].append(entry)
+                return
+        self._overflow.append(entry)
+
+
+class Scheduler:
+    def __init__(
+        self,
+        controller,
+        path: Path,
+        on_run: Optional[Callable[[str, dict], None]] = None,
+        max_workers: int = SCHEDULE_MAX_WORKERS,
+        clock: Callable[[], float] = time.time,
+        seed: Optional[int] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        controller : Controller
+            Runs the actions, its config holds the schedules.
+
+        path : Path
+            State file, see ``state_path``. Its lock file sits next to it.
+
+        on_run : callable, optional
+            ``on_run(name, results)`` after each run, results as returned by
+            ``Controller.scene``. Called from the worker threads.
+
+        """
+        self.controller = controller
+        self.path = Path(path)
+        self._lock = OwnerLock(Path(f"{self.path}.lock"))
+        self.on_run = on_run
+        self.max_workers = max_workers
+        self.clock = clock
+        self._rng = random.Random(seed)
+        self._schedules = {}
+        self._wheel = None
+        self._owner = False
+        self._dirty = False
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="iot-schedule"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="iot-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def is_owner(self) -> bool:
+        """This process runs the schedules, see the lock file."""
+        return self._owner
+
+    def schedules(self) -> list:
+        """Every schedule, the next ones first."""
+        with self._wakeup:
+            schedules = list(self._schedules.values())
+        return sorted(schedules, key=lambda s: (s.due is None, s.due or 0, s.name))
+
+    def reload(self, config: Config) -> None:
+        """Take the schedules of a reloaded config, keeping the unchanged ones."""
+        with self._wakeup:
+            if not self._owner:
+                return
+            added = [s for s in self._schedules.values() if s.added]
+            previous = self._schedules
+            self._schedules = {}
+            now = self.clock()
+            for definition in config.schedules:
+                schedule = Schedule(definition, config.location)
+                old = previous.get(schedule.name)
+                if old is not None and old.key == schedule.key and not old.added:
+                    schedule = old
+                    schedule.location = config.location
+                else:
+                    self._plan(schedule, now)
+                self._schedules[schedule.name] = schedule
+            for schedule in added:
+                if schedule.name not in self._schedules:
+                    self._schedules[schedule.name] = schedule
+            for schedule in previous.values():
+                if self._schedules.get(schedule.name) is not schedule:
+                    schedule.generation += 1
+            self._dirty = True
+            self._wakeup.notify()
+
+    def add(self, definition: dict) -> Schedule:
+        """
+        Add a schedule at runtime, kept in the state file.
+
+        Raises
+        ----------
+        ScheduleError
+            Invalid, name already used, or another process runs the schedules.
+
+        """
+        from config_schema import validate_schedule
+
+        try:
+            definition = validate_schedule(definition, self.controller.config)
+        except ValueError as e:
+            # pydantic.ValidationError too
+            raise ScheduleError(str(e))
+        with self._wakeup:
+            if not self._owner:
+                raise ScheduleError("Schedules are run by another process")
+            if definition["name"] in self._schedules:
+                raise ScheduleError(f"Schedule already exists: {definition['name']}")
+            schedule = Schedule(definition, self.controller.config.location, added=True)
+            self._plan(schedule, self.clock())
+            self._schedules[schedule.name] = schedule
+            self._dirty = True
+            self._wakeup.notify()
+        return schedule
+
+    def remove(self, name: str) -> None:
+        """
+        Remove a schedule added at runtime.
+
+        Raises
+        ----------
+        ScheduleError
+            Unknown, or defined in iot_devices.json.
+
+        """
+        with self._wakeup:
+            schedule = self._schedules.get(name)
+            if schedule is None or not schedule.added:
+                raise ScheduleError(f"No schedule added at runtime: {name}")
+            schedule.generation += 1
+            del self._schedules[name]
+            self._dirty = True
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        refreshed = 0.0
+        while True:
+            with self._wakeup:
+                if self._stopped:
+                    break
+                if not self._owner:
+                    self._owner = self._lock.acquire()
+                    if self._owner:
+                        self._load()
+                        refreshed = time.monotonic()
+                if self._owner:
+                    self._tick()
+                    if time.monotonic() - refreshed >= LOCK_REFRESH_INTERVAL:
+                        self._lock.refresh()
+                        refreshed = time.monotonic()
+                    delay = TICK_SECONDS - self.clock() % TICK_SECONDS
+                else:
+                    delay = LOCK_REFRESH_INTERVAL
+                self._wakeup.wait(delay)
+        with self._wakeup:
+            if self._owner:
+                self._save()
+                self._lock.release()
+                self._owner = False
+
+    def _tick(self) -> None:
+        # called with self._wakeup held
+        now = self.clock()
+        for schedule, generation in self._wheel.advance(now):
+            if generation != schedule.generation:
+                continue
+            self._dispatch(schedule, 1)
+            self._plan(schedule, max(now, schedule.nominal))
+        if self._dirty:
+            self._save()
+
+    def _plan(self, schedule: Schedule, after: float) -> None:
+        # called with self._wakeup held, puts the next run in the wheel
+        schedule.generation += 1
+        schedule.nominal = schedule.next_after(after)
+        schedule.due = None
+        if schedule.nominal is not None:
+            schedule.due = max(
+                self.clock(), schedule.jittered(schedule.nominal, self._rng)
+            )
+            self._wheel.add(schedule.due, (schedule, schedule.generation))
+        self._dirty = True
+
+    def _dispatch(self, schedule: Schedule, runs: int) -> None:
+        try:
+            self._executor.submit(self._fire, schedule, runs)
+        except RuntimeError:
+            # stopped
+            pass
+
+    def _fire(self, schedule: Schedule, runs: int) -> None:
+        definition = schedule.definition
+        for _ in range(runs):
+            try:
+                if definition.get("scene") is not None:
+                    results = self.controller.scene(definition["scene"])
+                else:
+                    results = self.controller.actions(definition["actions"])
+            except Exception as e:
+                # eg: a scene or group removed from the config since
+                logger.warning("Schedule %s failed: %s", schedule.name, e)
+                metrics.inc(SCHEDULE_RUNS_TOTAL, result="error")
+                continue
+            failed = sum(1 for error in results.values() if error is not None)
+            metrics.inc(SCHEDULE_RUNS_TOTAL, result="error" if failed else "ok")
+            if failed:
+                logger.warning(
+                    "Schedule %s: %d of %d devices failed",
+                    schedule.name,
+                    failed,
+                    len(results),
+                )
+            else:
+                logger.info("Schedule %s ran", schedule.name)
+            if self.on_run is not None:
+                self.on_run(schedule.name, results)
+
+    def _load(self) -> None:
+        # called with self._wakeup held, once the lock is ours: restores the
+        # runtime schedules and catches up on the missed runs
+        try:
+            with self.path.open("r") as filehandle:
+                state = json.load(filehandle)
+            if state.get("version") != STATE_VERSION:
+                state = {}
+        except (OSError, ValueError):
+            state = {}
+        saved = state.get("schedules", {})
+        config = self.controller.config
+        now = self.clock()
+        self._wheel = TimerWheel(now)
+        self._schedules = {}
+        definitions = [(d, False) for d in config.schedules]
+        definitions += [(d, True) for d in state.get("added", [])]
+        for definition, added in definitions:
+            schedule = Schedule(definition, config.location, added=added)
+            if schedule.name in self._schedules:
+                continue
+            self._schedules[schedule.name] = schedule
+            entry = saved.get(schedule.name)
+            if entry is None or entry.get("key") != schedule.key:
+                self._plan(schedule, now)
+                continue
+            if entry.get("next") is None:
+                # one-shot that already ran
+                continue
+            missed = self._missed(schedule, entry["next"], now)
+            if missed:
+                logger.info(
+                    "Schedule %s: catching up %d missed run(s)", schedule.name, missed
+                )
+                self._dispatch(schedule, missed)
+            self._plan(schedule, max(now, entry["next"] - 1e-6))
+        self._dirty = True
+
+    def _missed(self, schedule: Schedule, first: float, now: float) -> int:
+        """Runs of the catch up policy for the runs from ``first`` to ``now``."""
+        if schedule.catch_up == "skip" or first > now:
+            return 0
+        count = 0
+        moment = first
+        while moment is not None and moment <= now and count < CATCH_UP_MAX_RUNS:
+            if now - moment <= schedule.grace:
+                count += 1
+            moment = schedule.next_after(moment)
+        if schedule.catch_up == "once":
+            return min(1, count)
+        return count
+
+    def _save(self) -> None:
+        # called with self._wakeup held
+        state = {
+            "version": STATE_VERSION,
+            "schedules": {
+                schedule.name: {"key": schedule.key, "next": schedule.nominal}
+                for schedule in self._schedules.values()
+            },
+            "added": [s.definition for s in self._schedules.values() if s.added],
+        }
+        try:
+            tmp = Path(f"{self.path}.tmp")
+            with tmp.open("w") as filehandle:
+                json.dump(state, filehandle, indent=4)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning("%s not saved: %s", self.path.name, e)
+
+
+def planned(config: Config, path: Path) -> list:
+    """
+    Schedules of ``config`` and of the state file with their next run, read
+    without running them (command line).
+    """
+    try:
+        with Path(path).open("r") as filehandle:
+            state = json.load(filehandle)
+        if state.get("version") != STATE_VERSION:
+            state = {}
+    except (OSError, ValueError):
+        state = {}
+    saved = state.get("schedules", {})
+    now = time.time()
+    schedules = []
+    definitions = [(d, False) for d in config.schedules]
+    definitions += [(d, True) for d in state.get("added", [])]
+    for definition, added in definitions:
+        schedule = Schedule(definition, config.location, added=added)
+        entry = saved.get(schedule.name)
+        if entry is not None and entry.get("key") == schedule.key:
+            schedule.nominal = entry.get("next")
+        else:
+            schedule.nominal = schedule.next_after(now)
+        schedule.due = schedule.nominal
+        schedules.append(schedule)
+    return sorted(schedules, key=lambda s: (s.due is None, s.due or 0, s.name))
+
+
+def _isoformat(moment: Optional[float]) -> Optional[str]:
+    if moment is None:
+        return None
+    return datetime.fromtimestamp(moment).isoformat(timespec="seconds")
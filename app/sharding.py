@@ -0,0 +1,601 @@
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from config import Config, ConfigDiff, Device, diff_devices
+from controller import DeviceNotFoundError
+from health import DeviceHealth, DeviceUnavailableError
+from metrics import OPERATION_SECONDS, OPERATIONS_TOTAL, metrics
+from scenes import action_settings, scene_settings
+from state import StateCache
+
+"""
+Device operations spread over worker processes.
+
+A single process parses every reply and runs every command under one GIL,
+which caps a fleet of thousands of devices at what one core can do.
+``ShardedController`` has the interface of ``Controller`` used by the HTTP
+API, the schedules and the telemetry, but partitions the devices over
+``shards`` worker processes by a hash of their address. Each worker runs its
+own ``Controller`` on its devices: connections, state cache, circuit breakers,
+MQTT subscriptions.
+
+    coordinator                         worker (one per shard)
+    toggle(device)  --("call", ...)-->  Controller.toggle, on a thread pool
+    Future          <--("result", ...)
+    cache           <--("state", ip, state)     every change of its cache
+    is_available    <--("available", ip, bool)  breaker opened or closed
+
+Messages go over one pipe per worker, a worker sends its messages in
+batches. A scene is split by shard and sent as
+one message per worker, which applies its part concurrently. A worker that
+dies is started again after a delay doubling on every exit, the operations it
+was running fail with ``ShardError``. A worker exiting SHARD_CRASH_LIMIT times
+in SHARD_CRASH_WINDOW seconds is not started again and its devices are
+unavailable until the next start of the coordinator.
+
+    controller = ShardedController(load_config(path), shards=4)
+    controller.scene("all off")
+
+    python cli.py serve --shards 4
+"""
+
+
+# threads of a worker running device operations
+SHARD_MAX_WORKERS = 32
+# seconds to wait for a worker to exit
+SHARD_STOP_TIMEOUT = 5.0
+# seconds before starting a dead worker again, doubled on every exit
+SHARD_RESTART_DELAY = 1.0
+# longest delay before starting a dead worker again
+SHARD_RESTART_MAX_DELAY = 60.0
+# a worker exiting this many times in SHARD_CRASH_WINDOW seconds is left dead
+SHARD_CRASH_LIMIT = 5
+SHARD_CRASH_WINDOW = 120.0
+# operations of Controller a worker runs for the coordinator
+SHARD_OPERATIONS = (
+    "get_state",
+    "toggle",
+    "set",
+    "batch",
+    "energy",
+    "frame",
+    "frame_interval",
+    "is_pushing",
+    "stats",
+    "apply",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ShardError(Exception):
+    pass
+
+
+def shard_of(device: Device, shards: int) -> int:
+    """Shard of a device, stable across processes and restarts."""
+    return zlib.crc32(device.ip.encode("utf-8")) % shards
+
+
+def _shard_config(devices: list, options: dict) -> Config:
+    # config of a worker: its devices and the shared connection settings
+    return Config(
+        devices=tuple(Device(**device) for device in devices),
+        groups={},
+        scenes={},
+        mqtt=options.get("mqtt"),
+        http=options.get("http"),
+    )
+
+
+def _portable(error: Exception) -> Exception:
+    # exceptions cross the pipe pickled, not all of them can be
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return ShardError(f"{type(error).__name__}: {error}")
+
+
+def _worker_main(devices: list, options: dict, conn) -> None:
+    """Entry point of a worker process."""
+    from controller import Controller
+
+    logging.basicConfig(
+        level=options.get("log_level", "WARNING"),
+        format="%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s",
+    )
+    config = _shard_config(devices, options)
+    if options.get("pooled", True):
+        controller = Controller(config)
+    else:
+        from tasmota import TasmotaHttpClient
+
+        controller = Controller(config, http=TasmotaHttpClient())
+    # messages to the coordinator, sent in batches by the writer thread: under
+    # load one pickle and one write carry many results and state changes
+    outbox = deque()
+    ready = threading.Condition()
+    stopped = False
+
+    def _send(message: tuple) -> None:
+        with ready:
+            outbox.append(message)
+            ready.notify()
+
+    def _writer() -> None:
+        while True:
+            with ready:
+                while not outbox and not stopped:
+                    ready.wait()
+                if not outbox:
+                    return
+                batch = list(outbox)
+                outbox.clear()
+            try:
+                conn.send(batch)
+            except (OSError, ValueError):
+                # coordinator gone
+                return
+
+    def _handle(message: tuple) -> None:
+        _, call_id, operation, ip, args = message
+        try:
+            if operation == "apply":
+                value = {
+                    name: None if error is None else _portable(error)
+                    for name, error in controller.apply(
+                        [(controller.device(ip), settings) for ip, settings in args]
+                    ).items()
+                }
+            elif operation == "stats":
+                value = controller.health.stats(controller.device(ip))
+            elif operation in SHARD_OPERATIONS:
+                value = getattr(controller, operation)(controller.device(ip), *args)
+            else:
+                raise ShardError(f"Unknown operation: {operation}")
+        except Exception as e:
+            _send(("result", call_id, False, _portable(e)))
+            return
+        _send(("result", call_id, True, value))
+
+    controller.cache.subscribe(lambda ip, state: _send(("state", ip, state)))
+    controller.health.subscribe(
+        lambda ip, available: _send(("available", ip, available))
+    )
+    if config.mqtt is not None:
+        from mqtt import transport_from_config
+
+        controller.mqtt = transport_from_config(controller.cache, config)
+    for device in config.devices:
+        controller.connect(device)
+    executor = ThreadPoolExecutor(
+        max_workers=SHARD_MAX_WORKERS, thread_name_prefix="iot-shard"
+    )
+    writer = threading.Thread(target=_writer, name="iot-shard-writer", daemon=True)
+    writer.start()
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "stop":
+                break
+            if message[0] == "reload":
+                # in order with the calls that follow
+                controller.reload(_shard_config(message[1], options))
+                continue
+            executor.submit(_handle, message)
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the whole process group, the coordinator stops us
+        pass
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        controller.close()
+        with ready:
+            stopped = True
+            ready.notify()
+        writer.join(SHARD_STOP_TIMEOUT)
+
+
+class _Shard:
+    __slots__ = (
+        "index",
+        "process",
+        "conn",
+        "send_lock",
+        "devices",
+        "reader",
+        "exits",
+        "failed",
+    )
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        # device dicts of the shard, as sent to the worker
+        self.devices = []
+        self.reader = None
+        # time.monotonic() of the recent exits of the worker
+        self.exits = deque()
+        # crash loop, the worker is not started again
+        self.failed = False
+
+
+class ShardHealth:
+    """The part of ``HealthTracker`` read outside of the controller."""
+
+    def __init__(self, controller: "ShardedController") -> None:
+        self.controller = controller
+        self._listeners = []
+
+    def subscribe(self, listener: Callable[[str, bool], None]) -> None:
+        """``listener(ip, available)`` is called when a breaker opens or closes."""
+        self._listeners.append(listener)
+
+    def is_available(self, device: Device) -> bool:
+        return self.controller.is_available(device)
+
+    def stats(self, device: Device) -> dict:
+        try:
+            return self.controller._call(device, "stats")
+        except ShardError:
+            return DeviceHealth().as_dict()
+
+    def _notify(self, ip: str, available: bool) -> None:
+        for listener in list(self._listeners):
+            listener(ip, available)
+
+
+class ShardedController:
+    def __init__(
+        self,
+        config: Config,
+        shards: int,
+        pooled: bool = True,
+        log_level: str = "WARNING",
+    ) -> None:
+        """
+        Parameters
+        ----------
+        config : Config
+            The "iot" section of iot_devices.json, see config.load_config.
+
+        shards : int
+            Worker processes, the devices are spread evenly over them.
+
+        pooled : bool
+            Keep-alive Tasmota sessions in the workers, one-shot requests
+            otherwise.
+
+        """
+        if shards < 1:
+            raise ValueError("At least one shard is needed")
+        self.config = config
+        self.cache = StateCache()
+        self.health = ShardHealth(self)
+        # not used, the workers connect to the broker themselves
+        self.mqtt = None
+        self._options = {
+            "mqtt": config.mqtt,
+            "http": config.http,
+            "pooled": pooled,
+            "log_level": log_level,
+        }
+        # spawn: forking a process running threads is not safe
+        self._context = multiprocessing.get_context("spawn")
+        self._ids = itertools.count()
+        self._pending = {}
+        self._unavailable = set()
+        self._lock = threading.Lock()
+        self._closing = False
+        # interrupts the delay before starting a dead worker again
+        self._stopped = threading.Event()
+        self._shards = [_Shard(index) for index in range(shards)]
+        for shard, devices in zip(self._shards, self._partition(config)):
+            shard.devices = devices
+            self._start(shard)
+
+    @property
+    def shards(self) -> int:
+        return len(self._shards)
+
+    def find(self, name: str) -> Device:
+        """Return a device by name, exact match first, then case insensitive."""
+        device = self.config.device(name)
+        if device is not None:
+            return device
+        matches = [
+            device
+            for device in self.config.devices
+            if device.name.lower() == name.lower()
+        ]
+        if len(matches) != 1:
+            raise DeviceNotFoundError(f"Unknown device: {name}")
+        return matches[0]
+
+    def device(self, ip: str) -> Device:
+        device = self.config.device_at(ip)
+        if device is None:
+            raise DeviceNotFoundError(f"Unknown device: {ip}")
+        return device
+
+    def connect(self, device: Device) -> None:
+        # the workers connect their devices
+        pass
+
+    def reload(self, config: Config, connect: bool = True) -> ConfigDiff:
+        """Switch to a new config, each worker reloads its part of it."""
+        diff = diff_devices(self.config, config)
+        self.config = config
+        for shard, devices in zip(self._shards, self._partition(config)):
+            if devices != shard.devices:
+                shard.devices = devices
+                self._send(shard, ("reload", devices))
+        for device in diff.removed + [old for old, _ in diff.changed]:
+            self.cache.invalidate(device.ip)
+            with self._lock:
+                self._unavailable.discard(device.ip)
+        return diff
+
+    def is_available(self, device: Device) -> bool:
+        """
+        False while the circuit breaker of the device is open or its worker
+        is left dead after a crash loop.
+        """
+        if self._shards[shard_of(device, self.shards)].failed:
+            return False
+        with self._lock:
+            return device.ip not in self._unavailable
+
+    def is_pushing(self, device: Device) -> bool:
+        return self._call(device, "is_pushing")
+
+    def get_state(self, device: Device) -> dict:
+        return self._call(device, "get_state")
+
+    def toggle(self, device: Device) -> dict:
+        """Toggle the power of a device, returns the reply of the device."""
+        return self._call(device, "toggle")
+
+    def set(self, device: Device, settings: dict) -> dict:
+        """Apply settings to a device, see ``Controller.set``."""
+        return self._call(device, "set", settings)
+
+    def batch(self, device: Device, settings: list) -> dict:
+        """Apply several settings in order, in one request when possible."""
+        return self._call(device, "batch", settings)
+
+    def energy(self, device: Device) -> Optional[dict]:
+        """Power and energy counter, None without an energy monitor."""
+        return self._call(device, "energy")
+
+    def frame_interval(self, device: Device) -> Optional[float]:
+        return self._call(device, "frame_interval")
+
+    def frame(
+        self, device: Device, hue: int, sat: int, bri: int, first: bool = False
+    ) -> None:
+        """Show one frame of a light effect, see effects.py."""
+        self._call(device, "frame", hue, sat, bri, first)
+
+    def scene(self, name: str) -> dict:
+        """Apply a scene, see ``Controller.scene``."""
+        return self.apply(scene_settings(self.config, name))
+
+    def actions(self, actions: list) -> dict:
+        """Same as ``scene`` for a list of scene actions."""
+        return self.apply(action_settings(self.config, actions))
+
+    def apply(self, device_settings: list) -> dict:
+        """
+        Apply [(device, settings), ...], one message per worker, each worker
+        updating its devices concurrently.
+        """
+        results = {}
+        parts = {}
+        for device, settings in device_settings:
+            if not self.is_available(device):
+                results[device.name] = DeviceUnavailableError(
+                    f"{device.name} is unreachable"
+                )
+                continue
+            parts.setdefault(shard_of(device, self.shards), []).append(
+                (device, settings)
+            )
+        futures = {
+            index: self._submit(
+                self._shards[index],
+                "apply",
+                None,
+                [(device.ip, settings) for device, settings in part],
+            )
+            for index, part in parts.items()
+        }
+        for index, future in futures.items():
+            try:
+                results.update(future.result())
+            except Exception as e:
+                for device, _ in parts[index]:
+                    results[device.name] = e
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            self._closing = True
+        self._stopped.set()
+        for shard in self._shards:
+            self._send(shard, ("stop",))
+        for shard in self._shards:
+            shard.process.join(SHARD_STOP_TIMEOUT)
+            if shard.process.is_alive():
+                shard.process.terminate()
+            shard.conn.close()
+        self._fail_pending(None, ShardError("Controller closed"))
+
+    def _call(self, device: Device, operation: str, *args):
+        start = time.perf_counter()
+        result = "error"
+        try:
+            shard = self._shards[shard_of(device, self.shards)]
+            reply = self._submit(shard, operation, device.ip, args).result()
+            result = "ok"
+            return reply
+        except DeviceUnavailableError:
+            result = "unavailable"
+            raise
+        finally:
+            if operation not in ("stats", "frame_interval", "is_pushing"):
+                seconds = time.perf_counter() - start
+                if result != "unavailable":
+                    metrics.observe(
+                        OPERATION_SECONDS,
+                        seconds,
+                        device=device.name,
+                        operation=operation,
+                    )
+                metrics.inc(
+                    OPERATIONS_TOTAL,
+                    device=device.name,
+                    operation=operation,
+                    result=result,
+                )
+
+    def _submit(self, shard: _Shard, operation: str, ip, args) -> Future:
+        future = Future()
+        call_id = next(self._ids)
+        with self._lock:
+            self._pending[call_id] = (shard.index, future)
+        if not self._send(shard, ("call", call_id, operation, ip, args)):
+            with self._lock:
+                self._pending.pop(call_id, None)
+            future.set_exception(ShardError(f"Shard {shard.index} is not running"))
+        return future
+
+    def _send(self, shard: _Shard, message: tuple) -> bool:
+        with shard.send_lock:
+            try:
+                shard.conn.send(message)
+                return True
+            except (OSError, ValueError):
+                return False
+
+    def _partition(self, config: Config) -> list:
+        parts = [[] for _ in self._shards]
+        for device in config.devices:
+            parts[shard_of(device, len(parts))].append(device.as_dict())
+        return parts
+
+    def _start(self, shard: _Shard) -> None:
+        conn, child = self._context.Pipe()
+        shard.process = self._context.Process(
+            target=_worker_main,
+            args=(shard.devices, self._options, child),
+            name=f"iot-shard-{shard.index}",
+            daemon=True,
+        )
+        shard.process.start()
+        # the worker owns its end now
+        child.close()
+        shard.conn = conn
+        shard.reader = threading.Thread(
+            target=self._read,
+            args=(shard, conn),
+            name=f"iot-shard-reader-{shard.index}",
+            daemon=True,
+        )
+        shard.reader.start()
+
+    def _read(self, shard: _Shard, conn) -> None:
+        while True:
+            try:
+                batch = conn.recv()
+            except (EOFError, OSError):
+                break
+            for message in batch:
+                self._dispatch(message)
+        with self._lock:
+            closing = self._closing
+        if closing:
+            return
+        self._fail_pending(shard.index, ShardError(f"Shard {shard.index} exited"))
+        conn.close()
+        now = time.monotonic()
+        shard.exits.append(now)
+        while shard.exits[0] < now - SHARD_CRASH_WINDOW:
+            shard.exits.popleft()
+        if len(shard.exits) >= SHARD_CRASH_LIMIT:
+            logger.error(
+                "Shard %d exited %d times in %.0f seconds (%s), not starting it "
+                "again, its devices are unavailable",
+                shard.index,
+                len(shard.exits),
+                SHARD_CRASH_WINDOW,
+                shard.process.exitcode,
+            )
+            shard.failed = True
+            for device in shard.devices:
+                self.health._notify(device["ip"], False)
+            return
+        delay = min(
+            SHARD_RESTART_DELAY * 2 ** (len(shard.exits) - 1), SHARD_RESTART_MAX_DELAY
+        )
+        logger.warning(
+            "Shard %d exited (%s), starting it again in %.0f seconds",
+            shard.index,
+            shard.process.exitcode,
+            delay,
+        )
+        with self._lock:
+            for device in shard.devices:
+                self._unavailable.discard(device["ip"])
+        if self._stopped.wait(delay):
+            return
+        with shard.send_lock:
+            self._start(shard)
+
+    def _dispatch(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "result":
+            _, call_id, ok, value = message
+            with self._lock:
+                entry = self._pending.pop(call_id, None)
+            if entry is None:
+                return
+            if ok:
+                entry[1].set_result(value)
+            else:
+                entry[1].set_exception(value)
+        elif kind == "state":
+            self.cache.set(message[1], message[2])
+        elif kind == "available":
+            _, ip, available = message
+            with self._lock:
+                if available:
+                    self._unavailable.discard(ip)
+                else:
+                    self._unavailable.add(ip)
+            self.health._notify(ip, available)
+
+    def _fail_pending(self, index: Optional[int], error: Exception) -> None:
+        # index None: every shard
+        with self._lock:
+            failed = [
+                call_id
+                for call_id, (shard_index, _) in self._pending.items()
+                if index is None or shard_index == index
+            ]
+            futures = [self._pending.pop(call_id)[1] for call_id in failed]
+        for future in futures:
+            future.set_exception(error)
@@ -0,0 +1,594 @@
+import argparse
+import asyncio
+import colorsys
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+"""
+Simulated Tasmota and Yeelight devices.
+
+Every simulated device listens on its own local port, all of them served by
+one asyncio loop in a background thread, so the GUI, the command line, the
+HTTP API and benchmark.py can run against hundreds of devices without any
+hardware.
+
+    Tasmota     HTTP ``/cm?cmnd=...``: STATE, Status, Status 11, Power, Dimmer,
+                CT, White, Color, HSBColor and Backlog/Backlog0, with the
+                replies of a Tasmota light (RGBCCT), plug or switch. Plugs
+                have an energy monitor (Status 8 or 10), their load wanders
+                around ``load`` watts while on. Like the real web server, a
+                device answers one request at a time.
+    Yeelight    JSON lines over TCP: get_prop, set_power, toggle, set_bright,
+                set_ct_abx, set_rgb, set_hsv, set_music. State changes are
+                pushed as "props" notifications on every open connection,
+                music mode connects back to the client.
+
+``Conditions`` degrade a device: latency and jitter before each reply, a share
+of requests lost (Tasmota closes the connection, Yeelight never answers), and a
+rate limit (Tasmota answers 503, Yeelight "client quota exceeded" like the real
+~60 commands per minute quota).
+
+    simulator = Simulator()
+    simulator.add_tasmota(100, "tasmota-light-RGBCCT", Conditions(latency=0.02))
+    simulator.add_yeelight(2)
+    simulator.start()
+    simulator.devices()  ->  "devices" of iot_devices.json
+
+    python simulator.py --tasmota 50 --yeelight 5 --latency 30 --write sim.json
+    python cli.py --config sim.json list
+"""
+
+
+SIMULATOR_HOST = "127.0.0.1"
+TASMOTA_TYPES = ("tasmota-plug", "tasmota-switch", "tasmota-light-RGBCCT")
+# props of a get_prop request answered by the simulated bulbs
+YEELIGHT_DEFAULTS = {
+    "power": "on",
+    "bright": "100",
+    "ct": "4000",
+    "rgb": "16777215",
+    "hue": "0",
+    "sat": "0",
+    "color_mode": "2",
+    "flowing": "0",
+    "delayoff": "0",
+    "music_on": "0",
+    "name": "",
+}
+# seconds an idle keep-alive connection stays open
+KEEPALIVE_TIMEOUT = 30.0
+
+
+class Conditions:
+    __slots__ = ("latency", "jitter", "loss", "rate_limit", "rate_window")
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        loss: float = 0.0,
+        rate_limit: Optional[int] = None,
+        rate_window: float = 1.0,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        latency, jitter : float
+            Seconds before each reply, plus up to ``jitter`` at random.
+
+        loss : float
+            Share of requests never answered, 0..1.
+
+        rate_limit : int, optional
+            Requests accepted per ``rate_window`` seconds.
+
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+
+
+class _RateLimiter:
+    def __init__(self, conditions: Conditions) -> None:
+        self.conditions = conditions
+        self._times = deque()
+
+    def allow(self) -> bool:
+        limit = self.conditions.rate_limit
+        if limit is None:
+            return True
+        now = time.monotonic()
+        while self._times and now - self._times[0] >= self.conditions.rate_window:
+            self._times.popleft()
+        if len(self._times) >= limit:
+            return False
+        self._times.append(now)
+        return True
+
+
+class TasmotaDevice:
+    def __init__(
+        self,
+        device_type: str = "tasmota-plug",
+        name: str = "Tasmota",
+        topic: str = "tasmota",
+    ) -> None:
+        self.type = device_type
+        self.name = name
+        self.topic = topic
+        self.light = device_type == "tasmota-light-RGBCCT"
+        self.power = True
+        self.dimmer = 100
+        self.ct = 153
+        # h, s of the rgb leds, None in white mode
+        self.hs = None
+        self.requests = 0
+        self.metered = device_type == "tasmota-plug"
+        # watts drawn while on, energy counter in kWh
+        self.load = 60.0
+        self.total = 0.0
+        self._watts = 0.0
+        self._metered_at = time.monotonic()
+
+    def execute(self, cmnd: str) -> dict:
+        """Reply of the device to one command, e.g. "Dimmer 40"."""
+        self.requests += 1
+        name, _, value = cmnd.strip().partition(" ")
+        name, value = name.lower(), value.strip()
+        if name in ("backlog", "backlog0"):
+            reply = {}
+            for command in value.split(";"):
+                if command.strip():
+                    reply.update(self.execute(command))
+            return reply
+        if name == "state":
+            return {"Time": time.strftime("%Y-%m-%dT%H:%M:%S"), **self.state()}
+        if name == "status" and not value:
+            return {
+                "Status": {
+                    "Module": 0,
+                    "DeviceName": self.name,
+                    "FriendlyName": [self.name],
+                    "Topic": self.topic,
+                    "Power": int(self.power),
+                }
+            }
+        if name == "status" and value == "11":
+            return {
+                "StatusSTS": {
+                    "Time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    **self.state(),
+                }
+            }
+        if name == "status" and value in ("8", "10"):
+            sensors = {"Time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            if self.metered:
+                sensors["ENERGY"] = self._energy()
+            return {"StatusSNS": sensors}
+        if name in ("power", "power1"):
+            if value.lower() in ("on", "1"):
+                self.power = True
+            elif value.lower() in ("off", "0"):
+                self.power = False
+            elif value.lower() in ("toggle", "2"):
+                self.power = not self.power
+            return {"POWER": self._power()}
+        if not self.light:
+            return {"Command": "Unknown"}
+        if name == "dimmer":
+            self.dimmer = _clamp(int(value), 0, 100)
+            self.power = self.dimmer > 0
+        elif name == "ct":
+            self.ct = _clamp(int(value), 153, 500)
+            self.hs = None
+        elif name == "white":
+            self.dimmer = _clamp(int(value), 0, 100)
+            self.hs = None
+        elif name == "hsbcolor":
+            h, s, b = (int(part) for part in value.split(","))
+            self.hs = (_clamp(h, 0, 360), _clamp(s, 0, 100))
+            self.dimmer = _clamp(b, 0, 100)
+            self.power = self.dimmer > 0
+        elif name == "color":
+            self._set_color(value.lstrip("#"))
+        else:
+            return {"Command": "Unknown"}
+        return self.state()
+
+    def state(self) -> dict:
+        state = {"POWER": self._power()}
+        if self.light:
+            channel = self._channels()
+            state.update(
+                {
+                    "Dimmer": self.dimmer,
+                    "Color": "".join(f"{round(c * 2.55):02X}" for c in channel),
+                    "HSBColor": "0,0,0"
+                    if self.hs is None
+                    else f"{self.hs[0]},{self.hs[1]},{self.dimmer}",
+                    "White": 0 if self.hs is not None else self.dimmer,
+                    "CT": self.ct,
+                    "Channel": channel,
+                }
+            )
+        state["Wifi"] = {"RSSI": 80}
+        return state
+
+    def _energy(self) -> dict:
+        now = time.monotonic()
+        self.total += self._watts * (now - self._metered_at) / 3600000
+        self._metered_at = now
+        self._watts = self.load * random.uniform(0.9, 1.1) if self.power else 0.0
+        voltage = random.uniform(225.0, 235.0)
+        return {
+            "Total": round(self.total, 3),
+            "Power": round(self._watts),
+            "Voltage": round(voltage),
+            "Current": round(self._watts / voltage, 3),
+        }
+
+    def _power(self) -> str:
+        return "ON" if self.power else "OFF"
+
+    def _channels(self) -> list:
+        # [R, G, B, cold white, warm white] in percent
+        if self.hs is not None:
+            rgb = colorsys.hsv_to_rgb(
+                self.hs[0] / 360, self.hs[1] / 100, self.dimmer / 100
+            )
+            return [round(c * 100) for c in rgb] + [0, 0]
+        warm = (self.ct - 153) / (500 - 153)
+        return [0, 0, 0, round(self.dimmer * (1 - warm)), round(self.dimmer * warm)]
+
+    def _set_color(self, value: str) -> None:
+        channels = [int(value[i : i + 2], 16) for i in range(0, len(value) - 1, 2)]
+        if not any(channels):
+            # all channels off, e.g. before a HSBColor
+            self.hs = (0, 0) if self.hs is not None else None
+            return
+        r, g, b = (channels + [0, 0, 0])[:3]
+        if r or g or b:
+            h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+            self.hs = (round(h * 360), round(s * 100))
+            self.dimmer = round(v * 100)
+
+
+class YeelightDevice:
+    def __init__(self) -> None:
+        self.props = dict(YEELIGHT_DEFAULTS)
+        self.requests = 0
+
+    def call(self, method: str, params: list) -> dict:
+        """
+        Returns
+        ----------
+        dict
+            The props that changed, pushed as a notification.
+
+        Raises
+        ----------
+        ValueError
+            Unknown method or invalid params, answered as an error.
+
+        """
+        self.requests += 1
+        if method == "set_power":
+            return self._set(power=params[0])
+        if method == "toggle":
+            return self._set(power="off" if self.props["power"] == "on" else "on")
+        if method == "set_bright":
+            return self._set(bright=str(_clamp(int(params[0]), 1, 100)))
+        if method == "set_ct_abx":
+            return self._set(ct=str(_clamp(int(params[0]), 1700, 6500)), color_mode="2")
+        if method == "set_rgb":
+            return self._set(rgb=str(int(params[0]) & 0xFFFFFF), color_mode="1")
+        if method == "set_hsv":
+            return self._set(hue=str(params[0]), sat=str(params[1]), color_mode="3")
+        if method == "set_name":
+            return self._set(name=str(params[0]))
+        raise ValueError("method not supported")
+
+    def _set(self, **props) -> dict:
+        changed = {k: v for k, v in props.items() if self.props.get(k) != v}
+        self.props.update(props)
+        return changed
+
+
+class Simulator:
+    def __init__(self, host: str = SIMULATOR_HOST, seed: Optional[int] = None) -> None:
+        self.host = host
+        self._random = random.Random(seed)
+        # [kind, model, conditions, port]
+        self._devices = []
+        self._loop = None
+        self._thread = None
+        self._servers = []
+        self._clients = {}
+        self.ready = threading.Event()
+
+    def add_tasmota(
+        self,
+        count: int = 1,
+        device_type: str = "tasmota-plug",
+        conditions: Optional[Conditions] = None,
+    ) -> list:
+        """Add simulated Tasmota devices, returns their models."""
+        if device_type not in TASMOTA_TYPES:
+            raise ValueError(f"Unknown tasmota type: {device_type}")
+        models = []
+        for _ in range(count):
+            # the name of the device in devices(), a topic made of a MAC
+            model = TasmotaDevice(
+                device_type,
+                name=f"sim {device_type} {len(self._devices)}",
+                topic=f"tasmota_{self._random.randrange(16 ** 6):06X}",
+            )
+            models.append(model)
+            self._devices.append(["tasmota", model, conditions or Conditions(), 0])
+        return models
+
+    def add_yeelight(
+        self, count: int = 1, conditions: Optional[Conditions] = None
+    ) -> list:
+        models = [YeelightDevice() for _ in range(count)]
+        for model in models:
+            self._devices.append(["yeelight", model, conditions or Conditions(), 0])
+        return models
+
+    def devices(self) -> list:
+        """The "devices" of iot_devices.json, once started."""
+        devices = []
+        for index, (kind, model, _, port) in enumerate(self._devices):
+            if kind == "tasmota":
+                devices.append(
+                    {
+                        "type": model.type,
+                        "name": model.name,
+                        "ip": f"{self.host}:{port}",
+                    }
+                )
+            else:
+                devices.append(
+                    {
+                        "type": "yeelight-bulb",
+                        "name": f"sim yeelight-bulb {index}",
+                        "ip": self.host,
+                        "port": port,
+                    }
+                )
+        return devices
+
+    def start(self) -> None:
+        """Serve every device in a background thread."""
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self._serve()), name="iot-simulator", daemon=True
+        )
+        self._thread.start()
+        if not self.ready.wait(30):
+            raise RuntimeError("Simulator did not start")
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread is not None:
+            self._thread.join(5)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        for entry in self._devices:
+            kind, model, conditions, _ = entry
+            handler = self._tasmota if kind == "tasmota" else self._yeelight
+            limiter = _RateLimiter(conditions)
+            lock = asyncio.Lock()
+            server = await asyncio.start_server(
+                lambda r, w, h=handler, e=entry, l=limiter, k=lock: h(r, w, e, l, k),
+                self.host,
+                0,
+            )
+            entry[3] = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        self.ready.set()
+        await self._stop_event.wait()
+        for server in self._servers:
+            server.close()
+        for writer in [w for writers in self._clients.values() for w in writers]:
+            writer.close()
+
+    async def _delay(self, conditions: Conditions) -> bool:
+        """Wait for the latency, False when the request is lost."""
+        delay = conditions.latency + self._random.uniform(0, conditions.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._random.random() >= conditions.loss
+
+    async def _tasmota(self, reader, writer, entry, limiter, lock) -> None:
+        _, model, conditions, _ = entry
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                # the web server of a device handles one request at a time
+                async with lock:
+                    if not await self._delay(conditions):
+                        break
+                    url = urlsplit(target)
+                    if url.path != "/cm":
+                        status, payload = 404, {"error": "Not Found"}
+                    elif not limiter.allow():
+                        status, payload = 503, {"error": "Busy"}
+                    else:
+                        cmnd = parse_qs(url.query).get("cmnd", [""])[0]
+                        status, payload = 200, self._execute(model, cmnd)
+                body = json.dumps(payload).encode()
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _execute(model: TasmotaDevice, cmnd: str) -> dict:
+        try:
+            return model.execute(cmnd)
+        except (ValueError, IndexError):
+            return {"Command": "Error"}
+
+    async def _yeelight(self, reader, writer, entry, limiter, lock) -> None:
+        _, model, conditions, _ = entry
+        clients = self._clients.setdefault(id(model), set())
+        clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await self._yeelight_request(
+                        line, writer, entry, limiter, answer=True
+                    )
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    async def _yeelight_request(
+        self, line: bytes, writer, entry, limiter, answer: bool
+    ) -> None:
+        _, model, conditions, _ = entry
+        try:
+            request = json.loads(line.strip())
+            method, params = request["method"], request.get("params") or []
+        except (ValueError, KeyError, TypeError):
+            return
+        if answer and not await self._delay(conditions):
+            return
+        reply = {"id": request.get("id")}
+        changed = {}
+        if answer and not limiter.allow():
+            reply["error"] = {"code": -1, "message": "client quota exceeded"}
+        elif method == "get_prop":
+            reply["result"] = [model.props.get(name, "") for name in params]
+        elif method == "set_music":
+            if params and params[0] == 1:
+                asyncio.ensure_future(self._music(params[1], int(params[2]), entry))
+            reply["result"] = ["ok"]
+        else:
+            try:
+                changed = model.call(method, params)
+                reply["result"] = ["ok"]
+            except (ValueError, IndexError, TypeError) as e:
+                reply["error"] = {"code": -1, "message": str(e)}
+        if answer:
+            writer.write(json.dumps(reply).encode() + b"\r\n")
+        if changed:
+            notification = {"method": "props", "params": changed}
+            for client in list(self._clients.get(id(model), ())):
+                client.write(json.dumps(notification).encode() + b"\r\n")
+
+    async def _music(self, host: str, port: int, entry) -> None:
+        # music mode: the bulb connects to the client, commands are not
+        # answered nor rate limited
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            return
+        limiter = _RateLimiter(Conditions())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await self._yeelight_request(
+                        line, writer, entry, limiter, answer=False
+                    )
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def _clamp(value: int, minx: int, maxx: int) -> int:
+    return max(minx, min(maxx, value))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serve simulated IoT devices")
+    parser.add_argument("--tasmota", type=int, default=0, help="tasmota plugs")
+    parser.add_argument("--lights", type=int, default=0, help="tasmota lights")
+    parser.add_argument("--yeelight", type=int, default=0, help="yeelight bulbs")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument("--loss", type=float, default=0, help="0..1")
+    parser.add_argument(
+        "--rate-limit", type=int, default=None, help="requests per second"
+    )
+    parser.add_argument(
+        "--write", type=Path, help="iot_devices.json written for the devices"
+    )
+    args = parser.parse_args(argv)
+
+    conditions = Conditions(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        loss=args.loss,
+        rate_limit=args.rate_limit,
+    )
+    simulator = Simulator()
+    simulator.add_tasmota(args.tasmota, "tasmota-plug", conditions)
+    simulator.add_tasmota(args.lights, "tasmota-light-RGBCCT", conditions)
+    simulator.add_yeelight(args.yeelight, conditions)
+    simulator.start()
+    devices = simulator.devices()
+    if args.write is not None:
+        with args.write.open("w") as filehandle:
+            json.dump({"iot": {"devices": devices}}, filehandle, indent=4)
+    for device in devices:
+        port = device.get("port")
+        print(f"{device['type']:22} {device['ip']}{'' if port is None else f':{port}'}")
+    print(f"Serving {len(devices)} devices, Ctrl-C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from main import STARTUP_BENCHMARK_ENV
+
+"""
+GUI startup benchmark.
+
+Two measures, each repeated in fresh interpreters:
+
+    imports         ``python -X importtime -c "import main"``, total and
+                    slowest top level imports (no display needed)
+    first frame     wall time from process start to the first drawn frame
+                    of the main window, reported by main.py when
+                    IOT_STARTUP_BENCHMARK is set
+
+    python startup_benchmark.py --runs 10
+    python startup_benchmark.py --command dist/main.exe
+
+``--command`` measures the first frame of another build, e.g. the pyinstaller
+executable. The main window is closed as soon as it is drawn.
+"""
+
+
+BASE_PATH = Path(__file__).parent
+DEFAULT_RUNS = 5
+# slowest top level imports listed
+TOP_IMPORTS = 10
+# seconds to wait for the first frame
+FIRST_FRAME_TIMEOUT = 30
+
+
+def measure_imports() -> tuple:
+    """
+    Returns
+    ----------
+    tuple
+        (microseconds to import main.py, {module imported by main.py:
+        cumulative microseconds})
+
+    """
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BASE_PATH,
+        capture_output=True,
+        text=True,
+    )
+    if r.returncode != 0:
+        raise RuntimeError(r.stderr.strip().splitlines()[-1])
+    # children are printed before their parent
+    total, modules, children = 0, {}, {}
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                total, modules = int(cumulative), children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    return total, modules
+
+
+def measure_first_frame(command: list) -> float:
+    """Seconds from the start of ``command`` to its "first-frame" line."""
+    env = dict(os.environ, **{STARTUP_BENCHMARK_ENV: "1"})
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        cwd=BASE_PATH,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        for line in process.stdout:
+            if line.strip() == "first-frame":
+                return time.perf_counter() - start
+        _, err = process.communicate(timeout=FIRST_FRAME_TIMEOUT)
+        lines = err.strip().splitlines() or ["no first frame"]
+        raise RuntimeError(lines[-1])
+    finally:
+        if process.poll() is None:
+            try:
+                process.wait(timeout=FIRST_FRAME_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _summary(values: list) -> str:
+    return (
+        f"median {statistics.median(values):7.1f} ms   "
+        f"min {min(values):7.1f} ms   max {max(values):7.1f} ms"
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the GUI startup time")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument(
+        "--command",
+        nargs="+",
+        default=[sys.executable, str(Path(BASE_PATH, "main.py"))],
+        help="program showing the main window, main.py by default",
+    )
+    args = parser.parse_args(argv)
+
+    totals = []
+    modules = {}
+    for _ in range(args.runs):
+        total, run_modules = measure_imports()
+        totals.append(total / 1000)
+        for name, cumulative in run_modules.items():
+            modules.setdefault(name, []).append(cumulative / 1000)
+    print(f"imports       {_summary(totals)}")
+    slowest = sorted(modules.items(), key=lambda item: -statistics.median(item[1]))
+    for name, values in slowest[:TOP_IMPORTS]:
+        print(f"  {name:30} {statistics.median(values):7.1f} ms")
+
+    frames = []
+    try:
+        for _ in range(args.runs):
+            frames.append(measure_first_frame(args.command) * 1000)
+    except RuntimeError as e:
+        print(f"first frame   unavailable: {e}")
+        return 1
+    print(f"first frame   {_summary(frames)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import heapq
+import threading
+import time
+from typing import Callable, Optional
+
+from config import Device
+
+"""
+Device state cache and background poller.
+
+``StateCache`` keeps the last known state of every device, keyed by address.
+Each entry expires after its own ttl, an expired entry reads as unknown.
+Listeners are told about every change, in the thread that made it.
+
+``StatePoller`` refreshes every configured device in the background, all of
+them concurrently on the command engine. The interval of a device adapts to
+its activity: it drops to ``min_interval`` when its state changed and doubles
+up to ``max_interval`` while nothing happens, or after a failure.
+
+    cache = StateCache()
+    poller = StatePoller(engine, cache, fetch)
+    poller.start(devices)
+    cache.get("192.168.15.41")  ->  {"POWER": "ON", ...} or None
+
+"""
+
+
+# seconds between two polls of an active device
+DEFAULT_MIN_INTERVAL = 5.0
+# seconds between two polls of an idle or unreachable device
+DEFAULT_MAX_INTERVAL = 60.0
+# entries written outside of the poller live this many seconds
+DEFAULT_TTL = 120.0
+
+
+def is_on(state: Optional[dict]) -> Optional[bool]:
+    """Power state of a tasmota or yeelight state, None when unknown."""
+    if not state:
+        return None
+    power = state.get("POWER", state.get("power"))
+    if power is None:
+        return None
+    return str(power).lower() == "on"
+
+
+def resolve_power(power: Optional[str], state: Optional[dict]) -> Optional[str]:
+    """ "on" or "off" a power setting leads to, None when unknown."""
+    if power == "toggle":
+        on = is_on(state)
+        return None if on is None else ("off" if on else "on")
+    return power if power in ("on", "off") else None
+
+
+class StateCache:
+    def __init__(self, default_ttl: float = DEFAULT_TTL) -> None:
+        self.default_ttl = default_ttl
+        self._entries = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def get(self, ip: str) -> Optional[dict]:
+        """Return a copy of the state of a device, None if unknown or expired."""
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                return None
+            state, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[ip]
+                return None
+            return dict(state)
+
+    def set(self, ip: str, state: dict, ttl: Optional[float] = None) -> bool:
+        """
+        Replace the state of a device.
+
+        Returns
+        ----------
+        bool
+            True if the state changed, listeners were notified.
+
+        """
+        return self._store(ip, dict(state), ttl)
+
+    def update(self, ip: str, partial: dict, ttl: Optional[float] = None) -> bool:
+        """Merge a partial state (e.g. a command reply) into the entry."""
+        with self._lock:
+            entry = self._entries.get(ip)
+            state = dict(entry[0]) if entry is not None else {}
+        state.update(partial)
+        return self._store(ip, state, ttl)
+
+    def invalidate(self, ip: str) -> None:
+        with self._lock:
+            self._entries.pop(ip, None)
+
+    def subscribe(self, listener: Callable[[str, dict], None]) -> None:
+        """``listener(ip, state)`` is called after every change."""
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[str, dict], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _store(self, ip: str, state: dict, ttl: Optional[float]) -> bool:
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(ip)
+            changed = entry is None or entry[0] != state
+            self._entries[ip] = (state, time.monotonic() + ttl)
+        if changed:
+            for listener in list(self._listeners):
+                listener(ip, dict(state))
+        return changed
+
+
+class StatePoller:
+    def __init__(
+        self,
+        engine,
+        cache: StateCache,
+        fetch: Callable[[dict], dict],
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        max_interval: float = DEFAULT_MAX_INTERVAL,
+        skip: Optional[Callable[[dict], bool]] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        engine : CommandEngine
+            Runs the polls.
+
+        cache : StateCache
+            Receives the polled states.
+
+        fetch : callable
+            Blocking ``fetch(device) -> dict`` returning the state of a device
+            from iot_devices.json.
+
+        skip : callable, optional
+            ``skip(device) -> bool``, devices kept up to date by other means
+            (e.g. MQTT) are not polled while it returns True.
+
+        """
+        self.engine = engine
+        self.cache = cache
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.skip = skip
+        self._devices = {}
+        self._intervals = {}
+        self._due = {}
+        self._in_flight = set()
+        self._heap = []
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self, devices: list) -> None:
+        with self._wakeup:
+            for device in devices:
+                self._add(device)
+        self._thread = threading.Thread(
+            target=self._run, name="iot-state-poller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def set_devices(self, devices: list) -> None:
+        """Replace the polled devices, known devices keep their interval."""
+        with self._wakeup:
+            wanted = {device.ip: device for device in devices}
+            for ip in list(self._devices):
+                if ip not in wanted:
+                    del self._devices[ip]
+                    self._intervals.pop(ip, None)
+                    self._due.pop(ip, None)
+            for ip, device in wanted.items():
+                if ip in self._devices:
+                    self._devices[ip] = device
+                else:
+                    self._add(device)
+            self._wakeup.notify()
+
+    def refresh(self, ip: str) -> None:
+        """Poll a device as soon as possible, e.g. after a command."""
+        with self._wakeup:
+            if ip in self._devices:
+                self._intervals[ip] = self.min_interval
+                self._schedule(ip, time.monotonic())
+                self._wakeup.notify()
+
+    def _add(self, device: Device) -> None:
+        # called with self._wakeup held, new devices are polled right away
+        self._devices[device.ip] = device
+        self._intervals[device.ip] = self.min_interval
+        self._schedule(device.ip, time.monotonic())
+
+    def _schedule(self, ip: str, due: float) -> None:
+        # called with self._wakeup held. A device has a single valid heap
+        # entry, the one matching self._due, older ones are skipped.
+        self._due[ip] = due
+        heapq.heappush(self._heap, (due, ip))
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due_at, ip = heapq.heappop(self._heap)
+                    if self._due.get(ip) != due_at:
+                        continue
+                    if self.skip is not None and self.skip(self._devices[ip]):
+                        self._schedule(ip, now + self.max_interval)
+                        continue
+                    if ip not in self._in_flight:
+                        self._in_flight.add(ip)
+                        due.append(self._devices[ip])
+            for device in due:
+                try:
+                    future = self.engine.submit(self.fetch, device)
+                except RuntimeError:
+                    # engine shut down
+                    return
+                future.add_done_callback(lambda f, ip=device.ip: self._polled(ip, f))
+
+    def _polled(self, ip: str, future) -> None:
+        changed = False
+        failed = future.cancelled() or future.exception() is not None
+        with self._wakeup:
+            self._in_flight.discard(ip)
+            if ip not in self._devices:
+                return
+            interval = self._intervals.get(ip, self.min_interval)
+        if not failed:
+            # entries outlive the next poll, a single missed poll does not
+            # turn a device into unknown
+            changed = self.cache.set(ip, future.result(), ttl=interval * 3)
+        with self._wakeup:
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * 2)
+            self._intervals[ip] = interval
+            self._schedule(ip, time.monotonic() + interval)
+            self._wakeup.notify()
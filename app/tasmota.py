@@ -0,0 +1,196 @@
+import json
+import time
+from typing import Iterable, Optional, Union
+from urllib.parse import quote
+
+from metrics import PHASE_SECONDS, metrics
+
+"""
+Tasmota command building.
+
+Every web request is a full round-trip to the device. Commands belonging to
+one user action are sent as a single ``Backlog``, which Tasmota executes in
+order, so the light never shows an intermediate state for a whole round-trip.
+
+    Backlog("Power ON", "Dimmer 40")      -> "Backlog0 Power ON; Dimmer 40"
+    Backlog("Power Toggle")               -> "Power Toggle"
+    Backlog.rgb_color(245, 97, 97)        -> "Backlog0 Color 0000000000; HSBColor 245,97,97"
+
+https://tasmota.github.io/docs/Commands/#the-power-of-backlog
+
+``TasmotaHttpClient`` sends one-shot web requests with the standard library.
+Short-lived processes (the command line) use it instead of the keep-alive
+pool of http_pool.py, importing requests would cost more than the command.
+"""
+
+
+# Backlog0 runs the commands without the SetOption34 delay (200ms by default)
+# between them, the light goes from one color to the next without flicker.
+BACKLOG_NO_DELAY = True
+# Tasmota accepts at most 30 commands in one Backlog
+BACKLOG_MAX_COMMANDS = 30
+
+# All 5 channels off [R,G,B, Cold White, Warm White]
+COLOR_ALL_OFF = "Color 0000000000"
+
+
+class ConnectionError(Exception):
+    pass
+
+
+class ResponseCodeError(Exception):
+    pass
+
+
+class RequestError(Exception):
+    pass
+
+
+class Backlog:
+    def __init__(self, *commands: str, no_delay: bool = BACKLOG_NO_DELAY) -> None:
+        self.commands = []
+        self.no_delay = no_delay
+        self.extend(commands)
+
+    def add(self, command: str) -> "Backlog":
+        command = command.strip()
+        if not command:
+            return self
+        if len(self.commands) >= BACKLOG_MAX_COMMANDS:
+            raise ValueError(f"Backlog is limited to {BACKLOG_MAX_COMMANDS} commands")
+        self.commands.append(command)
+        return self
+
+    def extend(self, commands: Iterable[Union[str, "Backlog"]]) -> "Backlog":
+        for command in commands:
+            if isinstance(command, Backlog):
+                self.extend(command.commands)
+            else:
+                self.add(command)
+        return self
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __str__(self) -> str:
+        if len(self.commands) == 1:
+            return self.commands[0]
+        prefix = "Backlog0" if self.no_delay else "Backlog"
+        return f"{prefix} {'; '.join(self.commands)}"
+
+    def __repr__(self) -> str:
+        return f"Backlog({str(self)!r})"
+
+    @classmethod
+    def rgb_color(cls, hue: int, sat: int, bri: int) -> "Backlog":
+        """
+        Switch a RGBCCT light to a RGB color.
+
+        The white LEDs and the RGB LEDs must never be on at the same time on
+        RGBCCT bulbs, all channels are reset before the color is applied.
+        """
+        return cls(COLOR_ALL_OFF, f"HSBColor {hue},{sat},{bri}")
+
+    @classmethod
+    def white(cls, cold: int, warm: int = 0) -> "Backlog":
+        """
+        Switch a RGBCCT light to its white LEDs, RGB channels off.
+
+        Parameters
+        ----------
+        cold, warm : int
+            Channel values 0..255 of the cold and warm white LEDs.
+
+        """
+        return cls(f"Color 000000{cold:02X}{warm:02X}")
+
+
+def merge_reply(state: dict, reply: dict) -> dict:
+    """
+    Update a device state with the json reply of a command.
+
+    Single commands reply with the whole light state, Backlog replies may only
+    carry part of it, or a warning on older firmwares.
+    """
+    for key, value in reply.items():
+        if key != "WARNING":
+            state[key] = value
+    return state
+
+
+def energy_reading(reply: dict) -> Optional[dict]:
+    """
+    Power and energy of a ``Status 8`` reply, None when the device has no
+    energy monitor. Devices with several channels report a list per value.
+
+        {"StatusSNS": {"ENERGY": {"Total": 12.3, "Power": 45, ...}}}
+        -> {"power": 45.0, "energy": 12.3, "voltage": ..., "current": ...}
+
+    """
+    energy = (reply.get("StatusSNS") or {}).get("ENERGY")
+    if not isinstance(energy, dict) or "Power" not in energy:
+        return None
+
+    def _value(key: str) -> float:
+        value = energy.get(key) or 0
+        return float(sum(value) if isinstance(value, list) else value)
+
+    return {
+        "power": _value("Power"),
+        "energy": _value("Total"),
+        "voltage": _value("Voltage"),
+        "current": _value("Current"),
+    }
+
+
+class TasmotaReply:
+    """Same interface as the requests.Response used by the keep-alive pool."""
+
+    def __init__(self, status_code: int, content: bytes) -> None:
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class TasmotaHttpClient:
+    def get(self, ip: str, cmnd, timeout: float) -> TasmotaReply:
+        """
+        Send a command to the device.
+            http://device_ip/cm?cmnd={cmnd}
+
+        Raises
+        ----------
+        ConnectionError
+            The device could not be reached in time.
+
+        """
+        import http.client
+
+        host, _, port = ip.partition(":")
+        conn = http.client.HTTPConnection(host, int(port or 80), timeout=timeout)
+        try:
+            start = time.perf_counter()
+            conn.connect()
+            connected = time.perf_counter()
+            conn.request("GET", f"/cm?cmnd={quote(str(cmnd))}")
+            r = conn.getresponse()
+            reply = TasmotaReply(r.status, r.read())
+            metrics.observe(PHASE_SECONDS, connected - start, phase="connect")
+            metrics.observe(
+                PHASE_SECONDS, time.perf_counter() - connected, phase="device"
+            )
+            return reply
+        except TimeoutError:
+            raise ConnectionError("Connection Time out")
+        except (OSError, http.client.HTTPException) as e:
+            raise ConnectionError(e)
+        finally:
+            conn.close()
+
+    def discard(self, ip: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
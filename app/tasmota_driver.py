@@ -0,0 +1,153 @@
+import logging
+from typing import Optional
+
+from colors import clamp, rgb2hsv
+from config import Device
+from drivers import Driver
+from scenes import tasmota_backlog
+from state import resolve_power
+from tasmota import (
+    Backlog,
+    ConnectionError,
+    RequestError,
+    ResponseCodeError,
+    energy_reading,
+    merge_reply,
+)
+
+"""
+Tasmota plugs, switches and RGBCCT lights.
+
+Commands go over MQTT when the device is reachable through the broker,
+otherwise over HTTP with the client of the controller (keep-alive pool in the
+GUI, one-shot requests on the command line). Replies are merged into the state
+cache.
+"""
+
+
+# seconds to wait for a toggle or a set
+TOGGLE_TIMEOUT = 3
+# seconds to wait for any other command
+COMMAND_TIMEOUT = 4
+# energy monitor reading, see energy_reading
+ENERGY_COMMAND = "Status 8"
+# seconds between two frames of an effect, the web server handles one request
+# at a time
+FRAME_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class TasmotaDriver(Driver):
+    def command(self, device: Device, cmnd, timeout: float = COMMAND_TIMEOUT) -> dict:
+        """
+        Send web request to device and return its json reply.
+            http://device_ip/cm?cmnd={cmnd}
+
+        Parameters
+        ----------
+        cmnd : str or Backlog
+            The command to be attached to Web Request
+
+            e.g.:
+                Dimmer 10
+
+                STATUS
+
+                HSBColor 250,55,44
+
+        """
+        logger.debug("%s > %s", device.name, cmnd)
+        r = self.controller.http.get(device.ip, cmnd, timeout=timeout)
+        if r.status_code != 200:
+            raise ResponseCodeError("Got Wrong responde code from device")
+        try:
+            reply = r.json()
+        except ValueError:
+            raise RequestError("Unknow Request Error")
+        logger.debug("%s < %s", device.name, reply)
+        return reply
+
+    def connect(self, device: Device) -> None:
+        mqtt = self.controller.mqtt
+        if mqtt is not None and device.topic:
+            mqtt.add_device(device.ip, device.topic)
+
+    def disconnect(self, device: Device) -> None:
+        if self.controller.mqtt is not None:
+            self.controller.mqtt.remove_device(device.ip)
+        self.controller.http.discard(device.ip)
+
+    def is_pushing(self, device: Device) -> bool:
+        mqtt = self.controller.mqtt
+        return mqtt is not None and mqtt.has(device.ip)
+
+    def get_state(self, device: Device) -> dict:
+        return self.command(device, "STATE")
+
+    def toggle(self, device: Device) -> dict:
+        """Toggle the power of a device, returns the reply of the device."""
+        reply = self.send(device, Backlog("Power Toggle"))
+        if self.is_pushing(device):
+            return reply
+        if reply.get("POWER") is None:
+            raise ResponseCodeError("Got no POWER state from device")
+        return reply
+
+    def set(self, device: Device, settings: dict) -> dict:
+        return self.send(device, tasmota_backlog(device, settings))
+
+    def batch(self, device: Device, settings: list) -> dict:
+        """All settings in a single Backlog, a single round-trip."""
+        backlog = Backlog()
+        for values in settings:
+            backlog.extend([tasmota_backlog(device, values)])
+        return self.send(device, backlog)
+
+    def expected_state(self, device: Device, settings: dict, state: dict) -> dict:
+        expected = {}
+        power = resolve_power(settings.get("power"), state)
+        if power is not None:
+            expected["POWER"] = power.upper()
+        if device.type == "tasmota-light-RGBCCT":
+            # same values as tasmota_backlog
+            if "color" in settings:
+                h, s, v = rgb2hsv(settings["color"])
+                expected["HSBColor"] = f"{h},{s},{v}"
+            elif "ct" in settings:
+                expected["CT"] = clamp(int(settings["ct"]), 153, 500)
+            if "dimmer" in settings:
+                expected["Dimmer"] = clamp(int(settings["dimmer"]), 0, 100)
+        return expected
+
+    def is_unreachable(self, error: Exception) -> bool:
+        return isinstance(error, (ConnectionError, OSError))
+
+    def energy(self, device: Device) -> Optional[dict]:
+        # over HTTP even with MQTT, the reply is needed here
+        return energy_reading(self.command(device, ENERGY_COMMAND))
+
+    def send(self, device: Device, backlog: Backlog) -> dict:
+        if not len(backlog):
+            return {}
+        if self.is_pushing(device):
+            # the result is published by the device, straight into the cache
+            self.controller.mqtt.send(device.ip, backlog)
+            return {}
+        reply = self.command(device, backlog, timeout=TOGGLE_TIMEOUT)
+        self.controller.cache.update(device.ip, merge_reply({}, reply))
+        return reply
+
+
+class TasmotaLightDriver(TasmotaDriver):
+    window = "tasmota-light"
+    frame_interval = FRAME_INTERVAL
+
+    def frame(
+        self, device: Device, hue: int, sat: int, bri: int, first: bool = False
+    ) -> None:
+        if first:
+            # white LEDs off before the RGB ones are used, see Backlog.rgb_color
+            self.send(device, Backlog.rgb_color(hue, sat, bri))
+        else:
+            self.send(device, Backlog(f"HSBColor {hue},{sat},{bri}"))
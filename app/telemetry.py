@@ -0,0 +1,566 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from config import Config, Device
+from health import DeviceUnavailableError
+from lockfile import LOCK_REFRESH_INTERVAL, OwnerLock
+from metrics import TELEMETRY_SAMPLES_TOTAL, metrics
+
+"""
+Energy telemetry of the plugs.
+
+Tasmota plugs with an energy monitor report their power and energy counter
+(``Status 8``). When the "telemetry" section is set, every metered device is
+sampled at the same time every ``interval`` seconds, on a thread pool:
+
+    "iot": {
+        "telemetry": {"interval": 10, "raw_days": 2,
+                      "five_minute_days": 90, "hourly_days": 1095},
+        ...
+    }
+
+Samples go to one file per device under ``path`` (".telemetry" next to
+iot_devices.json), memory-mapped, holding a ring buffer per resolution:
+
+    raw         one record per sample, ``raw_days`` of them
+    5 minutes   min, max and average power of 5 minutes, ``five_minute_days``
+    1 hour      same per hour, ``hourly_days``
+
+A sample is written to every ring, the coarser ones update their last record
+in place, so the files have a fixed size and nothing is ever compacted: 28
+bytes per record, ~2 MB per plug with the defaults, whatever the uptime. Pages
+are cached by the OS, only those read or written recently use memory.
+
+Queries read the range with a binary search, then merge the records into
+buckets (min, max, average weighted by the samples, energy counter at the end
+of the bucket), from the coarsest ring the bucket is a multiple of.
+
+A lock file lets a single process (the GUI or ``cli.py serve``) sample the
+devices, any process can read the files.
+"""
+
+
+# seconds between two samples
+TELEMETRY_INTERVAL = 10
+# days kept by the raw, 5 minutes and hourly rings
+TELEMETRY_RAW_DAYS = 2
+TELEMETRY_FIVE_MINUTE_DAYS = 90
+TELEMETRY_HOURLY_DAYS = 1095
+# directory of the telemetry files, relative to iot_devices.json
+TELEMETRY_PATH = ".telemetry"
+# devices sampled at the same time
+TELEMETRY_MAX_WORKERS = 32
+# seconds before a device that reported no energy is asked again
+TELEMETRY_RECHECK = 3600.0
+# buckets of a query without a bucket size
+QUERY_BUCKETS = 300
+# magic, version, number of rings
+FILE_HEADER = struct.Struct("<4sHH")
+# resolution (seconds), capacity (records), head (next record), count
+RING_HEADER = struct.Struct("<IIII")
+# start, samples, average, min, max power (W), energy counter at the end (kWh)
+RECORD = struct.Struct("<IIfffd")
+FILE_MAGIC = b"IOTE"
+FILE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def telemetry_path(config_path: Path, options: dict) -> Path:
+    """Directory of the telemetry files of a config file."""
+    return Path(Path(config_path).parent, options.get("path", TELEMETRY_PATH))
+
+
+def ring_specs(options: dict) -> tuple:
+    """((resolution, capacity), ...) of the rings, finest first."""
+    interval = max(1, int(options.get("interval", TELEMETRY_INTERVAL)))
+    specs = [(interval, options.get("raw_days", TELEMETRY_RAW_DAYS))]
+    for resolution, days in (
+        (300, options.get("five_minute_days", TELEMETRY_FIVE_MINUTE_DAYS)),
+        (3600, options.get("hourly_days", TELEMETRY_HOURLY_DAYS)),
+    ):
+        if resolution > interval:
+            specs.append((resolution, days))
+    return tuple(
+        (resolution, max(1, int(days * 86400 / resolution)))
+        for resolution, days in specs
+    )
+
+
+def series_file(directory: Path, name: str) -> Path:
+    """File of a device, names differing only by their punctuation do not clash."""
+    slug = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")[:40]
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return Path(directory, f"{slug}-{digest}.ring")
+
+
+class Ring:
+    """One ring buffer of records inside a mapped file."""
+
+    __slots__ = ("data", "offset", "resolution", "capacity")
+
+    def __init__(self, data, offset: int) -> None:
+        self.data = data
+        self.offset = offset
+        self.resolution, self.capacity, _, _ = RING_HEADER.unpack_from(data, offset)
+
+    @property
+    def size(self) -> int:
+        return RING_HEADER.size + self.capacity * RECORD.size
+
+    def _cursor(self) -> tuple:
+        # (head, count)
+        return struct.unpack_from("<II", self.data, self.offset + 8)
+
+    def _position(self, index: int, head: int, count: int) -> int:
+        # byte offset of the index-th oldest record
+        slot = (head - count + index) % self.capacity
+        return self.offset + RING_HEADER.size + slot * RECORD.size
+
+    def __len__(self) -> int:
+        return self._cursor()[1]
+
+    def last(self) -> Optional[tuple]:
+        head, count = self._cursor()
+        if not count:
+            return None
+        return RECORD.unpack_from(self.data, self._position(count - 1, head, count))
+
+    def append(self, record: tuple) -> None:
+        head, count = self._cursor()
+        RECORD.pack_into(self.data, self._position(count, head, count), *record)
+        # the record is complete before the readers see it
+        struct.pack_into(
+            "<II",
+            self.data,
+            self.offset + 8,
+            (head + 1) % self.capacity,
+            min(count + 1, self.capacity),
+        )
+
+    def replace_last(self, record: tuple) -> None:
+        head, count = self._cursor()
+        RECORD.pack_into(self.data, self._position(count - 1, head, count), *record)
+
+    def records(self, start: float = 0, end: float = float("inf")) -> list:
+        """Records starting in [start, end), oldest first."""
+        head, count = self._cursor()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = self._position(middle, head, count)
+            if struct.unpack_from("<I", self.data, position)[0] < start:
+                low = middle + 1
+            else:
+                high = middle
+        first = low
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            position = self._position(middle, head, count)
+            if struct.unpack_from("<I", self.data, position)[0] < end:
+                low = middle + 1
+            else:
+                high = middle
+        records = []
+        index = first
+        while index < low:
+            # contiguous slots up to the end of the buffer, then from its start
+            position = self._position(index, head, count)
+            slot = (position - self.offset - RING_HEADER.size) // RECORD.size
+            run = min(low - index, self.capacity - slot)
+            chunk = self.data[position : position + run * RECORD.size]
+            records.extend(RECORD.iter_unpack(chunk))
+            index += run
+        return records
+
+
+class RingFile:
+    """The memory-mapped file of a device and its rings, finest first."""
+
+    def __init__(self, path: Path, specs: Optional[tuple] = None) -> None:
+        """
+        Parameters
+        ----------
+        specs : tuple, optional
+            ((resolution, capacity), ...) to open the file for writing,
+            creating it, or converting it when the rings changed. Read-only
+            with the rings of the file when None.
+
+        Raises
+        ----------
+        OSError
+            The file is missing (read-only) or could not be created.
+
+        ValueError
+            Not a telemetry file.
+
+        """
+        self.path = Path(path)
+        if specs is not None:
+            self._prepare(specs)
+        with self.path.open("r+b" if specs is not None else "rb") as filehandle:
+            self._data = mmap.mmap(
+                filehandle.fileno(),
+                0,
+                access=mmap.ACCESS_WRITE if specs is not None else mmap.ACCESS_READ,
+            )
+        try:
+            self.rings = _read_rings(self._data)
+        except (ValueError, struct.error):
+            self._data.close()
+            raise ValueError(f"{self.path.name}: not a telemetry file")
+
+    def specs(self) -> tuple:
+        return tuple((ring.resolution, ring.capacity) for ring in self.rings)
+
+    def add(self, t: int, power: float, energy: float) -> None:
+        """A sample, merged into the current record of each ring."""
+        for ring in self.rings:
+            start = t - t % ring.resolution
+            last = ring.last()
+            if last is None or last[0] < start:
+                ring.append((start, 1, power, power, power, energy))
+            elif last[0] == start:
+                _, count, average, low, high, _ = last
+                ring.replace_last(
+                    (
+                        start,
+                        count + 1,
+                        (average * count + power) / (count + 1),
+                        min(low, power),
+                        max(high, power),
+                        energy,
+                    )
+                )
+            # else the clock went back, the sample is dropped
+
+    def close(self) -> None:
+        if not self._data.closed:
+            self._data.close()
+
+    def _prepare(self, specs: tuple) -> None:
+        old = None
+        try:
+            old = RingFile(self.path)
+            if old.specs() == tuple(specs):
+                return
+            logger.info("Converting %s to %s", self.path.name, specs)
+            kept = {ring.resolution: ring.records() for ring in old.rings}
+        except FileNotFoundError:
+            kept = {}
+        except (OSError, ValueError) as e:
+            logger.warning("Replacing %s: %s", self.path.name, e)
+            kept = {}
+        finally:
+            if old is not None:
+                old.close()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        size = FILE_HEADER.size + sum(
+            RING_HEADER.size + capacity * RECORD.size for _, capacity in specs
+        )
+        tmp = Path(f"{self.path}.tmp")
+        with tmp.open("w+b") as filehandle:
+            # sparse until written
+            filehandle.truncate(size)
+            data = mmap.mmap(filehandle.fileno(), size)
+            FILE_HEADER.pack_into(data, 0, FILE_MAGIC, FILE_VERSION, len(specs))
+            offset = FILE_HEADER.size
+            for resolution, capacity in specs:
+                RING_HEADER.pack_into(data, offset, resolution, capacity, 0, 0)
+                ring = Ring(data, offset)
+                for record in kept.get(resolution, [])[-capacity:]:
+                    ring.append(record)
+                offset += ring.size
+            data.flush()
+            data.close()
+        os.replace(tmp, self.path)
+
+
+def _read_rings(data) -> list:
+    magic, version, count = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise ValueError("bad header")
+    rings = []
+    offset = FILE_HEADER.size
+    for _ in range(count):
+        ring = Ring(data, offset)
+        offset += ring.size
+        if offset > len(data):
+            raise ValueError("truncated")
+        rings.append(ring)
+    return rings
+
+
+def downsample(records: list, bucket: int) -> list:
+    """Merge records into buckets of ``bucket`` seconds aligned on the epoch."""
+    merged = []
+    current = None
+    for start, count, average, low, high, energy in records:
+        key = start - start % bucket
+        if current is None or current[0] != key:
+            current = [key, 0, 0.0, low, high, energy]
+            merged.append(current)
+        current[1] += count
+        current[2] += average * count
+        current[3] = min(current[3], low)
+        current[4] = max(current[4], high)
+        current[5] = energy
+    return [
+        {
+            "t": key,
+            "samples": count,
+            "avg": round(total / count, 2),
+            "min": round(low, 2),
+            "max": round(high, 2),
+            "energy": round(energy, 3),
+        }
+        for key, count, total, low, high, energy in merged
+    ]
+
+
+def consumed(points: list) -> float:
+    """kWh used over the buckets of ``downsample``, across counter resets."""
+    total = 0.0
+    for previous, point in zip(points, points[1:]):
+        total += max(0.0, point["energy"] - previous["energy"])
+    return round(total, 3)
+
+
+class TelemetryStore:
+    def __init__(self, directory: Path, specs: tuple) -> None:
+        """
+        Parameters
+        ----------
+        directory : Path
+            One file per device, see ``series_file``.
+
+        specs : tuple
+            Rings of the written files, see ``ring_specs``.
+
+        """
+        self.directory = Path(directory)
+        self.specs = specs
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, t: int, power: float, energy: float) -> None:
+        with self._lock:
+            ring_file = self._files.get(name)
+            if ring_file is None:
+                ring_file = RingFile(series_file(self.directory, name), self.specs)
+                self._files[name] = ring_file
+            ring_file.add(t, power, energy)
+
+    def query(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        bucket: Optional[int] = None,
+    ) -> dict:
+        """
+        Samples of a device from ``start`` to ``end`` (timestamps).
+
+        Parameters
+        ----------
+        bucket : int, optional
+            Seconds per point, about ``QUERY_BUCKETS`` points when None.
+
+        Returns
+        ----------
+        dict
+            {"device", "bucket", "points": [{"t", "samples", "avg", "min",
+            "max", "energy"}, ...], "kwh"}, power in W, energy in kWh.
+
+        """
+        try:
+            # mapped again for each query: the writer may be another process
+            ring_file = RingFile(series_file(self.directory, name))
+        except (OSError, ValueError):
+            return {"device": name, "bucket": bucket, "points": [], "kwh": 0.0}
+        try:
+            rings = ring_file.rings
+            if bucket is None:
+                bucket = int((end - start) / QUERY_BUCKETS)
+            bucket = max(rings[0].resolution, int(bucket))
+            # records of a coarser ring are the merge of the finer ones
+            ring = rings[0]
+            for candidate in rings:
+                if bucket % candidate.resolution == 0:
+                    ring = candidate
+            start = start - start % ring.resolution
+            points = downsample(ring.records(start, end), bucket)
+        finally:
+            ring_file.close()
+        return {
+            "device": name,
+            "bucket": bucket,
+            "points": points,
+            "kwh": consumed(points),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            for ring_file in self._files.values():
+                ring_file.close()
+            self._files.clear()
+
+
+def store_from_config(config: Config, config_path: Path) -> Optional[TelemetryStore]:
+    """Store of the "telemetry" section of iot_devices.json, None when missing."""
+    options = config.telemetry
+    if options is None:
+        return None
+    return TelemetryStore(telemetry_path(config_path, options), ring_specs(options))
+
+
+class TelemetryCollector:
+    def __init__(
+        self,
+        controller,
+        store: TelemetryStore,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        max_workers: int = TELEMETRY_MAX_WORKERS,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        controller : Controller
+            Reads the energy of the devices, its config holds the interval.
+
+        store : TelemetryStore
+            Receives the samples. Its lock file sits in its directory.
+
+        on_error : callable, optional
+            ``on_error(exception)`` when the store can not be written. Called
+            from the worker threads.
+
+        """
+        self.controller = controller
+        self.store = store
+        self.on_error = on_error
+        self.max_workers = max_workers
+        self.clock = clock
+        self._lock = OwnerLock(Path(store.directory, ".lock"))
+        self._owner = False
+        # ip: time of the next energy read of a device without a meter
+        self._unmetered = {}
+        self._in_flight = set()
+        self._due = 0.0
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="iot-telemetry"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="iot-telemetry", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self.store.close()
+
+    @property
+    def is_owner(self) -> bool:
+        """This process samples the devices, see the lock file."""
+        return self._owner
+
+    def _run(self) -> None:
+        refreshed = 0.0
+        while True:
+            with self._wakeup:
+                if self._stopped:
+                    break
+                if not self._owner:
+                    try:
+                        self.store.directory.mkdir(parents=True, exist_ok=True)
+                    except OSError as e:
+                        logger.warning("Telemetry disabled: %s", e)
+                    self._owner = self._lock.acquire()
+                    refreshed = time.monotonic()
+                options = self.controller.config.telemetry
+                if not self._owner or options is None:
+                    self._wakeup.wait(LOCK_REFRESH_INTERVAL)
+                    continue
+                if time.monotonic() - refreshed >= LOCK_REFRESH_INTERVAL:
+                    self._lock.refresh()
+                    refreshed = time.monotonic()
+                interval = max(1, int(options.get("interval", TELEMETRY_INTERVAL)))
+                now = self.clock()
+                if now < self._due:
+                    self._wakeup.wait(self._due - now)
+                    continue
+                self._due = (now // interval + 1) * interval
+                self._sample_all(int(now - now % interval))
+        with self._wakeup:
+            if self._owner:
+                self._lock.release()
+                self._owner = False
+
+    def _sample_all(self, t: int) -> None:
+        # called with self._wakeup held
+        now = time.monotonic()
+        for device in self.controller.config.devices:
+            if self._unmetered.get(device.ip, 0) > now:
+                continue
+            if device.ip in self._in_flight:
+                # the previous read is not done, skip this one
+                metrics.inc(TELEMETRY_SAMPLES_TOTAL, result="late")
+                continue
+            if not self.controller.is_available(device):
+                continue
+            self._in_flight.add(device.ip)
+            try:
+                self._executor.submit(self._sample, device, t)
+            except RuntimeError:
+                # stopped
+                return
+
+    def _sample(self, device: Device, t: int) -> None:
+        try:
+            try:
+                reading = self.controller.energy(device)
+            except DeviceUnavailableError:
+                return
+            except Exception as e:
+                logger.debug("Energy of %s not read: %s", device.name, e)
+                metrics.inc(TELEMETRY_SAMPLES_TOTAL, result="error")
+                return
+            if reading is None:
+                with self._wakeup:
+                    self._unmetered[device.ip] = time.monotonic() + TELEMETRY_RECHECK
+                return
+            try:
+                self.store.add(device.name, t, reading["power"], reading["energy"])
+            except (OSError, ValueError) as e:
+                logger.warning("Telemetry of %s not saved: %s", device.name, e)
+                metrics.inc(TELEMETRY_SAMPLES_TOTAL, result="error")
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+            metrics.inc(TELEMETRY_SAMPLES_TOTAL, result="ok")
+        finally:
+            with self._wakeup:
+                self._in_flight.discard(device.ip)
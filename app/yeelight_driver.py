@@ -0,0 +1,142 @@
+import threading
+
+from colors import clamp
+from config import Device
+from drivers import Driver
+from state import resolve_power
+
+"""
+Yeelight bulbs.
+
+One connection per bulb, kept open by the ``BulbRegistry``. Once connected, a
+bulb pushes its state changes into the state cache and is not polled. The
+yeelight library is imported by the first bulb operation, not with the driver.
+"""
+
+
+# yeelight color temperature range in kelvin
+YEELIGHT_KELVIN_MIN = 1700
+YEELIGHT_KELVIN_MAX = 6500
+# seconds between two frames of an effect, the first frames count against the
+# ~60 commands/minute quota until the bulb is in music mode
+FRAME_INTERVAL = 0.25
+
+
+class YeelightDriver(Driver):
+    window = "yeelight"
+    frame_interval = FRAME_INTERVAL
+
+    def __init__(self, controller) -> None:
+        super().__init__(controller)
+        self._bulbs = None
+        self._lock = threading.Lock()
+        # brightness of the last effect frame by ip, the bulb does not report
+        # its state in music mode
+        self._frame_bright = {}
+
+    @property
+    def bulbs(self):
+        with self._lock:
+            if self._bulbs is None:
+                from yeelight_manager import BulbRegistry
+
+                self._bulbs = BulbRegistry()
+            return self._bulbs
+
+    def bulb(self, device: Device):
+        return self.bulbs.get(device.ip, device.port)
+
+    def connect(self, device: Device) -> None:
+        self.bulbs.listen(device.ip, self.controller.cache, device.port)
+
+    def disconnect(self, device: Device) -> None:
+        self._frame_bright.pop(device.ip, None)
+        if self._bulbs is not None:
+            self._bulbs.discard(device.ip)
+
+    def is_pushing(self, device: Device) -> bool:
+        return self._bulbs is not None and self._bulbs.is_listening(device.ip)
+
+    def command(self, device: Device, cmnd: tuple, continuous: bool = False):
+        """
+        Call a bulb method.
+
+        Parameters
+        ----------
+        cmnd : tuple
+            Name of the ``Bulb`` method and its arguments, e.g.
+            ("set_brightness", 50).
+
+        continuous : bool
+            The command is part of a stream of adjustments, see
+            ``yeelight_manager.ManagedBulb.call``.
+
+        """
+        method, *args = cmnd
+        return self.bulb(device).call(method, *args, continuous=continuous)
+
+    def get_state(self, device: Device) -> dict:
+        return self.bulb(device).call("get_properties")
+
+    def toggle(self, device: Device) -> dict:
+        self.bulb(device).call("toggle")
+        return {}
+
+    def set(self, device: Device, settings: dict) -> dict:
+        bulb = self.bulb(device)
+        power = settings.get("power")
+        if power == "on":
+            bulb.call("turn_on")
+        if "color" in settings:
+            rgb = settings["color"].strip().lstrip("#")
+            bulb.call("set_rgb", *(int(rgb[i : i + 2], 16) for i in (0, 2, 4)))
+        elif "ct" in settings:
+            kelvin = round(1000000 / max(1, int(settings["ct"])))
+            kelvin = clamp(kelvin, YEELIGHT_KELVIN_MIN, YEELIGHT_KELVIN_MAX)
+            bulb.call("set_color_temp", kelvin)
+        if "dimmer" in settings:
+            bulb.call("set_brightness", clamp(int(settings["dimmer"]), 1, 100))
+        if power == "off":
+            bulb.call("turn_off")
+        elif power == "toggle":
+            bulb.call("toggle")
+        return {}
+
+    def expected_state(self, device: Device, settings: dict, state: dict) -> dict:
+        expected = {}
+        power = resolve_power(settings.get("power"), state)
+        if power is not None:
+            expected["power"] = power
+        if "dimmer" in settings:
+            expected["bright"] = str(clamp(int(settings["dimmer"]), 1, 100))
+        return expected
+
+    def frame(
+        self, device: Device, hue: int, sat: int, bri: int, first: bool = False
+    ) -> None:
+        bulb = self.bulb(device)
+        # a stream of frames switches the bulb to music mode, no quota there
+        milliseconds = max(30, int(self.frame_interval * 1000))
+        bulb.call(
+            "set_hsv", hue, sat, continuous=True, effect="smooth", duration=milliseconds
+        )
+        bri = clamp(bri, 1, 100)
+        if first or self._frame_bright.get(device.ip) != bri:
+            bulb.call(
+                "set_brightness",
+                bri,
+                continuous=True,
+                effect="smooth",
+                duration=milliseconds,
+            )
+            self._frame_bright[device.ip] = bri
+
+    def is_unreachable(self, error: Exception) -> bool:
+        # raised by a bulb operation, yeelight is already imported
+        from yeelight import BulbException
+
+        return isinstance(error, (BulbException, OSError))
+
+    def close(self) -> None:
+        if self._bulbs is not None:
+            self._bulbs.close()
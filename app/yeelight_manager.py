@@ -0,0 +1,334 @@
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Optional
+
+from yeelight import Bulb, BulbException
+
+from metrics import PHASE_SECONDS, metrics
+
+"""
+Long-lived Yeelight connections.
+
+A ``Bulb`` keeps its TCP socket open between commands, but only as long as the
+same instance is reused. Every window used to create its own, so each click
+opened a new connection and counted against the ~60 commands/minute quota of
+the bulb. ``BulbRegistry`` hands out one ``ManagedBulb`` per address, shared by
+the main window and all settings windows.
+
+Continuous adjustments (dragging a slider) switch the bulb to music mode: the
+bulb connects back to us and accepts commands without rate limit. Music mode
+is left again after a few idle seconds, since the bulb does not answer queries
+while in it.
+
+    bulbs = BulbRegistry()
+    bulbs.get("192.168.15.40").call("toggle")
+    bulbs.get("192.168.15.40").call("set_brightness", 40, continuous=True)
+
+Bulbs also push a "props" notification on every open connection whenever
+their state changes. ``BulbListener`` keeps one such connection per bulb and
+writes the notifications into the state cache, so the state of a listened bulb
+is read locally instead of being queried.
+
+"""
+
+
+YEELIGHT_PORT = 55443
+# continuous commands within MUSIC_MODE_WINDOW seconds that enable music mode
+MUSIC_MODE_THRESHOLD = 4
+MUSIC_MODE_WINDOW = 2.0
+# seconds without continuous commands before music mode is stopped
+MUSIC_MODE_IDLE = 5.0
+# seconds before music mode is tried again after the bulb failed to connect back
+MUSIC_MODE_RETRY_DELAY = 60.0
+# seconds before a lost notification connection is opened again, doubled on
+# each failure up to LISTEN_MAX_RECONNECT_DELAY
+LISTEN_RECONNECT_DELAY = 2.0
+LISTEN_MAX_RECONNECT_DELAY = 60.0
+# the state of a listened bulb stays valid while its connection is open
+LISTEN_STATE_TTL = 24 * 3600.0
+# seconds a read of the notification connection waits, bounds the time a
+# stopped listener takes to notice
+LISTEN_RECV_TIMEOUT = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedBulb:
+    def __init__(
+        self,
+        ip: str,
+        port: int = YEELIGHT_PORT,
+        music_threshold: int = MUSIC_MODE_THRESHOLD,
+        music_window: float = MUSIC_MODE_WINDOW,
+        music_idle: float = MUSIC_MODE_IDLE,
+    ) -> None:
+        self.ip = ip
+        self.port = port
+        self.music_threshold = music_threshold
+        self.music_window = music_window
+        self.music_idle = music_idle
+        self._bulb = None
+        self._lock = threading.RLock()
+        self._continuous = []
+        self._music_timer = None
+        self._music_failed_at = None
+
+    @property
+    def bulb(self) -> Bulb:
+        with self._lock:
+            if self._bulb is None:
+                self._bulb = Bulb(ip=self.ip, port=self.port)
+            return self._bulb
+
+    @property
+    def music_mode(self) -> bool:
+        return self._bulb is not None and self._bulb.music_mode
+
+    def call(self, method: str, *args, continuous: bool = False, **kwargs):
+        """
+        Call a ``Bulb`` method. Blocking, run it on the command engine.
+
+        Parameters
+        ----------
+        method : str
+            Name of the Bulb method, e.g. "set_brightness".
+
+        continuous : bool
+            The command is part of a stream of adjustments. Enough of them in
+            a short time switch the bulb to music mode.
+
+        Raises
+        ----------
+        BulbException
+            The command failed. The connection is dropped and the next call
+            reconnects.
+
+        """
+        with self._lock:
+            if continuous:
+                self._track_continuous()
+            start = time.perf_counter()
+            try:
+                reply = getattr(self.bulb, method)(*args, **kwargs)
+            except (BulbException, OSError) as e:
+                logger.debug("%s %s failed: %s", self.ip, method, e)
+                self._reset()
+                raise
+            # connect and command, the yeelight library does not tell them apart
+            metrics.observe(PHASE_SECONDS, time.perf_counter() - start, phase="device")
+            return reply
+
+    def close(self) -> None:
+        with self._lock:
+            self._cancel_music_timer()
+            if self._bulb is not None and self._bulb.music_mode:
+                try:
+                    self._bulb.stop_music()
+                except (BulbException, OSError):
+                    pass
+            self._bulb = None
+
+    def _track_continuous(self) -> None:
+        now = time.monotonic()
+        self._continuous = [
+            t for t in self._continuous if now - t < self.music_window
+        ] + [now]
+        if self.music_mode:
+            self._arm_music_timer()
+            return
+        if len(self._continuous) < self.music_threshold:
+            return
+        if (
+            self._music_failed_at is not None
+            and now - self._music_failed_at < MUSIC_MODE_RETRY_DELAY
+        ):
+            return
+        try:
+            self.bulb.start_music()
+            self._arm_music_timer()
+        except (BulbException, OSError, AssertionError):
+            # the bulb could not connect back (firewall, NAT...), keep using
+            # the normal rate limited connection for a while
+            self._music_failed_at = now
+            self._reset()
+
+    def _arm_music_timer(self) -> None:
+        self._cancel_music_timer()
+        self._music_timer = threading.Timer(self.music_idle, self._music_idle)
+        self._music_timer.daemon = True
+        self._music_timer.start()
+
+    def _cancel_music_timer(self) -> None:
+        if self._music_timer is not None:
+            self._music_timer.cancel()
+            self._music_timer = None
+
+    def _music_idle(self) -> None:
+        with self._lock:
+            self._music_timer = None
+            self._continuous = []
+            if self._bulb is not None and self._bulb.music_mode:
+                try:
+                    self._bulb.stop_music()
+                except (BulbException, OSError):
+                    self._reset()
+
+    def _reset(self) -> None:
+        # called with self._lock held
+        self._cancel_music_timer()
+        self._continuous = []
+        # dropping the Bulb closes its socket, music mode or not, without
+        # sending anything to a bulb that may be gone
+        self._bulb = None
+
+
+class BulbListener:
+    def __init__(self, ip: str, cache, port: int = YEELIGHT_PORT) -> None:
+        """
+        Parameters
+        ----------
+        ip : str
+            Address of the bulb.
+
+        cache : StateCache
+            Receives the properties of the bulb, keyed by ``ip``.
+
+        """
+        self.ip = ip
+        self.port = port
+        self.cache = cache
+        self.listening = threading.Event()
+        self._stopped = threading.Event()
+        self._socket = None
+        self._thread = threading.Thread(
+            target=self._run, name=f"yeelight-listen-{ip}", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        sock = self._socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        delay = LISTEN_RECONNECT_DELAY
+        while not self._stopped.is_set():
+            try:
+                # a dedicated connection, the command connection stays free;
+                # opened first so no change is missed after reading the state
+                with socket.create_connection(
+                    (self.ip, self.port), timeout=LISTEN_RECV_TIMEOUT
+                ) as sock:
+                    self._socket = sock
+                    props = Bulb(ip=self.ip, port=self.port).get_properties()
+                    self.cache.set(self.ip, props, ttl=LISTEN_STATE_TTL)
+                    self.listening.set()
+                    delay = LISTEN_RECONNECT_DELAY
+                    self._listen(sock)
+            except (BulbException, OSError) as e:
+                logger.debug("%s notifications lost: %s", self.ip, e)
+            finally:
+                self.listening.clear()
+                self._socket = None
+            if self._stopped.is_set():
+                break
+            # notifications may have been missed, the state is unknown again
+            self.cache.invalidate(self.ip)
+            self._stopped.wait(delay)
+            delay = min(LISTEN_MAX_RECONNECT_DELAY, delay * 2)
+
+    def _listen(self, sock: socket.socket) -> None:
+        """
+        Read the notifications until the connection is lost or the listener
+        is stopped.
+
+        Raises
+        ----------
+        ConnectionError
+            The bulb closed the connection.
+
+        """
+        buffer = b""
+        while not self._stopped.is_set():
+            try:
+                data = sock.recv(16 * 1024)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError("Connection closed by the bulb")
+            *lines, buffer = (buffer + data).split(b"\r\n")
+            for line in lines:
+                self._received(line)
+
+    def _received(self, line: bytes) -> None:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(message, dict) or message.get("method") != "props":
+            return
+        params = message.get("params")
+        if isinstance(params, dict):
+            self.cache.update(self.ip, params, ttl=LISTEN_STATE_TTL)
+
+
+class BulbRegistry:
+    def __init__(self, **bulb_options) -> None:
+        self.bulb_options = bulb_options
+        self._bulbs = {}
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def get(self, ip: str, port: Optional[int] = None) -> ManagedBulb:
+        with self._lock:
+            managed = self._bulbs.get(ip)
+            if managed is None:
+                options = dict(self.bulb_options)
+                if port is not None:
+                    options["port"] = port
+                managed = self._bulbs[ip] = ManagedBulb(ip, **options)
+            return managed
+
+    def listen(self, ip: str, cache, port: Optional[int] = None) -> BulbListener:
+        """Start pushing the notifications of a bulb into ``cache``."""
+        with self._lock:
+            listener = self._listeners.get(ip)
+            if listener is None:
+                listener = self._listeners[ip] = BulbListener(
+                    ip, cache, port=port or self.bulb_options.get("port", YEELIGHT_PORT)
+                )
+                listener.start()
+            return listener
+
+    def is_listening(self, ip: str) -> bool:
+        listener = self._listeners.get(ip)
+        return listener is not None and listener.listening.is_set()
+
+    def discard(self, ip: str) -> None:
+        with self._lock:
+            managed = self._bulbs.pop(ip, None)
+            listener = self._listeners.pop(ip, None)
+        if managed is not None:
+            managed.close()
+        if listener is not None:
+            listener.stop()
+
+    def close(self) -> None:
+        with self._lock:
+            bulbs = list(self._bulbs.values())
+            listeners = list(self._listeners.values())
+            self._bulbs.clear()
+            self._listeners.clear()
+        for managed in bulbs:
+            managed.close()
+        for listener in listeners:
+            listener.stop()
@@ -12,7 +12,8 @@ a = Analysis(
         ("app/resources", "resources"),
         ("app/iot_devices.json", ".")
         ],
-    hiddenimports=[],
+    # device drivers are imported by name, see app/drivers.py
+    hiddenimports=["tasmota_driver", "yeelight_driver", "diagnostics"],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
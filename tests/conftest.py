@@ -0,0 +1,47 @@
+import pytest
+
+from config import load_config
+from controller import Controller
+from simulator import Simulator
+from support import write_config
+
+
+@pytest.fixture
+def simulator():
+    """Stopped after the test, add the devices before ``start()``."""
+    simulator = Simulator(seed=0)
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def fleet(simulator):
+    """Models of a plug, a switch and a light."""
+    return [
+        *simulator.add_tasmota(1, "tasmota-plug"),
+        *simulator.add_tasmota(1, "tasmota-switch"),
+        *simulator.add_tasmota(1, "tasmota-light-RGBCCT"),
+    ]
+
+
+@pytest.fixture
+def controller(fleet, simulator, tmp_path):
+    """Controller of the fleet and of a device down, with an "evening" scene."""
+    simulator.start()
+    devices = simulator.devices()
+    # nothing listens there
+    devices.append({"type": "tasmota-plug", "name": "gone", "ip": "127.0.0.1:1"})
+    path = write_config(
+        tmp_path,
+        devices=devices,
+        groups={"lights": [devices[2]["name"]]},
+        scenes={
+            "evening": [
+                {"group": "all", "power": "off"},
+                {"group": "lights", "power": "on", "dimmer": 25, "ct": 400},
+            ]
+        },
+    )
+    controller = Controller(load_config(path))
+    yield controller
+    controller.close()
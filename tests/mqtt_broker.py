@@ -0,0 +1,195 @@
+import asyncio
+import threading
+
+"""
+Stand-in MQTT broker of the tests.
+
+Speaks enough MQTT 3.1.1 for paho-mqtt and mqtt.py: CONNECT, SUBSCRIBE and
+UNSUBSCRIBE with ``+`` and ``#`` wildcards, PUBLISH at QoS 0 and 1, PINGREQ
+and DISCONNECT. No sessions, no retained messages, no authentication: every
+CONNECT is accepted. Runs its own asyncio loop in a background thread.
+
+    broker = Broker()
+    broker.start()
+    broker.port                                ->  ephemeral port on 127.0.0.1
+    broker.publish("stat/plug/POWER", "ON")    ->  to the matching subscribers
+    broker.wait_for("cmnd/plug/Power")         ->  (topic, payload) published
+    broker.stop()
+"""
+
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    patterns, names = pattern.split("/"), topic.split("/")
+    for index, part in enumerate(patterns):
+        if part == "#":
+            return True
+        if index >= len(names) or (part != "+" and part != names[index]):
+            return False
+    return len(patterns) == len(names)
+
+
+def _length(value: int) -> bytes:
+    # remaining length, variable byte integer
+    encoded = bytearray()
+    while True:
+        byte, value = value % 128, value // 128
+        encoded.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(encoded)
+
+
+def _string(data: bytes, offset: int) -> tuple:
+    size = int.from_bytes(data[offset : offset + 2], "big")
+    return data[offset + 2 : offset + 2 + size].decode("utf-8"), offset + 2 + size
+
+
+def _packet(kind: int, flags: int, body: bytes) -> bytes:
+    return bytes([kind << 4 | flags]) + _length(len(body)) + body
+
+
+class Broker:
+    def __init__(self, host: str = "127.0.0.1") -> None:
+        self.host = host
+        self.port = 0
+        # every (topic, payload) published by a client, in order
+        self.published = []
+        self._subscriptions = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._changed = threading.Condition()
+        self._ready = threading.Event()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def publish(self, topic: str, payload: str) -> None:
+        """Send a message to the subscribers, as a device would."""
+        self._loop.call_soon_threadsafe(self._route, topic, payload.encode("utf-8"))
+
+    def subscriptions(self) -> set:
+        """Topic filters of all the connected clients."""
+        with self._changed:
+            return set().union(*self._subscriptions.values())
+
+    def wait_for(self, topic: str, timeout: float = 5.0):
+        """First message published by a client on ``topic``, None on timeout."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: any(t == topic for t, _ in self.published), timeout
+            )
+            for published in self.published:
+                if published[0] == topic:
+                    return published
+        return None
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._client, self.host, 0)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _close(self) -> None:
+        self._server.close()
+        with self._changed:
+            writers = list(self._subscriptions)
+        for writer in writers:
+            writer.close()
+        await self._server.wait_closed()
+        # let the client handlers see the end of their connection
+        await asyncio.sleep(0.05)
+
+    def _route(self, topic: str, payload: bytes) -> None:
+        body = len(topic.encode()).to_bytes(2, "big") + topic.encode() + payload
+        for writer, patterns in list(self._subscriptions.items()):
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                writer.write(_packet(PUBLISH, 0, body))
+
+    async def _client(self, reader, writer) -> None:
+        with self._changed:
+            self._subscriptions[writer] = set()
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                size, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    size += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                data = await reader.readexactly(size)
+                if not self._handle(writer, first[0] >> 4, first[0] & 0x0F, data):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            with self._changed:
+                self._subscriptions.pop(writer, None)
+                self._changed.notify_all()
+            writer.close()
+
+    def _handle(self, writer, kind: int, flags: int, data: bytes) -> bool:
+        if kind == CONNECT:
+            writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+        elif kind == PUBLISH:
+            topic, offset = _string(data, 0)
+            qos = (flags >> 1) & 0x03
+            if qos:
+                writer.write(_packet(PUBACK, 0, data[offset : offset + 2]))
+                offset += 2
+            payload = data[offset:]
+            with self._changed:
+                self.published.append((topic, payload.decode("utf-8", "replace")))
+                self._changed.notify_all()
+            self._route(topic, payload)
+        elif kind in (SUBSCRIBE, UNSUBSCRIBE):
+            packet_id, offset = data[:2], 2
+            codes = bytearray()
+            with self._changed:
+                while offset < len(data):
+                    pattern, offset = _string(data, offset)
+                    if kind == SUBSCRIBE:
+                        # granted QoS 0
+                        offset += 1
+                        codes.append(0)
+                        self._subscriptions[writer].add(pattern)
+                    else:
+                        self._subscriptions[writer].discard(pattern)
+                self._changed.notify_all()
+            if kind == SUBSCRIBE:
+                writer.write(_packet(SUBACK, 0, packet_id + bytes(codes)))
+            else:
+                writer.write(_packet(UNSUBACK, 0, packet_id))
+        elif kind == PINGREQ:
+            writer.write(_packet(PINGRESP, 0, b""))
+        elif kind == DISCONNECT:
+            return False
+        return True
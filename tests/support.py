@@ -0,0 +1,22 @@
+import json
+import time
+from pathlib import Path
+
+"""Helpers shared by the tests."""
+
+
+def wait_until(predicate, timeout: float = 5.0, interval: float = 0.01) -> bool:
+    """Poll ``predicate`` until it is true, False after ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def write_config(directory: Path, **iot) -> Path:
+    """iot_devices.json with ``iot`` as its "iot" section."""
+    path = Path(directory, "iot_devices.json")
+    path.write_text(json.dumps({"iot": iot}))
+    return path
@@ -0,0 +1,162 @@
+import json
+import socket
+import urllib.error
+import urllib.request
+
+import pytest
+
+import api as api_module
+from api import ApiServer, server_from_config
+from scheduler import Scheduler
+from support import wait_until
+from telemetry import TelemetryStore, ring_specs
+
+PLUG = "sim tasmota-plug 0"
+LIGHT = "sim tasmota-light-RGBCCT 2"
+
+
+@pytest.fixture
+def scheduler(controller, tmp_path):
+    scheduler = Scheduler(controller, tmp_path / "schedules.json")
+    scheduler.start()
+    assert wait_until(lambda: scheduler.is_owner)
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TelemetryStore(tmp_path / "telemetry", ring_specs({"interval": 10}))
+    for index in range(30):
+        store.add(PLUG, 1_000_000 + index * 10, 50.0 + index, index / 1000)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def api(controller, scheduler, store):
+    server = ApiServer(
+        controller, port=0, max_workers=4, scheduler=scheduler, telemetry=store
+    )
+    server.start()
+    yield server
+    server.stop()
+
+
+def request(api, method: str, path: str, payload=None) -> tuple:
+    """(status, json reply) of a request to the server."""
+    data = None if payload is None else json.dumps(payload).encode()
+    url = f"http://127.0.0.1:{api.port}{path.replace(' ', '%20')}"
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(url, data=data, method=method), timeout=10
+        ) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_devices_and_states(api, fleet):
+    status, devices = request(api, "GET", "/devices")
+    assert status == 200
+    assert [device["name"] for device in devices][:3] == [
+        PLUG,
+        "sim tasmota-switch 1",
+        LIGHT,
+    ]
+    status, reply = request(api, "GET", f"/devices/{PLUG}")
+    assert (status, reply["state"]["POWER"]) == (200, "ON")
+    assert request(api, "GET", "/devices/nothing")[0] == 404
+
+
+def test_commands(api, fleet):
+    plug, _, light = fleet
+    assert request(api, "POST", f"/devices/{PLUG}/toggle")[0] == 200
+    assert plug.power is False
+    status, _ = request(api, "POST", f"/devices/{LIGHT}/set", {"dimmer": 35})
+    assert (status, light.dimmer) == (200, 35)
+    assert request(api, "POST", f"/devices/{LIGHT}/set", [1])[0] == 400
+    assert request(api, "GET", f"/devices/{PLUG}/toggle")[0] == 405
+    assert request(api, "POST", f"/devices/{PLUG}/explode")[0] == 404
+
+
+def test_scene_and_batch(api, fleet):
+    plug, switch, light = fleet
+    status, results = request(api, "POST", "/scenes/evening")
+    assert status == 200
+    assert results[PLUG] is None and results["gone"] is not None
+    assert (plug.power, switch.power, light.dimmer) == (False, False, 25)
+    assert request(api, "POST", "/scenes/nothing")[0] == 404
+
+    status, reply = request(
+        api,
+        "POST",
+        "/batch",
+        {
+            "commands": [
+                {"device": LIGHT, "action": "set", "settings": {"dimmer": 60}},
+                {"device": LIGHT, "action": "set", "settings": {"ct": 300}},
+                {"device": PLUG, "action": "toggle"},
+                {"device": "nothing", "action": "state"},
+            ]
+        },
+    )
+    assert status == 200
+    assert [result["ok"] for result in reply["results"]] == [True, True, True, False]
+    assert (light.dimmer, light.ct, plug.power) == (60, 300, True)
+    assert request(api, "POST", "/batch", {"commands": [{}]})[0] == 400
+
+
+def test_schedules(api, fleet):
+    definition = {
+        "name": "plug off",
+        "at": "23:30",
+        "actions": [{"device": PLUG, "power": "off"}],
+    }
+    status, schedule = request(api, "POST", "/schedules", definition)
+    assert (status, schedule["added"]) == (200, True)
+    assert schedule["next"] is not None
+    assert request(api, "POST", "/schedules", definition)[0] == 400
+    assert request(api, "POST", "/schedules", {"name": "x"})[0] == 400
+    status, schedules = request(api, "GET", "/schedules")
+    assert [schedule["name"] for schedule in schedules] == ["plug off"]
+    assert request(api, "DELETE", "/schedules/plug off") == (
+        200,
+        {"removed": "plug off"},
+    )
+    assert request(api, "DELETE", "/schedules/plug off")[0] == 404
+
+
+def test_telemetry(api):
+    status, reply = request(
+        api, "GET", f"/telemetry/{PLUG}?start=1000000&end=1000300&bucket=60"
+    )
+    assert status == 200
+    assert [point["samples"] for point in reply["points"]] == [2, 6, 6, 6, 6, 4]
+    # from the end of the first bucket to the end of the last one
+    assert reply["kwh"] == pytest.approx(0.028)
+    assert request(api, "GET", f"/telemetry/{PLUG}?start=x")[0] == 400
+    assert request(api, "GET", "/telemetry/nothing")[0] == 404
+
+
+@pytest.mark.parametrize("length", ["abc", "-1"])
+def test_malformed_content_length(api, length):
+    with socket.create_connection(("127.0.0.1", api.port), timeout=10) as sock:
+        sock.sendall(
+            f"POST /scenes/evening HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode()
+        )
+        reply = sock.makefile("rb").readline()
+    assert reply.split()[1] == b"400"
+
+
+def test_empty_api_section_starts_the_server(controller, monkeypatch):
+    monkeypatch.setattr(api_module, "API_PORT", 0)
+    monkeypatch.setattr(controller.config, "api", {})
+    server = server_from_config(controller)
+    try:
+        assert server is not None
+        assert request(server, "GET", "/devices")[0] == 200
+    finally:
+        server.stop()
+    monkeypatch.setattr(controller.config, "api", None)
+    assert server_from_config(controller) is None
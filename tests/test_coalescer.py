@@ -0,0 +1,66 @@
+import threading
+
+from engine import CommandEngine
+from support import wait_until
+
+
+def test_jobs_finishing_at_once_do_not_deadlock():
+    engine = CommandEngine()
+    sent = []
+    # zero delay jobs are often done before their callback is added
+    worker = threading.Thread(
+        target=lambda: [
+            engine.submit_latest(("k", 0), sent.append, index, min_interval=0)
+            for index in range(2000)
+        ],
+        daemon=True,
+    )
+    try:
+        worker.start()
+        worker.join(10)
+        assert not worker.is_alive()
+        assert wait_until(lambda: sent and sent[-1] == 1999)
+    finally:
+        engine.shutdown()
+
+
+def test_latest_value_wins():
+    engine = CommandEngine()
+    sent = []
+    started, release = threading.Event(), threading.Event()
+
+    def send(value):
+        started.set()
+        release.wait(5)
+        sent.append(value)
+
+    try:
+        engine.submit_latest("dimmer", send, 1, min_interval=0)
+        assert started.wait(5)
+        # waiting while 1 is in flight, each one replaces the previous
+        for value in range(2, 10):
+            engine.submit_latest("dimmer", send, value, min_interval=0)
+        release.set()
+        assert wait_until(lambda: sent == [1, 9])
+    finally:
+        engine.shutdown()
+
+
+def test_failed_final_value_is_retried():
+    engine = CommandEngine()
+    attempts = []
+    errors = []
+
+    def send(value):
+        attempts.append(value)
+        if len(attempts) == 1:
+            raise ConnectionError("lost")
+        return value
+
+    try:
+        engine.submit_latest("ct", send, 400, on_error=errors.append, min_interval=0)
+        assert wait_until(lambda: len(attempts) == 2)
+        engine.process_results()
+    finally:
+        engine.shutdown()
+    assert errors == []
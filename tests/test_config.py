@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from config import ConfigError, load_config
+
+DEVICES = [{"type": "tasmota-plug", "name": "Plug", "ip": "192.168.15.41"}]
+
+
+def load(directory, **sections):
+    path = directory / "iot_devices.json"
+    path.write_text(json.dumps({"iot": {"devices": DEVICES, **sections}}))
+    return load_config(path)
+
+
+def test_mqtt_section_without_host_is_rejected(tmp_path):
+    with pytest.raises(ConfigError, match="host"):
+        load(tmp_path, mqtt={"port": 1883})
+    assert load(tmp_path, mqtt={"host": "broker"}).mqtt["host"] == "broker"
+
+
+@pytest.mark.parametrize(
+    "http", [{"pool_size": 0}, {"retries": -1}, {"size": 2}, {"idle_timeout": 0}]
+)
+def test_invalid_http_section_is_rejected(tmp_path, http):
+    with pytest.raises(ConfigError, match="http"):
+        load(tmp_path, http=http)
+
+
+@pytest.mark.parametrize("api", [{"port": "x"}, {"port": 0}, {"host": ""}, {"ssl": 1}])
+def test_invalid_api_section_is_rejected(tmp_path, api):
+    with pytest.raises(ConfigError, match="api"):
+        load(tmp_path, api=api)
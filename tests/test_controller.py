@@ -0,0 +1,74 @@
+import pytest
+
+from controller import DeviceNotFoundError
+from health import DeviceUnavailableError
+from metrics import OPERATIONS_TOTAL, metrics
+
+
+def test_find(controller):
+    assert controller.find("SIM TASMOTA-PLUG 0").name == "sim tasmota-plug 0"
+    with pytest.raises(DeviceNotFoundError):
+        controller.find("nothing")
+
+
+def test_state_toggle_and_set(controller, fleet):
+    plug, _, light = fleet
+    device = controller.find("sim tasmota-plug 0")
+    assert controller.get_state(device)["POWER"] == "ON"
+    controller.toggle(device)
+    assert plug.power is False
+
+    device = controller.find("sim tasmota-light-RGBCCT 2")
+    controller.set(device, {"power": "on", "dimmer": 40, "color": "#ff0000"})
+    assert (light.power, light.dimmer, light.hs) == (True, 40, (0, 100))
+    assert controller.get_state(device)["Dimmer"] == 40
+
+
+def test_raw_command_is_counted_and_guarded(controller, fleet):
+    _, _, light = fleet
+    device = controller.find("sim tasmota-light-RGBCCT 2")
+    before = metrics.value(
+        OPERATIONS_TOTAL, device=device.name, operation="command", result="ok"
+    )
+    assert controller.command(device, "Dimmer 30")["Dimmer"] == 30
+    assert light.dimmer == 30
+    assert (
+        metrics.value(
+            OPERATIONS_TOTAL, device=device.name, operation="command", result="ok"
+        )
+        == before + 1
+    )
+
+    gone = controller.find("gone")
+    for _ in range(2):
+        with pytest.raises(Exception) as error:
+            controller.command(gone, "Power")
+        assert not isinstance(error.value, DeviceUnavailableError)
+    with pytest.raises(DeviceUnavailableError):
+        controller.command(gone, "Power")
+
+
+def test_energy_of_plugs_only(controller):
+    reading = controller.energy(controller.find("sim tasmota-plug 0"))
+    assert set(reading) >= {"power", "energy"}
+    assert controller.energy(controller.find("sim tasmota-switch 1")) is None
+
+
+def test_scene_runs_on_every_device(controller, fleet):
+    plug, switch, light = fleet
+    results = controller.scene("evening")
+    assert [name for name, error in results.items() if error is not None] == ["gone"]
+    assert (plug.power, switch.power) == (False, False)
+    assert (light.power, light.dimmer, light.ct) == (True, 25, 400)
+
+
+def test_unreachable_device_opens_its_breaker(controller):
+    device = controller.find("gone")
+    for _ in range(2):
+        with pytest.raises(Exception) as error:
+            controller.get_state(device)
+        assert not isinstance(error.value, DeviceUnavailableError)
+    assert not controller.is_available(device)
+    with pytest.raises(DeviceUnavailableError):
+        controller.toggle(device)
+    assert isinstance(controller.scene("evening")["gone"], DeviceUnavailableError)
@@ -0,0 +1,28 @@
+import asyncio
+
+from discovery import merge_devices, parse_ports, sweep_tasmota
+from simulator import Simulator
+
+
+def test_parse_ports():
+    assert parse_ports("80") == [80]
+    assert parse_ports("80, 8080-8082") == [80, 8080, 8081, 8082]
+
+
+def test_sweep_finds_the_simulated_devices(simulator: Simulator):
+    simulator.add_tasmota(2, "tasmota-plug")
+    simulator.add_tasmota(1, "tasmota-switch")
+    simulator.add_tasmota(1, "tasmota-light-RGBCCT")
+    simulator.start()
+    devices = simulator.devices()
+    ports = [int(device["ip"].rpartition(":")[2]) for device in devices]
+    # a port nothing listens on is skipped
+    found = asyncio.run(sweep_tasmota("127.0.0.1", ports=ports + [1]))
+    assert sorted((d["name"], d["type"], d["ip"]) for d in found) == sorted(
+        (d["name"], d["type"], d["ip"]) for d in devices
+    )
+    assert all(d["topic"].startswith("tasmota_") for d in found)
+
+    merged, changed = merge_devices(devices, found)
+    assert changed == [d["name"] for d in devices]
+    assert [d["topic"] for d in merged] == [d["topic"] for d in found]
@@ -0,0 +1,180 @@
+import threading
+
+import pytest
+
+import effects
+from config import Device
+from effects import (
+    EASING_STEPS,
+    FRAME_MAX_ERRORS,
+    ColorLoop,
+    EffectRunner,
+    Fade,
+    _Stream,
+    easing_table,
+)
+from health import DeviceUnavailableError
+from metrics import EFFECT_FRAMES_TOTAL, metrics
+from state import StateCache
+from support import wait_until
+
+
+LIGHTS = [Device("tasmota-light-RGBCCT", f"light {i}", f"10.0.0.{i}") for i in (1, 2)]
+
+
+class FakeController:
+    """Frames of every device in ``frames``, ``frame`` runs ``on_frame`` first."""
+
+    def __init__(self, interval: float = 0.0, on_frame=None) -> None:
+        self.interval = interval
+        self.on_frame = on_frame
+        self.cache = StateCache()
+        self.frames = []
+
+    def frame_interval(self, device: Device) -> float:
+        return self.interval
+
+    def frame(self, device, hue, sat, bri, first=False) -> None:
+        if self.on_frame is not None:
+            self.on_frame(device)
+        self.frames.append((device.name, (hue, sat, bri)))
+
+
+@pytest.fixture
+def runner_of():
+    """``runner_of(controller, fps)``, the runners are closed after the test."""
+    runners = []
+
+    def _runner(controller, fps=50):
+        runner = EffectRunner(controller, fps=fps)
+        runners.append(runner)
+        return runner
+
+    yield _runner
+    for runner in runners:
+        runner.close()
+
+
+@pytest.mark.parametrize("name", sorted(effects.EASINGS))
+def test_easing_tables(name):
+    table = easing_table(name)
+    assert len(table) == EASING_STEPS
+    assert (table[0], table[-1]) == pytest.approx((0.0, 1.0))
+    assert all(a <= b for a, b in zip(table, table[1:]))
+    assert easing_table(name) is table
+
+
+def test_unknown_easing():
+    with pytest.raises(ValueError):
+        easing_table("bounce")
+
+
+def test_fade_takes_the_shortest_hue_arc():
+    # from hue 300 to yellow (60) through red (0), not through 180
+    fade = Fade(LIGHTS[:1], "#ffff00", duration=1.0, easing="linear")
+    fade.prepare([{"HSBColor": "300,100,100"}])
+    hues = [fade.frame(i / 100)[0][0] for i in range(101)]
+    assert all(hue >= 300 or hue <= 60 for hue in hues)
+    assert hues[50] == 0
+    assert hues[-1] == 60
+
+
+def test_fade_ends_on_its_colors():
+    fade = Fade(LIGHTS, ["#ff0000", "#0000ff"], duration=1.0, start="#ffffff")
+    assert fade.frame(0.0) == [(0, 0, 100), (0, 0, 100)]
+    assert fade.frame(5.0) == [(0, 100, 100), (239, 100, 100)]
+
+
+def test_color_loop_spreads_the_hues():
+    loop = ColorLoop(LIGHTS, period=10, spread=180, sat=80, bri=50)
+    assert loop.frame(0.0) == [(0, 80, 50), (180, 80, 50)]
+    assert loop.frame(2.5) == [(90, 80, 50), (270, 80, 50)]
+
+
+def test_frames_are_dropped_while_a_device_is_busy(runner_of):
+    started, release = threading.Event(), threading.Event()
+
+    def _block(device):
+        started.set()
+        assert release.wait(5)
+
+    controller = FakeController(on_frame=_block)
+    runner = runner_of(controller)
+    before = metrics.value(EFFECT_FRAMES_TOTAL, result="dropped")
+    runner.play(ColorLoop(LIGHTS[:1], period=0.5))
+    try:
+        assert started.wait(5)
+        assert wait_until(
+            lambda: metrics.value(EFFECT_FRAMES_TOTAL, result="dropped") >= before + 3
+        )
+        # skipped, not queued behind the busy frame
+        assert controller.frames == []
+    finally:
+        release.set()
+    assert wait_until(lambda: len(controller.frames) >= 2)
+    runner.stop()
+
+
+def test_last_frame_is_delivered(runner_of):
+    # the device takes a frame every 0.3 s, the fade is over before that
+    controller = FakeController(interval=0.3)
+    runner = runner_of(controller)
+    runner.play(Fade(LIGHTS, "#0000ff", duration=0.1, start="#ff0000"))
+    assert runner.wait(5)
+    for light in LIGHTS:
+        frames = [hsb for name, hsb in controller.frames if name == light.name]
+        assert frames[-1] == (239, 100, 100)
+        assert len(frames) <= 2
+
+
+def test_unavailable_device_leaves_the_effect(runner_of):
+    def _down(device):
+        if device is LIGHTS[0]:
+            raise DeviceUnavailableError("down")
+
+    controller = FakeController(on_frame=_down)
+    runner = runner_of(controller)
+    runner.play(ColorLoop(LIGHTS, period=0.5, duration=0.2))
+    assert runner.wait(5)
+    assert {name for name, _ in controller.frames} == {LIGHTS[1].name}
+
+
+def test_failing_device_leaves_the_effect(runner_of):
+    calls = []
+
+    def _fail(device):
+        calls.append(device)
+        raise OSError("refused")
+
+    runner = runner_of(FakeController(on_frame=_fail))
+    runner.play(ColorLoop(LIGHTS[:1], period=0.5))
+    # every light failed, the endless effect is over
+    assert runner.wait(5)
+    assert len(calls) == FRAME_MAX_ERRORS
+
+
+def test_failed_stream_stays_failed():
+    def _fail(device):
+        raise OSError("refused")
+
+    runner = EffectRunner(FakeController(on_frame=_fail))
+    stream = _Stream(LIGHTS[0], 0.0)
+    # taken over by another effect while this frame was on its way
+    stream.failed = True
+    runner._send(stream, (0, 100, 100))
+    assert stream.failed
+    assert (stream.errors, stream.busy, stream.sent) == (1, False, None)
+
+
+@pytest.mark.skipif(effects.numpy is None, reason="numpy is not installed")
+def test_numpy_and_lists_give_the_same_frames(monkeypatch):
+    def _frames():
+        fade = Fade(LIGHTS, ["#ff8800", "#00ffcc"], 3.0, start=["#0000ff", "#ff0000"])
+        loop = ColorLoop(LIGHTS, period=7, spread=137, sat=90, bri=40)
+        times = [i * 0.07 for i in range(60)]
+        return [fade.frame(t) for t in times] + [loop.frame(t) for t in times]
+
+    with_numpy = _frames()
+    monkeypatch.setattr(effects, "numpy", None)
+    monkeypatch.setattr(effects, "_easing_tables", {})
+    assert _frames() == with_numpy
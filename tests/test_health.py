@@ -0,0 +1,165 @@
+import threading
+
+import pytest
+
+from config import Device
+from health import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    DeviceUnavailableError,
+    HealthTracker,
+)
+from support import wait_until
+
+
+DEVICE = Device("tasmota-plug", "plug", "10.0.0.1")
+
+
+def _fail(device):
+    raise OSError("unreachable")
+
+
+def _open(tracker):
+    for _ in range(tracker.failure_threshold):
+        with pytest.raises(OSError):
+            tracker.call(DEVICE, _fail)
+
+
+@pytest.fixture
+def tracker():
+    """Probes of a test are added to ``tracker.probes``, failing by default."""
+    probes = []
+
+    def _probe(device):
+        probes.append(device)
+        raise OSError("still down")
+
+    tracker = HealthTracker(_probe)
+    tracker.probes = probes
+    yield tracker
+    tracker.stop()
+
+
+def test_closed_breaker_runs_the_operations(tracker):
+    assert tracker.call(DEVICE, lambda device, value: value * 2, 21) == 42
+    with pytest.raises(ValueError):
+        tracker.call(DEVICE, lambda device: int("x"), is_unreachable=lambda e: False)
+    with pytest.raises(OSError):
+        tracker.call(DEVICE, _fail)
+    # an answer resets the count of connection errors
+    tracker.call(DEVICE, lambda device: None)
+    with pytest.raises(OSError):
+        tracker.call(DEVICE, _fail)
+    assert tracker.is_available(DEVICE)
+    stats = tracker.stats(DEVICE)
+    assert (stats["state"], stats["samples"], stats["error_rate"]) == (
+        CLOSED,
+        5,
+        0.6,
+    )
+
+
+def test_errors_of_a_device_that_answered_do_not_open_it(tracker):
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            tracker.call(
+                DEVICE, lambda device: int("x"), is_unreachable=lambda e: False
+            )
+    assert tracker.is_available(DEVICE)
+
+
+def test_open_breaker_fails_fast(tracker):
+    changes = []
+    tracker.subscribe(lambda ip, available: changes.append((ip, available)))
+    _open(tracker)
+    assert not tracker.is_available(DEVICE)
+    assert tracker.stats(DEVICE)["state"] == OPEN
+    assert changes == [(DEVICE.ip, False)]
+
+    called = []
+    with pytest.raises(DeviceUnavailableError):
+        tracker.call(DEVICE, called.append)
+    assert called == []
+
+
+def test_probe_backoff_doubles_up_to_the_maximum(tracker):
+    _open(tracker)
+    health = tracker._health[DEVICE.ip]
+    assert health.probe_interval == 5.0
+    intervals = []
+    for _ in range(6):
+        # what the probe thread does once the probe is due
+        health.state = HALF_OPEN
+        tracker._probe(DEVICE)
+        assert health.state == OPEN
+        intervals.append(health.probe_interval)
+    assert intervals == [10.0, 20.0, 40.0, 60.0, 60.0, 60.0]
+    # not due before minutes, the probe thread left it alone
+    assert tracker.probes == [DEVICE] * 6
+
+
+def test_half_open_probe_closes_the_breaker():
+    started, release = threading.Event(), threading.Event()
+
+    def _probe(device):
+        started.set()
+        assert release.wait(5)
+
+    changes = []
+    tracker = HealthTracker(_probe, probe_interval=0.01)
+    tracker.subscribe(lambda ip, available: changes.append(available))
+    try:
+        _open(tracker)
+        assert started.wait(5)
+        assert tracker.stats(DEVICE)["state"] == HALF_OPEN
+        # only the probe reaches the device while it is half-open
+        with pytest.raises(DeviceUnavailableError):
+            tracker.call(DEVICE, lambda device: None)
+        release.set()
+        assert wait_until(lambda: tracker.is_available(DEVICE))
+        assert changes == [False, True]
+        assert tracker.call(DEVICE, lambda device: "ok") == "ok"
+    finally:
+        tracker.stop()
+
+
+def test_failed_probe_reopens_the_breaker():
+    probes = []
+
+    def _probe(device):
+        probes.append(device)
+        if len(probes) < 3:
+            raise OSError("still down")
+
+    tracker = HealthTracker(_probe, probe_interval=0.01, max_probe_interval=0.02)
+    try:
+        _open(tracker)
+        assert wait_until(lambda: tracker.is_available(DEVICE))
+        assert len(probes) == 3
+        stats = tracker.stats(DEVICE)
+        assert stats["state"] == CLOSED
+        assert stats["last_error"] == "still down"
+    finally:
+        tracker.stop()
+
+
+def test_apply_skips_devices_down(controller, fleet):
+    plug, _, _ = fleet
+    gone = controller.find("gone")
+    for _ in range(controller.health.failure_threshold):
+        with pytest.raises(Exception):
+            controller.get_state(gone)
+    assert not controller.is_available(gone)
+
+    results = controller.apply(
+        [
+            (controller.find("sim tasmota-plug 0"), {"power": "off"}),
+            (gone, {"power": "off"}),
+        ]
+    )
+    assert results["sim tasmota-plug 0"] is None
+    assert isinstance(results["gone"], DeviceUnavailableError)
+    assert plug.power is False
+    # skipped, not tried: no new sample for the device
+    assert controller.health.stats(gone)["samples"] == 2
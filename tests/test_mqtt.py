@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from mqtt import MQTT_STATE_TTL, SUBSCRIPTIONS, MqttTransport, paho
+from mqtt_broker import Broker, topic_matches
+from state import StateCache
+from support import wait_until
+
+pytestmark = pytest.mark.skipif(paho is None, reason="paho-mqtt is not installed")
+
+IP = "192.168.15.41"
+TOPIC = "tasmota_A1B2C3"
+
+
+@pytest.fixture
+def broker():
+    broker = Broker()
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def transport(broker):
+    cache = StateCache()
+    transport = MqttTransport(cache, "127.0.0.1", broker.port)
+    transport.add_device(IP, TOPIC)
+    transport.start()
+    assert transport.connected.wait(5)
+    # subscriptions are sent right after the connection, one at a time
+    assert wait_until(lambda: broker.subscriptions() == set(SUBSCRIPTIONS))
+    yield transport
+    transport.stop()
+
+
+def test_topic_matches():
+    assert topic_matches("stat/+/RESULT", "stat/plug/RESULT")
+    assert topic_matches("tele/#", "tele/plug/STATE")
+    assert not topic_matches("stat/+/RESULT", "stat/plug/POWER")
+    assert not topic_matches("stat/+", "stat/plug/POWER")
+
+
+def test_asks_the_state_on_connect(broker, transport):
+    assert broker.wait_for(f"cmnd/{TOPIC}/STATE") is not None
+    assert transport.has(IP)
+
+
+def test_publishes_commands(broker, transport):
+    transport.send(IP, "Dimmer 40")
+    assert broker.wait_for(f"cmnd/{TOPIC}/Dimmer") == (f"cmnd/{TOPIC}/Dimmer", "40")
+
+
+def test_published_state_reaches_the_cache(broker, transport):
+    broker.publish(f"stat/{TOPIC}/RESULT", json.dumps({"POWER": "ON", "Dimmer": 40}))
+    wait_until(lambda: transport.cache.get(IP) is not None)
+    assert transport.cache.get(IP) == {"POWER": "ON", "Dimmer": 40}
+
+    broker.publish(f"stat/{TOPIC}/POWER", "OFF")
+    wait_until(lambda: transport.cache.get(IP)["POWER"] == "OFF")
+    assert transport.cache.get(IP) == {"POWER": "OFF", "Dimmer": 40}
+
+
+def test_offline_device_is_forgotten(broker, transport):
+    transport.cache.set(IP, {"POWER": "ON"}, ttl=MQTT_STATE_TTL)
+    broker.publish(f"tele/{TOPIC}/LWT", "Offline")
+    wait_until(lambda: transport.cache.get(IP) is None)
+    assert transport.cache.get(IP) is None
+
+
+def test_messages_of_unknown_topics_are_ignored(broker, transport):
+    broker.publish("stat/other/RESULT", json.dumps({"POWER": "ON"}))
+    broker.publish(f"stat/{TOPIC}/POWER", "ON")
+    wait_until(lambda: transport.cache.get(IP) is not None)
+    assert transport.cache.get(IP) == {"POWER": "ON"}
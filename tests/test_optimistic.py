@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from optimistic import OptimisticState
+from state import StateCache
+from support import wait_until
+
+IP = "192.168.15.41"
+
+
+@pytest.fixture
+def cache():
+    cache = StateCache()
+    cache.set(IP, {"POWER": "OFF", "Dimmer": 10})
+    return cache
+
+
+@pytest.fixture
+def view(cache):
+    view = OptimisticState(cache)
+    yield view
+    view.close()
+
+
+def test_listeners_are_told_of_expired_operations(cache):
+    view = OptimisticState(cache, timeout=0.05)
+    seen = []
+    view.subscribe(lambda ip, state: seen.append((ip, state)))
+    try:
+        view.apply(IP, {"POWER": "ON"})
+        assert seen == [(IP, {"POWER": "ON", "Dimmer": 10})]
+        # the expiry timer tells the listeners, nothing reads the view
+        assert wait_until(lambda: len(seen) == 2)
+        assert seen[-1] == (IP, {"POWER": "OFF", "Dimmer": 10})
+        assert not view.is_pending(IP)
+        time.sleep(0.1)
+        assert len(seen) == 2
+    finally:
+        view.close()
+
+
+def test_expiry_timer_follows_the_operations(cache):
+    view = OptimisticState(cache, timeout=0.1)
+    seen = []
+    view.subscribe(lambda ip, state: ip == IP and seen.append(state["Dimmer"]))
+    try:
+        view.apply(IP, {"Dimmer": 20})
+        time.sleep(0.05)
+        view.apply("192.168.15.42", {"POWER": "ON"})
+        assert wait_until(lambda: not view.is_pending(IP))
+        assert view.is_pending("192.168.15.42")
+        assert seen[-1] == 10
+        assert wait_until(lambda: not view.is_pending("192.168.15.42"))
+    finally:
+        view.close()
+
+
+def test_rollback_restores_the_cached_state(view):
+    token = view.apply(IP, {"POWER": "ON"})
+    assert view.get(IP)["POWER"] == "ON"
+    view.rollback(token)
+    assert view.get(IP)["POWER"] == "OFF"
+
+
+def test_settle_with_an_agreeing_reply(view, cache):
+    seen = []
+    view.subscribe(lambda ip, state: seen.append(state))
+    token = view.apply(IP, {"POWER": "ON", "Dimmer": 50})
+    reply = {"POWER": "on", "Dimmer": 50}
+    assert view.settle(token, reply)
+    assert not view.is_pending(IP)
+    # the caller stores the reply, as the windows do
+    cache.update(IP, reply)
+    assert view.get(IP) == reply
+    assert seen[-1] == reply
+
+
+def test_settle_with_a_disagreeing_reply(view):
+    seen = []
+    view.subscribe(lambda ip, state: seen.append(state))
+    token = view.apply(IP, {"POWER": "ON", "Dimmer": 50})
+    assert not view.settle(token, {"POWER": "ON", "Dimmer": 30})
+    assert not view.is_pending(IP)
+    # back to the last known state until the reply reaches the cache
+    assert seen[-1] == {"POWER": "OFF", "Dimmer": 10}
+
+
+def test_settle_without_the_expected_keys_waits_for_the_device(view, cache):
+    token = view.apply(IP, {"POWER": "ON"})
+    assert view.settle(token, None)
+    assert view.is_pending(IP)
+    assert view.get(IP)["POWER"] == "ON"
+    cache.update(IP, {"POWER": "ON"})
+    assert not view.is_pending(IP)
@@ -0,0 +1,36 @@
+from config import load_config
+from controller import Controller
+from engine import CommandEngine
+from health import DeviceUnavailableError
+from scenes import SceneRunner
+from support import wait_until, write_config
+
+
+def test_scene_runner_applies_a_scene_through_the_controller(
+    simulator, tmp_path, monkeypatch
+):
+    models = simulator.add_tasmota(2, "tasmota-light-RGBCCT")
+    simulator.start()
+    devices = simulator.devices()
+    path = write_config(
+        tmp_path,
+        devices=devices,
+        scenes={"dim": [{"group": "all", "power": "on", "dimmer": 30}]},
+    )
+    controller = Controller(load_config(path))
+    engine = CommandEngine()
+    # the second light is known to be down
+    down = devices[1]["ip"]
+    monkeypatch.setattr(controller, "is_available", lambda device: device.ip != down)
+    results = []
+    try:
+        SceneRunner(engine, controller).run("dim", on_done=results.append)
+        assert wait_until(lambda: engine.process_results() or results)
+    finally:
+        engine.shutdown()
+        controller.close()
+    (result,) = results
+    assert result[devices[0]["name"]] is None
+    assert isinstance(result[devices[1]["name"]], DeviceUnavailableError)
+    assert models[0].dimmer == 30
+    assert models[1].requests == 0
@@ -0,0 +1,115 @@
+import json
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+from scheduler import STATE_VERSION, Schedule, Scheduler, TimerWheel
+from support import wait_until
+
+PLUG = "sim tasmota-plug 0"
+
+
+def test_timer_wheel_fires_each_item_at_its_tick():
+    # levels of 1, 4 and 16 ticks, later entries wait in the overflow list
+    wheel = TimerWheel(0, resolution=1, slots=4, levels=2)
+    rng = random.Random(0)
+    whens = {index: rng.randrange(1, 200) for index in range(300)}
+    for index, when in whens.items():
+        wheel.add(when, index)
+    assert len(wheel) == 300
+    fired = {}
+    now = 0
+    while now < 210:
+        now += rng.randrange(1, 4)
+        for index in wheel.advance(now):
+            fired[index] = now
+    assert len(wheel) == 0
+    for index, when in whens.items():
+        # never early, at the first advance past its tick
+        assert when <= fired[index] < when + 4
+
+
+def test_timer_wheel_items_in_the_past_are_due_at_once():
+    wheel = TimerWheel(100.0)
+    wheel.add(50.0, "late")
+    wheel.add(100.5, "now")
+    wheel.add(102.0, "later")
+    assert sorted(wheel.advance(100.9)) == ["late", "now"]
+    assert wheel.advance(101.9) == []
+    assert wheel.advance(102.0) == ["later"]
+
+
+def test_next_after():
+    every = Schedule({"name": "e", "every": 900, "offset": 1})
+    assert every.next_after(0) == 60
+    assert every.next_after(60) == 960
+    daily = Schedule({"name": "d", "at": "07:30", "days": ["mon"]})
+    # a Sunday, then that Monday at 07:30
+    sunday = datetime(2026, 10, 18, 12, 0).timestamp()
+    assert daily.next_after(sunday) == datetime(2026, 10, 19, 7, 30).timestamp()
+    once = Schedule({"name": "o", "at": "2026-10-18T07:00"})
+    assert once.next_after(0) == datetime(2026, 10, 18, 7, 0).timestamp()
+    assert once.next_after(sunday) is None
+
+
+def test_runtime_schedule_runs_against_the_simulator(controller, fleet, tmp_path):
+    plug = fleet[0]
+    runs = []
+    scheduler = Scheduler(
+        controller, tmp_path / "schedules.json", on_run=lambda *run: runs.append(run)
+    )
+    scheduler.start()
+    try:
+        assert wait_until(lambda: scheduler.is_owner)
+        scheduler.add(
+            {"name": "off", "every": 1, "actions": [{"device": PLUG, "power": "off"}]}
+        )
+        assert wait_until(lambda: runs)
+    finally:
+        scheduler.stop()
+    assert runs[0] == ("off", {PLUG: None})
+    assert plug.power is False
+    state = json.loads((tmp_path / "schedules.json").read_text())
+    assert [d["name"] for d in state["added"]] == ["off"]
+    assert not (tmp_path / "schedules.json.lock").exists()
+
+
+@pytest.mark.parametrize("catch_up, expected", [("skip", 0), ("once", 1), ("all", 4)])
+def test_missed_runs_are_caught_up(controller, tmp_path, catch_up, expected):
+    definition = {
+        "name": "toggle",
+        "every": 60,
+        "catch_up": catch_up,
+        "actions": [{"device": PLUG, "power": "toggle"}],
+    }
+    now = time.time()
+    # due 3 minutes ago on a minute: missed then, +1, +2 and +3 minutes
+    first = now - now % 60 - 180
+    path = tmp_path / "schedules.json"
+    path.write_text(
+        json.dumps(
+            {
+                "version": STATE_VERSION,
+                "schedules": {
+                    "toggle": {"key": Schedule(definition).key, "next": first}
+                },
+                "added": [definition],
+            }
+        )
+    )
+    runs = []
+    scheduler = Scheduler(
+        controller, path, on_run=lambda *run: runs.append(run), clock=lambda: now
+    )
+    scheduler.start()
+    try:
+        assert wait_until(lambda: scheduler.is_owner)
+        # the runs are dispatched when the schedules are loaded
+        wait_until(lambda: len(runs) >= expected, timeout=2 if expected else 0.2)
+    finally:
+        scheduler.stop()
+    assert len(runs) == expected
+    (schedule,) = scheduler.schedules()
+    assert schedule.nominal == first + 240
@@ -0,0 +1,31 @@
+import pytest
+
+import sharding
+from config import Config, Device
+from mqtt import paho
+from sharding import ShardedController, ShardError
+from support import wait_until
+
+DEVICE = Device(type="tasmota-plug", name="Plug", ip="127.0.0.1:9")
+
+
+@pytest.mark.skipif(paho is None, reason="paho-mqtt is not installed")
+def test_crash_looping_shard_is_left_dead(monkeypatch):
+    monkeypatch.setattr(sharding, "SHARD_RESTART_DELAY", 0.01)
+    monkeypatch.setattr(sharding, "SHARD_CRASH_LIMIT", 3)
+    # a mqtt section without host makes the worker exit on start
+    config = Config(devices=(DEVICE,), groups={}, scenes={}, mqtt={"port": 1883})
+    controller = ShardedController(config, shards=1)
+    unavailable = []
+    controller.health.subscribe(
+        lambda ip, available: available or unavailable.append(ip)
+    )
+    try:
+        assert wait_until(lambda: unavailable, timeout=60)
+        assert unavailable == [DEVICE.ip]
+        assert not controller.is_available(DEVICE)
+        assert len(controller._shards[0].exits) == 3
+        with pytest.raises(ShardError):
+            controller.get_state(DEVICE)
+    finally:
+        controller.close()
@@ -0,0 +1,122 @@
+import time
+
+from config import Config
+from support import wait_until
+from telemetry import (
+    RECORD,
+    RingFile,
+    TelemetryCollector,
+    TelemetryStore,
+    consumed,
+    downsample,
+    ring_specs,
+    series_file,
+)
+
+PLUG = "sim tasmota-plug 0"
+
+
+def test_ring_wraps_around(tmp_path):
+    ring_file = RingFile(tmp_path / "plug.ring", ((10, 5),))
+    (ring,) = ring_file.rings
+    for index in range(13):
+        ring_file.add(index * 10, float(index), index / 10)
+    assert len(ring) == 5
+    assert [record[0] for record in ring.records()] == [80, 90, 100, 110, 120]
+    assert ring.last()[2] == 12.0
+    # ranges across the end of the buffer, [start, end)
+    assert [record[0] for record in ring.records(95, 115)] == [100, 110]
+    assert [record[0] for record in ring.records(0, 85)] == [80]
+    assert ring.records(121) == []
+    ring_file.close()
+
+
+def test_ring_merges_samples_of_a_record(tmp_path):
+    ring_file = RingFile(tmp_path / "plug.ring", ((10, 5), (60, 2)))
+    for t, power in ((0, 10.0), (5, 30.0), (10, 20.0), (70, 40.0)):
+        ring_file.add(t, power, t / 100)
+    raw, minute = ring_file.rings
+    assert raw.records()[0] == RECORD.unpack(RECORD.pack(0, 2, 20.0, 10.0, 30.0, 0.05))
+    assert [(r[0], r[1]) for r in minute.records()] == [(0, 3), (60, 1)]
+    # the clock went back, dropped
+    ring_file.add(30, 99.0, 1.0)
+    assert len(raw) == 3
+    ring_file.close()
+
+
+def test_file_converted_when_the_rings_change(tmp_path):
+    path = tmp_path / "plug.ring"
+    ring_file = RingFile(path, ((10, 4),))
+    for index in range(4):
+        ring_file.add(index * 10, 1.0, 0.0)
+    ring_file.close()
+    ring_file = RingFile(path, ((10, 2), (300, 2)))
+    assert [record[0] for record in ring_file.rings[0].records()] == [20, 30]
+    assert len(ring_file.rings[1]) == 0
+    ring_file.close()
+    assert RingFile(path).specs() == ((10, 2), (300, 2))
+
+
+def test_series_files_do_not_clash(tmp_path):
+    assert series_file(tmp_path, "Plug 1") != series_file(tmp_path, "plug-1")
+
+
+def test_downsample_and_consumed():
+    records = [
+        (0, 1, 10.0, 10.0, 10.0, 5.0),
+        (10, 1, 30.0, 30.0, 30.0, 5.5),
+        (60, 2, 20.0, 15.0, 25.0, 0.2),
+        (70, 1, 40.0, 40.0, 40.0, 0.5),
+    ]
+    points = downsample(records, 60)
+    assert points == [
+        {"t": 0, "samples": 2, "avg": 20.0, "min": 10.0, "max": 30.0, "energy": 5.5},
+        {"t": 60, "samples": 3, "avg": 26.67, "min": 15.0, "max": 40.0, "energy": 0.5},
+    ]
+    # the counter was reset in between
+    assert consumed(points) == 0.0
+    assert consumed(downsample(records[:2], 10)) == 0.5
+
+
+def test_query_reads_the_coarsest_ring_of_the_bucket(tmp_path):
+    specs = ring_specs({"interval": 60, "raw_days": 1, "five_minute_days": 1})
+    assert [resolution for resolution, _ in specs] == [60, 300, 3600]
+    store = TelemetryStore(tmp_path, specs)
+    day = 86400 * 20000
+    for minute in range(120):
+        store.add("plug", day + minute * 60, 100.0, minute / 60)
+    store.close()
+    hourly = store.query("plug", day, day + 7200, bucket=3600)
+    assert [point["samples"] for point in hourly["points"]] == [60, 60]
+    assert hourly["kwh"] == round(119 / 60 - 59 / 60, 3)
+    default = store.query("plug", day, day + 7200)
+    # ~QUERY_BUCKETS points, never finer than the raw ring
+    assert default["bucket"] == 60 and len(default["points"]) == 120
+    assert store.query("other", day, day + 60)["points"] == []
+
+
+def test_collector_samples_the_metered_devices(controller, tmp_path):
+    options = {"interval": 1, "path": str(tmp_path / "telemetry")}
+    store = TelemetryStore(tmp_path / "telemetry", ring_specs(options))
+    controller.config = Config(
+        devices=controller.config.devices,
+        groups={},
+        scenes={},
+        telemetry=options,
+    )
+    collector = TelemetryCollector(controller, store)
+    collector.start()
+    try:
+        assert wait_until(lambda: collector.is_owner)
+        end = time.time() + 60
+        assert wait_until(
+            lambda: store.query(PLUG, end - 120, end)["points"], timeout=10
+        )
+    finally:
+        collector.stop()
+    point = store.query(PLUG, end - 120, end)["points"][0]
+    assert 50 <= point["avg"] <= 70
+    names = {device.name for device in controller.config.devices} - {PLUG}
+    # no energy monitor or down: no file
+    assert all(not series_file(store.directory, name).exists() for name in names)
+    assert not (store.directory / ".lock").exists()
@@ -0,0 +1,75 @@
+import json
+import socket
+import threading
+
+import yeelight_manager
+from state import StateCache
+from support import wait_until
+from yeelight_manager import BulbListener
+
+
+class ClosingBulb:
+    """Answers get_prop, then closes the notification connection."""
+
+    def __init__(self) -> None:
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.connections = 0
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self.server.close()
+
+    def _serve(self) -> None:
+        notifications = None
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            if notifications is None:
+                notifications = conn
+                continue
+            request = json.loads(conn.makefile("rb").readline())
+            reply = {"id": request["id"], "result": ["on"] * len(request["params"])}
+            conn.sendall(json.dumps(reply).encode() + b"\r\n")
+            conn.close()
+            notifications.close()
+            notifications = None
+
+
+def test_listener_writes_notifications_to_the_cache(simulator):
+    (model,) = simulator.add_yeelight(1)
+    simulator.start()
+    (device,) = simulator.devices()
+    cache = StateCache()
+    listener = BulbListener(device["ip"], cache, port=device["port"])
+    listener.start()
+    try:
+        assert listener.listening.wait(5)
+        assert cache.get(device["ip"])["power"] == model.props["power"]
+        # a change made on another connection is pushed to the listener
+        from yeelight import Bulb
+
+        Bulb(device["ip"], port=device["port"]).set_brightness(42)
+        assert wait_until(lambda: cache.get(device["ip"])["bright"] == "42")
+    finally:
+        listener.stop()
+
+
+def test_listener_reconnects_when_the_bulb_closes(monkeypatch):
+    monkeypatch.setattr(yeelight_manager, "LISTEN_RECONNECT_DELAY", 0.05)
+    bulb = ClosingBulb()
+    cache = StateCache()
+    listener = BulbListener("127.0.0.1", cache, port=bulb.port)
+    listener.start()
+    try:
+        # two connections per attempt: notifications and get_prop
+        assert wait_until(lambda: bulb.connections >= 6)
+    finally:
+        listener.stop()
+        bulb.close()
+    listener._thread.join(5)
+    assert not listener._thread.is_alive()